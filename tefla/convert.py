@@ -7,6 +7,8 @@
 from __future__ import division, print_function
 
 import os
+import json
+import time
 from PIL import Image, ImageFilter
 from multiprocessing import cpu_count
 from multiprocessing.pool import Pool
@@ -65,8 +67,7 @@ def convert_v2(fname, target_size=512):
     print('Corrupted Image file %s' % fname)
 
 
-def full_bbox(img, fname):
-  print("full bbox conversion done for image: %s" % fname)
+def full_bbox(img, fname=None):
   w, h = img.size
   left = 0
   upper = 0
@@ -75,8 +76,7 @@ def full_bbox(img, fname):
   return (left, upper, right, lower)
 
 
-def square_bbox(img, fname):
-  print("square bbox conversion done for image: %s" % fname)
+def square_bbox(img, fname=None):
   w, h = img.size
   left = max((w - h) // 2, 0)
   upper = 0
@@ -115,15 +115,61 @@ def get_convert_fname(fname, extension, directory, convert_directory):
 
 
 def process(args):
+  """Converts one image, unless its converted file is already up to date.
+
+  Returns:
+      a tuple, (fname, mtime, size, ok) with the source file stats recorded
+      in the conversion manifest; the stats are `None` for a file that can
+      not be read
+  """
   fun, arg = args
   directory, convert_directory, fname, crop_size, extension = arg
   convert_fname = get_convert_fname(fname, extension, directory, convert_directory)
-  if not os.path.exists(convert_fname):
+  try:
+    stat = os.stat(fname)
+    if os.path.exists(convert_fname) and os.path.getmtime(convert_fname) >= stat.st_mtime:
+      return fname, stat.st_mtime, stat.st_size, True
     img = fun(fname, crop_size)
-    try:
-      save(img, convert_fname)
-    except Exception:
-      print('Corrupted Image file %s' % fname)
+    save(img, convert_fname)
+  except Exception:
+    print('Corrupted Image file %s' % fname)
+    return fname, None, None, False
+  return fname, stat.st_mtime, stat.st_size, True
+
+
+def load_manifest(path, crop_size, extension):
+  """Loads the conversion manifest, a map of source file to (mtime, size).
+
+  A missing manifest, or one written for another crop size or extension,
+  gives an empty map.
+  """
+  try:
+    with open(path) as f:
+      manifest = json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+  if manifest.get('crop_size') != crop_size or manifest.get('extension') != extension:
+    return {}
+  return manifest.get('files', {})
+
+
+def save_manifest(path, files, crop_size, extension):
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump({'crop_size': crop_size, 'extension': extension, 'files': files}, f)
+  os.rename(tmp_path, path)
+
+
+def is_converted(fname, files, directory):
+  entry = files.get(os.path.relpath(fname, directory))
+  if entry is None:
+    return False
+  try:
+    stat = os.stat(fname)
+  except OSError:
+    # removed since the walk, reported by process
+    return False
+  return entry[0] == stat.st_mtime and entry[1] == stat.st_size
 
 
 def save(img, fname):
@@ -146,7 +192,12 @@ def save(img, fname):
     help="Convert images one by one and examine them on screen.")
 @click.option('--crop_size', default=256, show_default=True, help="Size of converted images.")
 @click.option('--extension', default='tiff', show_default=True, help="Filetype of converted images.")
-def main(directory, convert_directory, test, crop_size, extension):
+@click.option(
+    '--chunksize',
+    default=0,
+    show_default=True,
+    help="Images handed to a worker at a time, 0 to derive it from the number of images.")
+def main(directory, convert_directory, test, crop_size, extension, chunksize):
   try:
     os.mkdir(convert_directory)
   except OSError:
@@ -176,22 +227,35 @@ def main(directory, convert_directory, test, crop_size, extension):
 
   print("Resizing images in {} to {}, this takes a while." "".format(directory, convert_directory))
 
+  manifest_path = os.path.join(convert_directory, '.convert_manifest.json')
+  files = load_manifest(manifest_path, crop_size, extension)
+  n_total = len(filenames)
+  filenames = [f for f in filenames if not is_converted(f, files, directory)]
   n = len(filenames)
-  # process in batches, sometimes weird things happen with Pool on my machine
-  batchsize = 500
-  batches = n // batchsize + 1
-  pool = Pool(N_PROC)
-
-  args = []
+  print("{} images to convert, {} up to date".format(n, n_total - n))
+  if chunksize <= 0:
+    # large enough to amortize the ipc, small enough to keep all workers busy at the end
+    chunksize = max(1, min(64, n // (N_PROC * 16)))
 
-  for f in filenames:
-    args.append((convert, (directory, convert_directory, f, crop_size, extension)))
-
-  for i in range(batches):
-    print("batch {:>2} / {}".format(i + 1, batches))
-    pool.map(process, args[i * batchsize:(i + 1) * batchsize])
-
-  pool.close()
+  args = [(convert, (directory, convert_directory, f, crop_size, extension)) for f in filenames]
+  pool = Pool(N_PROC)
+  start = last_report = last_save = time.time()
+  try:
+    for i, (fname, mtime, size, ok) in enumerate(
+        pool.imap_unordered(process, args, chunksize=chunksize), start=1):
+      if ok:
+        files[os.path.relpath(fname, directory)] = [mtime, size]
+      now = time.time()
+      if now - last_save > 30:
+        save_manifest(manifest_path, files, crop_size, extension)
+        last_save = now
+      if now - last_report > 5 or i == n:
+        rate = i / max(now - start, 1e-6)
+        print("{:>7} / {} images, {:.1f} images/s, ETA {:.0f}s".format(i, n, rate, (n - i) / rate))
+        last_report = now
+  finally:
+    pool.terminate()
+    save_manifest(manifest_path, files, crop_size, extension)
 
   print('done')
 
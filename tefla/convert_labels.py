@@ -86,19 +86,14 @@ def palette_demo():
 
 
 def convert_labels(label_image, image_height, image_width):
-  arr_3d = label_image
-  arr_2d = np.zeros((arr_3d.shape[0], arr_3d.shape[1]), dtype=np.uint8)
+  arr_3d = np.asarray(label_image, dtype=np.int64)
   palette = pascal_palette()
-
-  for i in range(0, arr_3d.shape[0]):
-    for j in range(0, arr_3d.shape[1]):
-      key = (arr_3d[i, j, 0], arr_3d[i, j, 1], arr_3d[i, j, 2])
-      arr_2d[i, j] = palette.get(key, 0)
-  print(sum(sum(arr_2d)))
-  # import matplotlib.pyplot as plt
-  # plt.imshow(arr_2d)
-  # plt.show()
-  return arr_2d
+  # look the colours up as 24 bit keys, unknown colours give 0
+  keys = np.array(sorted((r << 16) | (g << 8) | b for r, g, b in palette))
+  labels = np.array([palette[(k >> 16, (k >> 8) & 255, k & 255)] for k in keys], dtype=np.uint8)
+  colors = (arr_3d[:, :, 0] << 16) | (arr_3d[:, :, 1] << 8) | arr_3d[:, :, 2]
+  idx = np.minimum(np.searchsorted(keys, colors), len(keys) - 1)
+  return np.where(keys[idx] == colors, labels[idx], 0).astype(np.uint8)
 
 
 def convert_seg_labels(label_file, image_height, image_width):
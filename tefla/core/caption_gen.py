@@ -136,63 +136,109 @@ class CaptionGenerator(object):
     Returns:
         A list of Caption sorted by descending score.
     """
-    # Feed in the image to get the initial state.
-    initial_state = self.model.feed_image(sess, encoded_image)
-
-    initial_beam = Caption(
-        sentence=[self.vocab.start_id],
-        state=initial_state[0],
-        logprob=0.0,
-        score=0.0,
-        metadata=[""])
-    partial_captions = TopN(self.beam_size)
-    partial_captions.push(initial_beam)
-    complete_captions = TopN(self.beam_size)
+    return self.beam_search_batch(sess, [encoded_image])[0]
 
-    # Run beam search.
-    for _ in range(self.max_caption_length - 1):
-      partial_captions_list = partial_captions.extract()
-      partial_captions.reset()
-      input_feed = np.array([c.sentence[-1] for c in partial_captions_list])
-      state_feed = np.array([c.state for c in partial_captions_list])
+  def beam_search_batch(self, sess, encoded_images):
+    """Runs beam search caption generation on a batch of images.
 
-      softmax, new_states, metadata = self.model.inference_step(sess, input_feed, state_feed)
+    The partial captions of all images are advanced together, with one
+    inference_step() call per time step.
+
+    Args:
+        sess: TensorFlow Session object.
+        encoded_images: A list of encoded image strings.
+
+    Returns:
+        A list with, for each image, a list of Caption sorted by descending score.
+    """
+    partial_captions = []
+    complete_captions = []
+    for encoded_image in encoded_images:
+      # Feed in the image to get the initial state.
+      initial_state = self.model.feed_image(sess, encoded_image)
+      initial_beam = Caption(
+          sentence=[self.vocab.start_id],
+          state=initial_state[0],
+          logprob=0.0,
+          score=0.0,
+          metadata=[""])
+      partial_captions.append(TopN(self.beam_size))
+      partial_captions[-1].push(initial_beam)
+      complete_captions.append(TopN(self.beam_size))
+
+    # Images whose search is still running.
+    active = list(range(len(encoded_images)))
 
-      for i, partial_caption in enumerate(partial_captions_list):
-        word_probabilities = softmax[i]
-        state = new_states[i]
-        # For this partial caption, get the beam_size most probable next words.
-        words_and_probs = list(enumerate(word_probabilities))
-        words_and_probs.sort(key=lambda x: -x[1])
-        words_and_probs = words_and_probs[0:self.beam_size]
-        # Each next word gives a new partial caption.
-        for w, p in words_and_probs:
-          if p < 1e-12:
-            continue  # Avoid log(0).
-          sentence = partial_caption.sentence + [w]
-          logprob = partial_caption.logprob + math.log(p)
-          score = logprob
-          if metadata:
-            metadata_list = partial_caption.metadata + \
-                [metadata[i]]
-          else:
-            metadata_list = None
-          if w == self.vocab.end_id:
-            if self.length_normalization_factor > 0:
-              score /= len(sentence)**self.length_normalization_factor
-            beam = Caption(sentence, state, logprob, score, metadata_list)
-            complete_captions.push(beam)
-          else:
-            beam = Caption(sentence, state, logprob, score, metadata_list)
-            partial_captions.push(beam)
-      if partial_captions.size() == 0:
-        # We have run out of partial candidates; happens when beam_size = 1.
+    # Run beam search.
+    for _ in range(self.max_caption_length - 1):
+      if not active:
         break
+      partial_captions_lists = []
+      for b in active:
+        partial_captions_lists.append(partial_captions[b].extract())
+        partial_captions[b].reset()
+      captions_flat = [c for captions in partial_captions_lists for c in captions]
+      input_feed = np.array([c.sentence[-1] for c in captions_flat])
+      state_feed = np.array([c.state for c in captions_flat])
 
-    # If we have no complete captions then fall back to the partial captions.
-    # But never output a mixture of complete and partial captions because a
-    # partial caption could have a higher score than all the complete captions.
-    if not complete_captions.size():
-      complete_captions = partial_captions
+      softmax, new_states, metadata = self.model.inference_step(sess, input_feed, state_feed)
+      words, probs = self._top_words(softmax)
+
+      i = 0
+      for b, partial_captions_list in zip(active, partial_captions_lists):
+        for partial_caption in partial_captions_list:
+          state = new_states[i]
+          # Each of the beam_size most probable next words gives a new partial caption.
+          for w, p in zip(words[i], probs[i]):
+            if p < 1e-12:
+              continue  # Avoid log(0).
+            sentence = partial_caption.sentence + [w]
+            logprob = partial_caption.logprob + math.log(p)
+            score = logprob
+            if metadata:
+              metadata_list = partial_caption.metadata + \
+                  [metadata[i]]
+            else:
+              metadata_list = None
+            if w == self.vocab.end_id:
+              if self.length_normalization_factor > 0:
+                score /= len(sentence)**self.length_normalization_factor
+              beam = Caption(sentence, state, logprob, score, metadata_list)
+              complete_captions[b].push(beam)
+            else:
+              beam = Caption(sentence, state, logprob, score, metadata_list)
+              partial_captions[b].push(beam)
+          i += 1
+      # We have run out of partial candidates; happens when beam_size = 1.
+      active = [b for b in active if partial_captions[b].size()]
+
+    results = []
+    for partial, complete in zip(partial_captions, complete_captions):
+      # If we have no complete captions then fall back to the partial captions.
+      # But never output a mixture of complete and partial captions because a
+      # partial caption could have a higher score than all the complete captions.
+      if not complete.size():
+        complete = partial
+      results.append(complete.extract(sort=True))
+    return results
+
+  def _top_words(self, softmax):
+    """Returns the beam_size most probable words of every row of softmax.
+
+    Words are sorted by descending probability, ties by ascending word id.
 
-    return complete_captions.extract(sort=True)
+    Returns:
+        A tuple (words, probabilities), both of shape [rows, beam_size].
+    """
+    k = min(self.beam_size, softmax.shape[1])
+    rows = np.arange(len(softmax))[:, None]
+    words = np.sort(np.argpartition(-softmax, k - 1, axis=1)[:, :k], axis=1)
+    probs = softmax[rows, words]
+    # Rows where the k-th probability is tied with a word left out keep the
+    # lowest word ids through a stable sort of the whole row.
+    tied = np.nonzero((softmax >= probs.min(1, keepdims=True)).sum(1) > k)[0]
+    if len(tied):
+      words[tied] = np.argsort(-softmax[tied], axis=1, kind='mergesort')[:, :k]
+      probs[tied] = softmax[tied[:, None], words[tied]]
+    order = np.argsort(-probs, axis=1, kind='mergesort')
+    return words[rows, order].tolist(), probs[rows, order].tolist()
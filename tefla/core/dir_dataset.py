@@ -6,6 +6,7 @@ import numpy as np
 
 from . import data_load_ops as data
 from . import logger
+from ..da.packed_images import PackedImages
 
 
 class DataSet(object):
@@ -71,3 +72,24 @@ class DataSet(object):
     logger.info("Data: Class frequencies: %s" % self.class_frequencies())
     logger.info("Data: Class balance weights: %s" % self.balance_weights())
     logger.info("Data: #Validation images: %d" % self.num_validation_files())
+
+
+class PackedDataSet(DataSet):
+  """A dataset read from the packed training and validation files written
+  by `pack_dataset.py`, `training_<img_size>.packed` and
+  `validation_<img_size>.packed` in `data_dir`.
+
+  The image names are used as `training_X`/`validation_X`, and
+  `training_preprocessor`/`validation_preprocessor` load them from the
+  memory mapped files.
+  """
+
+  def __init__(self, data_dir, img_size):
+    self.data_dir = data_dir
+    self.training_preprocessor = PackedImages("%s/training_%d.packed" % (data_dir, img_size))
+    self._training_files = self.training_preprocessor.names
+    self._training_labels = self.training_preprocessor.labels.astype(np.int32)
+
+    self.validation_preprocessor = PackedImages("%s/validation_%d.packed" % (data_dir, img_size))
+    self._validation_files = self.validation_preprocessor.names
+    self._validation_labels = self.validation_preprocessor.labels.astype(np.int32)
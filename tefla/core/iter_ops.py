@@ -27,11 +27,13 @@ def create_training_iters(cnf, data_set, standardizer, crop_size, epoch, paralle
     validation_iterator_maker = iterator.ParallelDAIterator
     logger.info('Using queued iterators')
 
-  preprocessor = None
+  # packed datasets read their images through their own preprocessors
+  training_preprocessor = getattr(data_set, 'training_preprocessor', None)
+  validation_preprocessor = getattr(data_set, 'validation_preprocessor', None)
   training_iterator = training_iterator_maker(
       batch_size=cnf['batch_size_train'],
       shuffle=True,
-      preprocessor=preprocessor,
+      preprocessor=training_preprocessor,
       crop_size=crop_size,
       is_training=True,
       aug_params=cnf['aug_params'],
@@ -48,7 +50,7 @@ def create_training_iters(cnf, data_set, standardizer, crop_size, epoch, paralle
   validation_iterator = validation_iterator_maker(
       batch_size=cnf['batch_size_test'],
       shuffle=False,
-      preprocessor=preprocessor,
+      preprocessor=validation_preprocessor,
       crop_size=crop_size,
       is_training=False,
       standardizer=standardizer,
@@ -12,6 +12,7 @@ import numpy as np
 import tensorflow as tf
 
 from .base import Base, BaseMixin
+from .metrics import ConfusionMatrix
 from . import summary as summary
 from . import logger as log
 from .optimizer import MovingAverageOptimizer
@@ -182,6 +183,8 @@ class SupervisedLearner(Base, BaseMixin):
         batch_validation_metrics = [[] for _, _ in self.validation_metrics_def]
         epoch_validation_metrics = []
         batch_validation_sizes = []
+        # epoch level scores, exact rather than averaged over the batches
+        validation_confusion = ConfusionMatrix(self.num_classes) if self.classification else None
         for batch_num, (validation_Xb, validation_yb) in enumerate(
                 self.validation_iterator(validation_X, validation_y)):
           if validation_Xb.shape[0] < self.cnf['batch_size_test']:
@@ -195,8 +198,8 @@ class SupervisedLearner(Base, BaseMixin):
           if (epoch - 1) % summary_every == 0 and self.is_summary and \
                   validation_batch_summary_op is not None:
             log.debug('7. Running validation steps with summary...')
-            _validation_metric, summary_str_validate = sess.run(
-                [self.validation_metric, validation_batch_summary_op],
+            _validation_metric, _validation_predictions, summary_str_validate = sess.run(
+                [self.validation_metric, self.validation_predictions, validation_batch_summary_op],
                 feed_dict=feed_dict_validation)
             validation_writer.add_summary(summary_str_validate, epoch)
             validation_writer.flush()
@@ -207,10 +210,14 @@ class SupervisedLearner(Base, BaseMixin):
                                                                          _validation_metric[0]))
           else:
             log.debug('7. Running validation steps without summary...')
-            _validation_metric = sess.run(self.validation_metric, feed_dict=feed_dict_validation)
+            _validation_metric, _validation_predictions = sess.run(
+                [self.validation_metric, self.validation_predictions],
+                feed_dict=feed_dict_validation)
             log.debug('7. Running validation steps without summary done.')
           validation_losses.append(_validation_metric[-1])
           batch_validation_sizes.append(self.cnf.get('batch_size_test', 32))
+          if validation_confusion is not None:
+            validation_confusion.update(_validation_predictions, validation_yb)
 
           for i, (_, metric_function) in enumerate(self.validation_metrics_def):
             batch_validation_metrics[i].append(_validation_metric[i])
@@ -238,6 +245,10 @@ class SupervisedLearner(Base, BaseMixin):
             ', %s: %.3f' % (name, epoch_validation_metrics[i])
             for i, (name, _) in enumerate(self.validation_metrics_def)
         ]
+        if validation_confusion is not None:
+          custom_metrics_string.append(', v-kappa: %.3f, v-accuracy: %.3f' %
+                                       (validation_confusion.kappa(),
+                                        validation_confusion.accuracy()))
         custom_metrics_string = ''.join(custom_metrics_string)
 
         log.info("Epoch %d [(%s, %s) images, %6.1fs]: t-loss: %.3f, v-loss: %.3f%s" %
@@ -7,6 +7,7 @@ from __future__ import division, print_function, absolute_import
 
 import os
 import time
+import functools
 
 import numpy as np
 import tensorflow as tf
@@ -17,7 +18,7 @@ from . import logger as log
 from ..da.data_augmentation import inputs, distorted_inputs
 from ..dataset.base import Dataset
 from ..dataset.decoder import Decoder
-from ..dataset.dataflow import Dataflow
+from ..dataset.dataflow import Dataflow, TFDataflow
 from ..da.preprocessor import InceptionPreprocessor
 
 TRAINING_BATCH_SUMMARIES = 'training_batch_summaries'
@@ -33,6 +34,8 @@ class SupervisedLearner(Base, BaseMixin):
   Args:
       model: model definition
       cnf: dict, training configs
+          e.g.: set 'tf_data' to read the TFRecords with a `TFDataflow`, and
+          'global_shuffle' to shuffle them globally through the record indexes
       training_iterator: iterator to use for training data access, processing and augmentations
       validation_iterator: iterator to use for validation data access, processing and augmentations
       start_epoch: int, training start epoch; for resuming training provide the last
@@ -153,7 +156,13 @@ class SupervisedLearner(Base, BaseMixin):
         num_examples_per_epoch=training_set_size,
         batch_size=self.cnf['batch_size_train'])
 
-    dataflow_train = Dataflow(
+    if self.cnf.get('tf_data', False):
+      # tf.data input pipeline, optionally globally shuffled through the record indexes
+      dataflow_class = functools.partial(
+          TFDataflow, global_shuffle=self.cnf.get('global_shuffle', False))
+    else:
+      dataflow_class = Dataflow
+    dataflow_train = dataflow_class(
         dataset,
         num_readers=num_readers,
         shuffle=True,
@@ -167,7 +176,7 @@ class SupervisedLearner(Base, BaseMixin):
           num_examples_per_epoch=val_set_size,
           batch_size=self.cnf['batch_size_train'])
 
-      dataflow_val = Dataflow(
+      dataflow_val = dataflow_class(
           dataset_val,
           num_readers=num_readers,
           shuffle=False,
@@ -14,12 +14,11 @@ import six
 import tensorflow as tf
 import numpy as np
 import os
-import re
-import subprocess
-import tempfile
+import math
 import itertools
+import collections
+from multiprocessing.pool import Pool, ThreadPool
 
-from six.moves import urllib
 from pydoc import locate
 from sklearn.metrics import precision_recall_fscore_support, roc_auc_score, accuracy_score
 from tensorflow.contrib import metrics
@@ -28,6 +27,7 @@ from ..convert import convert
 from ..convert_labels import convert_labels
 from .encoder import Configurable
 from ..utils import postproc
+from ..utils import quadratic_weighted_kappa as qwk
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -49,28 +49,80 @@ class MetricMixin(object):
 
   def confusion_matrix(self, rater_a, rater_b, min_rating=None, max_rating=None):
     """Returns the confusion matrix between rater's ratings."""
-    assert (len(rater_a) == len(rater_b))
-    if min_rating is None:
-      min_rating = min(rater_a + rater_b)
-    if max_rating is None:
-      max_rating = max(rater_a + rater_b)
-    num_ratings = int(max_rating - min_rating + 1)
-    conf_mat = [[0 for i in range(num_ratings)] for j in range(num_ratings)]
-    for a, b in zip(rater_a, rater_b):
-      conf_mat[a - min_rating][b - min_rating] += 1
-    return conf_mat
+    return qwk.confusion_matrix(rater_a, rater_b, min_rating, max_rating)
 
   def histogram(self, ratings, min_rating=None, max_rating=None):
     """Returns the counts of each type of rating that a rater made."""
-    if min_rating is None:
-      min_rating = min(ratings)
-    if max_rating is None:
-      max_rating = max(ratings)
-    num_ratings = int(max_rating - min_rating + 1)
-    hist_ratings = [0 for x in range(num_ratings)]
-    for r in ratings:
-      hist_ratings[r - min_rating] += 1
-    return hist_ratings
+    return qwk.histogram(ratings, min_rating, max_rating)
+
+
+class ConfusionMatrix(object):
+  """Running confusion matrix, for metrics accumulated over batches.
+
+  Each `update` adds the counts of a batch with a single `np.bincount`;
+  the metrics are computed from the matrix alone, in O(num_classes**2)
+  whatever the number of samples seen.
+
+  Args:
+      num_classes: int, number of classes
+  """
+
+  def __init__(self, num_classes):
+    self.num_classes = num_classes
+    self.reset()
+
+  def reset(self):
+    """Clears the counts, e.g. at the start of an epoch."""
+    self.conf_mat = np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+
+  def update(self, predictions, targets):
+    """Adds a batch of predictions and targets to the counts.
+
+    Args:
+        predictions: 1D array of class ids, or 2D array of class scores
+        targets: 1D array of class ids, or 2D array of one hot labels
+
+    Pairs with a class id outside `[0, num_classes)` are left out, as in
+    `fast_hist`.
+    """
+    predictions = np.asarray(predictions)
+    targets = np.asarray(targets)
+    if predictions.ndim > 1 and predictions.shape[1] > 1:
+      predictions = np.argmax(predictions, axis=1)
+    if targets.ndim > 1 and targets.shape[1] > 1:
+      targets = np.argmax(targets, axis=1)
+    predictions = predictions.ravel().astype(np.int64)
+    targets = targets.ravel().astype(np.int64)
+    n = self.num_classes
+    k = (predictions >= 0) & (predictions < n) & (targets >= 0) & (targets < n)
+    self.conf_mat += np.bincount(predictions[k] * n + targets[k], minlength=n * n).reshape(n, n)
+
+  def kappa(self):
+    """Quadratic weighted kappa, as `Kappa`."""
+    try:
+      return qwk.kappa_from_confusion_matrix(self.conf_mat)
+    except ZeroDivisionError:
+      return 0.0001
+
+  def accuracy(self):
+    return np.trace(self.conf_mat) / float(max(self.conf_mat.sum(), 1))
+
+  def f1_score(self):
+    """Macro averaged F1 score over the classes seen in predictions or targets."""
+    tp = np.diag(self.conf_mat).astype(np.float64)
+    support = self.conf_mat.sum(0) + self.conf_mat.sum(1)
+    seen = support > 0
+    return np.mean(2 * tp[seen] / support[seen]) if seen.any() else 0.0
+
+  def iou(self):
+    """Per class intersection over union, `nan` for classes never seen."""
+    tp = np.diag(self.conf_mat).astype(np.float64)
+    union = self.conf_mat.sum(0) + self.conf_mat.sum(1) - tp
+    with np.errstate(divide='ignore', invalid='ignore'):
+      return tp / union
+
+  def mean_iou(self):
+    return np.nanmean(self.iou())
 
 
 class Top_k(Metric):
@@ -135,63 +187,116 @@ class IOU(Metric, MetricMixin):
       ])
 
 
+def _load_seg_label(gt_name, image_size):
+  """Loads a ground truth mask as class ids, in a worker thread."""
+  gt = np.asarray(convert(gt_name, image_size))
+  return convert_labels(gt, image_size, image_size)
+
+
+def _load_seg_example(fname, gt_name, image_size, load_image):
+  """Loads an image, with `load_image` if given, and its ground truth mask."""
+  img = load_image(fname) if load_image is not None else fname
+  return img, _load_seg_label(gt_name, image_size)
+
+
 class IOUSeg(object):
+  """Segmentation IoU over a directory of images and `_final_mask.png` masks.
+
+  All the images are predicted in one pass, in batches, while a pool of
+  worker threads loads the images and ground truth masks of the next
+  `prefetch_batches` batches; threads rather than processes, as forking once
+  the predictor session runs its own threads is unsafe. Images are decoded
+  by the predictor's `load_image` method and passed to `predict` decoded;
+  for a predictor without one, `predict` gets the filenames. The per pixel
+  counts are accumulated in one `fast_hist` confusion matrix, from which the
+  mean and per class IoU are computed; pass the matrix returned by
+  `evaluate` to both to predict the images only once.
 
-  def __init__(self, name='IOU'):
+  Args:
+      name: a string, name of the metric
+      num_classes: number of classes, including background
+      class_names: dict of class id to name, used for the per class IoU;
+          defaults to the class ids
+      batch_size: number of images per `predictor.predict` call
+      workers: number of loading threads, `None` for one per cpu
+      prefetch_batches: number of batches loaded ahead of the one being
+          predicted
+  """
+
+  def __init__(self,
+               name='IOU',
+               num_classes=15,
+               class_names=None,
+               batch_size=8,
+               workers=None,
+               prefetch_batches=2):
     self.name = name
+    self.num_classes = num_classes
+    if class_names is None:
+      class_names = dict((i, i) for i in range(1, num_classes))
+    self.class_names = class_names
+    self.batch_size = batch_size
+    self.workers = workers
+    self.prefetch_batches = prefetch_batches
     super(IOUSeg, self).__init__()
 
-  def meaniou(self, predictor, predict_dir, image_size):
-    segparams = util.SegParams()
-    classes = segparams.feature_classes().values()
-    num_classes = len(classes) + 1
-    hist = np.zeros((num_classes, num_classes))
-    image_names = [
-        filename.strip() for filename in os.listdir(predict_dir) if filename.endswith('.jpg')
-    ]
-    for image_filename in image_names:
-      final_prediction_map = predictor.predict(os.path.join(predict_dir, image_filename))
-      final_prediction_map = final_prediction_map.transpose(0, 2, 1).squeeze()
-      gt_name = os.path.join(predict_dir, image_filename[:-4] + '_final_mask' + '.png')
-      gt = convert(gt_name, image_size)
-      gt = np.asarray(gt)
-      gt = convert_labels(gt, image_size, image_size)
-      hist += compute_hist(gt, final_prediction_map, num_classes=num_classes)
+  def evaluate(self, predictor, predict_dir, image_size):
+    """Predicts all the images and returns the confusion matrix, ground
+    truth along the rows."""
+    image_names = sorted(
+        filename.strip() for filename in os.listdir(predict_dir) if filename.endswith('.jpg'))
+    load_image = getattr(predictor, 'load_image', None)
+    hist = np.zeros((self.num_classes, self.num_classes))
+    pool = ThreadPool(self.workers)
+
+    def load_batch(start):
+      results = []
+      for image_filename in image_names[start:start + self.batch_size]:
+        fname = os.path.join(predict_dir, image_filename)
+        gt_name = os.path.join(predict_dir, image_filename[:-4] + '_final_mask' + '.png')
+        results.append(
+            pool.apply_async(_load_seg_example, (fname, gt_name, image_size, load_image)))
+      return results
+
+    starts = collections.deque(range(0, len(image_names), self.batch_size))
+    pending = collections.deque()
+    try:
+      # at most prefetch_batches + 1 batches of images and masks are held
+      while starts or pending:
+        while starts and len(pending) <= self.prefetch_batches:
+          pending.append(load_batch(starts.popleft()))
+        examples = [result.get() for result in pending.popleft()]
+        imgs = [img for img, _ in examples]
+        final_prediction_maps = predictor.predict(imgs).transpose(0, 2, 1)
+        for final_prediction_map, (_, gt) in zip(final_prediction_maps, examples):
+          hist += fast_hist(gt.ravel(), final_prediction_map.ravel(), self.num_classes)
+    finally:
+      pool.terminate()
+    return hist
+
+  def meaniou(self, predictor, predict_dir, image_size, hist=None):
+    """Returns the mean IoU; `hist` is an optional matrix from `evaluate`."""
+    if hist is None:
+      hist = self.evaluate(predictor, predict_dir, image_size)
     iou = np.diag(hist) / (hist.sum(1) + hist.sum(0) - np.diag(hist))
-    meaniou = np.nanmean(iou)
+    return np.nanmean(iou)
 
-    return meaniou
+  def per_class_iou(self, predictor, predict_dir, image_size, hist=None):
+    """Returns, for each class, the mean IoU of the class vs rest masks.
 
-  def per_class_iou(self, predictor, predict_dir, image_size):
-    image_names = [
-        filename.strip() for filename in os.listdir(predict_dir) if filename.endswith('.jpg')
-    ]
-    per_class_iou_hist = defaultdict(np.ndarray)
-    per_class_iou_dict = defaultdict(float)
-    segparams = util.SegParams()
-    classes = segparams.feature_classes().values()
-    num_classes = len(classes) + 1
-    for class_id, class_name in enumerate(classes, 1):
-      per_class_iou_hist[class_name] = np.zeros((num_classes, num_classes))
-
-    for image_filename in image_names:
-      final_prediction_map = predictor.predict(os.path.join(predict_dir, image_filename))
-      final_prediction_map = final_prediction_map.transpose(0, 2, 1).squeeze()
-      gt_name = os.path.join(predict_dir, image_filename[:-4] + '_final_mask' + '.png')
-      gt = convert(gt_name, image_size)
-      gt = np.asarray(gt)
-      gt = convert_labels(gt, image_size, image_size)
-      for class_id, class_name in enumerate(classes, 1):
-        per_class_iou_hist[class_name] += compute_hist(
-            np.asarray(gt == class_id, dtype=np.int32),
-            np.asarray(final_prediction_map == class_id, dtype=np.int32),
-            num_classes=num_classes)
-
-    for class_id, class_name in enumerate(classes, 1):
+    `hist` is an optional confusion matrix from `evaluate`.
+    """
+    if hist is None:
+      hist = self.evaluate(predictor, predict_dir, image_size)
+    total = hist.sum()
+    per_class_iou_dict = collections.defaultdict(float)
+    for class_id, class_name in sorted(self.class_names.items()):
+      tp = hist[class_id, class_id]
+      fn = hist[class_id].sum() - tp
+      fp = hist[:, class_id].sum() - tp
+      tn = total - tp - fn - fp
       per_class_iou_dict[class_name] = np.nanmean(
-          np.diag(per_class_iou_hist[class_name]) /
-          (per_class_iou_hist[class_name].sum(1) + per_class_iou_hist[class_name].sum(0) -
-           np.diag(per_class_iou_hist[class_name])))
+          np.array([tn, tp]) / np.array([tn + fn + fp, tp + fn + fp]))
     return per_class_iou_dict
 
 
@@ -254,23 +359,8 @@ class Kappa(Metric, MetricMixin):
     if max_rating is None:
       max_rating = max(max(rater_a), max(rater_b))
     conf_mat = self.confusion_matrix(rater_a, rater_b, min_rating, max_rating)
-    num_ratings = len(conf_mat)
-    num_scored_items = float(len(rater_a))
-
-    hist_rater_a = self.histogram(rater_a, min_rating, max_rating)
-    hist_rater_b = self.histogram(rater_b, min_rating, max_rating)
-
-    numerator = 0.0
-    denominator = 0.0
-
-    for i in range(num_ratings):
-      for j in range(num_ratings):
-        expected_count = (hist_rater_a[i] * hist_rater_b[j] / num_scored_items)
-        d = pow(i - j, 2.0) / pow(num_ratings - 1, 2.0)
-        numerator += d * conf_mat[i][j] / num_scored_items
-        denominator += d * expected_count / num_scored_items
     try:
-      return 1.0 - numerator / denominator
+      return qwk.kappa_from_confusion_matrix(conf_mat)
     except ZeroDivisionError:
       return 0.0001
 
@@ -621,6 +711,11 @@ class TextMetricSpec(Configurable, MetricSpec):
   def _py_func(self, hypotheses, references):
     """Wrapper function that converts tensors to unicode and slices them until
     the EOS token is found."""
+    return self.metric_fn(*self._prepare_text(hypotheses, references))
+
+  def _prepare_text(self, hypotheses, references):
+    """Converts hypotheses and references tensors to lists of unicode strings,
+    sliced until the EOS token and post-processed."""
     # Deal with byte chars
     if hypotheses.dtype.kind == np.dtype("U"):
       hypotheses = np.char.encode(hypotheses, "utf-8")
@@ -644,7 +739,7 @@ class TextMetricSpec(Configurable, MetricSpec):
       sliced_hypotheses = [self._postproc_fn(_) for _ in sliced_hypotheses]
       sliced_references = [self._postproc_fn(_) for _ in sliced_references]
 
-    return self.metric_fn(sliced_hypotheses, sliced_references)
+    return sliced_hypotheses, sliced_references
 
   def metric_fn(self, hypotheses, references):
     """Calculates the value of the metric.
@@ -662,11 +757,43 @@ class TextMetricSpec(Configurable, MetricSpec):
 
 
 class BleuMetricSpec(TextMetricSpec):
-  """Calculates BLEU score using the Moses multi-bleu.perl script."""
+  """Calculates BLEU score as the Moses multi-bleu.perl script does.
+
+  Instead of accumulating the strings of all eval batches, the update op adds
+  the batch BLEU statistics to a local variable; the value op only reduces
+  them to a score.
+  """
 
   def __init__(self, params):
     super(BleuMetricSpec, self).__init__(params, "bleu")
 
+  def create_metric_ops(self, _inputs, labels, predictions):
+    """Creates (value, update_op) tensors."""
+    with tf.variable_scope(self._name):
+
+      # Join tokens into single strings
+      predictions_flat = tf.reduce_join(
+          predictions["predicted_tokens"], 1, separator=self._separator)
+      labels_flat = tf.reduce_join(labels["target_tokens"], 1, separator=self._separator)
+
+      stats = tf.Variable(
+          name="stats",
+          initial_value=tf.zeros([10], dtype=tf.int64),
+          trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+      batch_stats = tf.py_func(
+          func=self._stats_py_func, inp=[predictions_flat, labels_flat], Tout=tf.int64)
+      stats_update = tf.assign_add(stats, tf.reshape(batch_stats, [10]))
+
+      metric_value = tf.py_func(func=bleu_from_stats, inp=[stats], Tout=tf.float32, name="value")
+      update_op = tf.py_func(
+          func=bleu_from_stats, inp=[stats_update], Tout=tf.float32, name="update_op")
+
+    return metric_value, update_op
+
+  def _stats_py_func(self, hypotheses, references):
+    return bleu_stats(*self._prepare_text(hypotheses, references))
+
   def metric_fn(self, hypotheses, references):
     return moses_multi_bleu(hypotheses, references, lowercase=False)
 
@@ -691,6 +818,7 @@ class RougeMetricSpec(TextMetricSpec):
   def metric_fn(self, hypotheses, references):
     if not hypotheses or not references:
       return np.float32(0.0)
+    # scored on the calling thread, forking from a running session is unsafe
     return np.float32(rouge(hypotheses, references)[self._rouge_type])
 
 
@@ -719,14 +847,77 @@ class LogPerplexityMetricSpec(MetricSpec, Configurable):
     return metrics.streaming_mean(predictions["losses"], loss_mask)
 
 
+def bleu_stats(hypotheses, references, lowercase=False):
+  """Computes the corpus BLEU statistics of hypotheses and references.
+
+  Statistics are additive, so those of successive batches can be summed and
+  reduced to the BLEU score of all of them with `bleu_from_stats`. Tokens and
+  counts follow the MOSES multi-bleu.perl script: words are split on ASCII
+  whitespace, lowercasing only affects ASCII letters and reference n-gram
+  counts clip the hypothesis counts.
+
+  Args:
+    hypotheses: A list of strings where each string is a single example.
+    references: A list of strings where each string is a single example.
+    lowercase: If true, lowercase hypotheses and references
+
+  Returns:
+    An int64 array: translation length, closest reference length, then the
+      matching and total counts of the 1 to 4-grams.
+  """
+  stats = np.zeros(10, dtype=np.int64)
+  for hyp, ref in zip(hypotheses, references):
+    hyp_words = _bleu_words(hyp, lowercase)
+    ref_words = _bleu_words(ref, lowercase)
+    stats[0] += len(hyp_words)
+    stats[1] += len(ref_words)
+    for n in range(1, 5):
+      hyp_ngrams = _count_ngrams(hyp_words, n)
+      ref_ngrams = _count_ngrams(ref_words, n)
+      stats[1 + n] += sum(min(count, ref_ngrams[ngram]) for ngram, count in hyp_ngrams.items())
+      stats[5 + n] += sum(hyp_ngrams.values())
+  return stats
+
+
+def _bleu_words(text, lowercase):
+  if not isinstance(text, bytes):
+    text = text.encode("utf-8")
+  if lowercase:
+    text = text.lower()
+  return text.split()
+
+
+def _count_ngrams(words, n):
+  return collections.Counter(zip(*[words[i:] for i in range(n)]))
+
+
+def bleu_from_stats(stats):
+  """Returns the BLEU score, from 0 to 100, of summed `bleu_stats`."""
+  length_translation, length_reference = stats[0], stats[1]
+  if length_reference == 0 or length_translation == 0:
+    # multi-bleu.perl fails on these
+    return np.float32(0.0)
+  log_precision = 0.0
+  for n in range(1, 5):
+    correct, total = stats[1 + n], stats[5 + n]
+    if correct == 0:
+      # no matching n-gram: a zero score
+      return np.float32(0.0)
+    log_precision += math.log(correct / total)
+  brevity_penalty = 1.0
+  if length_translation < length_reference:
+    brevity_penalty = math.exp(1 - length_reference / length_translation)
+  return np.float32(100 * brevity_penalty * math.exp(log_precision / 4))
+
+
 def moses_multi_bleu(hypotheses, references, lowercase=False):
-  """Calculate the bleu score for hypotheses and references using the MOSES
-  ulti-bleu.perl script.
+  """Calculate the bleu score for hypotheses and references as the MOSES
+  multi-bleu.perl script does, without running it.
 
   Args:
     hypotheses: A numpy array of strings where each string is a single example.
     references: A numpy array of strings where each string is a single example.
-    lowercase: If true, pass the "-lc" flag to the multi-bleu script
+    lowercase: If true, lowercase as the "-lc" flag of the multi-bleu script
 
   Returns:
     The BLEU score as a float32 value.
@@ -735,50 +926,7 @@ def moses_multi_bleu(hypotheses, references, lowercase=False):
   if np.size(hypotheses) == 0:
     return np.float32(0.0)
 
-  # Get MOSES multi-bleu script
-  try:
-    multi_bleu_path, _ = urllib.request.urlretrieve(
-        "https://raw.githubusercontent.com/moses-smt/mosesdecoder/"
-        "master/scripts/generic/multi-bleu.perl")
-    os.chmod(multi_bleu_path, 0o755)
-  except:
-    tf.logging.info("Unable to fetch multi-bleu.perl script, using local.")
-    metrics_dir = os.path.dirname(os.path.realpath(__file__))
-    bin_dir = os.path.abspath(os.path.join(metrics_dir, "..", "..", "tools"))
-    multi_bleu_path = os.path.join(bin_dir, "tools/multi-bleu.perl")
-
-  # Dump hypotheses and references to tempfiles
-  hypothesis_file = tempfile.NamedTemporaryFile()
-  hypothesis_file.write("\n".join(hypotheses).encode("utf-8"))
-  hypothesis_file.write(b"\n")
-  hypothesis_file.flush()
-  reference_file = tempfile.NamedTemporaryFile()
-  reference_file.write("\n".join(references).encode("utf-8"))
-  reference_file.write(b"\n")
-  reference_file.flush()
-
-  # Calculate BLEU using multi-bleu script
-  with open(hypothesis_file.name, "r") as read_pred:
-    bleu_cmd = [multi_bleu_path]
-    if lowercase:
-      bleu_cmd += ["-lc"]
-    bleu_cmd += [reference_file.name]
-    try:
-      bleu_out = subprocess.check_output(bleu_cmd, stdin=read_pred, stderr=subprocess.STDOUT)
-      bleu_out = bleu_out.decode("utf-8")
-      bleu_score = re.search(r"BLEU = (.+?),", bleu_out).group(1)
-      bleu_score = float(bleu_score)
-    except subprocess.CalledProcessError as error:
-      if error.output is not None:
-        tf.logging.warning("multi-bleu.perl script returned non-zero exit code")
-        tf.logging.warning(error.output)
-      bleu_score = np.float32(0.0)
-
-  # Close temp files
-  hypothesis_file.close()
-  reference_file.close()
-
-  return np.float32(bleu_score)
+  return bleu_from_stats(bleu_stats(hypotheses, references, lowercase))
 
 
 def _get_ngrams(n, text):
@@ -817,7 +965,12 @@ def _len_lcs(x, y):
   """
     Returns the length of the Longest Common Subsequence between sequences x
     and y.
-    Source: http://www.algorithmist.com/index.php/Longest_Common_Subsequence
+
+    Uses the bit-parallel form of the LCS dynamic programme: a row of the DP
+    table is encoded in the bits of one integer, over the shorter sequence,
+    and each element of the other sequence updates it with a few integer
+    operations, in O(n) integer operations and O(min(n, m)) memory.
+    Source: Hyyro, Bit-parallel LCS-length computation revisited, 2004
 
     Args:
       x: sequence of words
@@ -826,9 +979,18 @@ def _len_lcs(x, y):
     Returns
       integer: Length of LCS between x and y
     """
-  table = _lcs(x, y)
-  n, m = len(x), len(y)
-  return table[n, m]
+  if len(x) < len(y):
+    x, y = y, x
+  m = len(y)
+  matches = {}
+  for j, word in enumerate(y):
+    matches[word] = matches.get(word, 0) | (1 << j)
+  full = (1 << m) - 1
+  row = full
+  for word in x:
+    u = row & matches.get(word, 0)
+    row = ((row + u) | (row - u)) & full
+  return m - bin(row).count("1")
 
 
 def _lcs(x, y):
@@ -843,19 +1005,21 @@ def _lcs(x, y):
       y: collection of words
 
     Returns:
-      Table of dictionary of coord and len lcs
+      2D array, the lcs length of every pair of prefixes, indexed by coord
     """
   n, m = len(x), len(y)
-  table = dict()
-  for i in range(n + 1):
-    for j in range(m + 1):
-      if i == 0 or j == 0:
-        table[i, j] = 0
-      elif x[i - 1] == y[j - 1]:
-        table[i, j] = table[i - 1, j - 1] + 1
+  table = [[0] * (m + 1)]
+  for i in range(1, n + 1):
+    prev = table[-1]
+    row = [0] * (m + 1)
+    x_i = x[i - 1]
+    for j in range(1, m + 1):
+      if x_i == y[j - 1]:
+        row[j] = prev[j - 1] + 1
       else:
-        table[i, j] = max(table[i - 1, j], table[i, j - 1])
-  return table
+        row[j] = max(prev[j], row[j - 1])
+    table.append(row)
+  return np.array(table)
 
 
 def _recon_lcs(x, y):
@@ -872,20 +1036,34 @@ def _recon_lcs(x, y):
     """
   i, j = len(x), len(y)
   table = _lcs(x, y)
-
-  def _recon(i, j):
-    """private recon calculation."""
-    if i == 0 or j == 0:
-      return []
-    elif x[i - 1] == y[j - 1]:
-      return _recon(i - 1, j - 1) + [(x[i - 1], i)]
+  recon = []
+  while i > 0 and j > 0:
+    if x[i - 1] == y[j - 1]:
+      recon.append(x[i - 1])
+      i -= 1
+      j -= 1
     elif table[i - 1, j] > table[i, j - 1]:
-      return _recon(i - 1, j)
+      i -= 1
     else:
-      return _recon(i, j - 1)
+      j -= 1
+  return tuple(reversed(recon))
 
-  recon_tuple = tuple(map(lambda x: x[0], _recon(i, j)))
-  return recon_tuple
+
+def _f_p_r_ngrams(overlapping_count, evaluated_count, reference_count):
+  """Computes the ROUGE-N F1, precision and recall from n-gram counts."""
+  # Handle edge case. This isn't mathematically correct, but it's good enough
+  if evaluated_count == 0:
+    precision = 0.0
+  else:
+    precision = overlapping_count / evaluated_count
+
+  if reference_count == 0:
+    recall = 0.0
+  else:
+    recall = overlapping_count / reference_count
+
+  f1_score = 2.0 * ((precision * recall) / (precision + recall + 1e-8))
+  return f1_score, precision, recall
 
 
 def rouge_n(evaluated_sentences, reference_sentences, n=2):
@@ -917,21 +1095,8 @@ def rouge_n(evaluated_sentences, reference_sentences, n=2):
   overlapping_ngrams = evaluated_ngrams.intersection(reference_ngrams)
   overlapping_count = len(overlapping_ngrams)
 
-  # Handle edge case. This isn't mathematically correct, but it's good enough
-  if evaluated_count == 0:
-    precision = 0.0
-  else:
-    precision = overlapping_count / evaluated_count
-
-  if reference_count == 0:
-    recall = 0.0
-  else:
-    recall = overlapping_count / reference_count
-
-  f1_score = 2.0 * ((precision * recall) / (precision + recall + 1e-8))
-
   # return overlapping_count / reference_count
-  return f1_score, precision, recall
+  return _f_p_r_ngrams(overlapping_count, evaluated_count, reference_count)
 
 
 def _f_p_r_lcs(llcs, m, n):
@@ -1072,25 +1237,59 @@ def rouge_l_summary_level(evaluated_sentences, reference_sentences):
   return _f_p_r_lcs(union_lcs_sum_across_all_references, m, n)
 
 
-def rouge(hypotheses, references):
+def _rouge_scores(hyp_and_ref):
+  """Returns the ROUGE-1, ROUGE-2 and ROUGE-L (F1, precision, recall) of one
+  hypothesis and reference, computed on integer word ids."""
+  hyp, ref = hyp_and_ref
+  word_ids = {}
+  hyp_ids = [word_ids.setdefault(w, len(word_ids)) for w in hyp.split(" ")]
+  ref_ids = [word_ids.setdefault(w, len(word_ids)) for w in ref.split(" ")]
+  scores = []
+  for n in (1, 2):
+    hyp_ngrams = set(zip(*[hyp_ids[i:] for i in range(n)]))
+    ref_ngrams = set(zip(*[ref_ids[i:] for i in range(n)]))
+    scores.append(
+        _f_p_r_ngrams(len(hyp_ngrams & ref_ngrams), len(hyp_ngrams), len(ref_ngrams)))
+  scores.append(_f_p_r_lcs(_len_lcs(hyp_ids, ref_ids), len(ref_ids), len(hyp_ids)))
+  return scores
+
+
+def rouge(hypotheses, references, processes=0):
   """Calculates average rouge scores for a list of hypotheses and
-  references."""
+  references.
+
+  Args:
+    hypotheses: A list of strings, the hypotheses
+    references: A list of strings, the references
+    processes: number of worker processes to score the pairs on, 0 to score
+      them on the calling process; keep 0 when called from a running
+      `tf.Session`, such as in a `tf.py_func`, as forking it is unsafe
+  """
 
   # Filter out hyps that are of 0 length
   # hyps_and_refs = zip(hypotheses, references)
   # hyps_and_refs = [_ for _ in hyps_and_refs if len(_[0]) > 0]
   # hypotheses, references = zip(*hyps_and_refs)
 
+  hyps_and_refs = list(zip(hypotheses, references))
+  if processes > 0:
+    pool = Pool(processes)
+    try:
+      scores = pool.map(
+          _rouge_scores, hyps_and_refs, chunksize=max(1, len(hyps_and_refs) // (processes * 4)))
+    finally:
+      pool.terminate()
+  else:
+    scores = [_rouge_scores(_) for _ in hyps_and_refs]
+  rouge_1, rouge_2, rouge_l = zip(*scores)
+
   # Calculate ROUGE-1 F1, precision, recall scores
-  rouge_1 = [rouge_n([hyp], [ref], 1) for hyp, ref in zip(hypotheses, references)]
   rouge_1_f, rouge_1_p, rouge_1_r = map(np.mean, zip(*rouge_1))
 
   # Calculate ROUGE-2 F1, precision, recall scores
-  rouge_2 = [rouge_n([hyp], [ref], 2) for hyp, ref in zip(hypotheses, references)]
   rouge_2_f, rouge_2_p, rouge_2_r = map(np.mean, zip(*rouge_2))
 
   # Calculate ROUGE-L F1, precision, recall scores
-  rouge_l = [rouge_l_sentence_level([hyp], [ref]) for hyp, ref in zip(hypotheses, references)]
   rouge_l_f, rouge_l_p, rouge_l_r = map(np.mean, zip(*rouge_l))
 
   return {
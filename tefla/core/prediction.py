@@ -1,11 +1,14 @@
 from __future__ import division, print_function, absolute_import
 
 import abc
+import functools
+import os
 import six
 import time
-from scipy.stats.mstats import gmean
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import tensorflow as tf
+from ..da import data
 from ..da import tta
 from ..utils import util
 
@@ -79,6 +82,52 @@ class OneCropPredictor(PredictSession):
     print('took %6.1f seconds' % (time.time() - tic))
     return data_predictions
 
+  def _real_predict_fused(self, X, augment_fn, n_variants):
+    """Predicts on several augmented versions of every image, decoding each image once.
+
+    All versions of a group of images are fed as one batch of about
+    `batch_size` images and their predictions averaged per image. With a
+    parallel prediction iterator, the next group is augmented by its worker
+    pool while the current one runs through the session.
+
+    Args:
+        X: a list of image filenames
+        augment_fn: picklable function mapping a filename to its
+            (n_variants, w, h, C) augmented versions
+        n_variants: number of versions returned by `augment_fn`
+
+    Returns:
+        predictions averaged over the versions of every image
+    """
+    if not len(X):
+      return np.zeros((0,) + tuple(self.predictions.get_shape().as_list()[1:]), dtype=np.float32)
+    tic = time.time()
+    print('Making %d predictions, %d variants each' % (len(X), n_variants))
+    pool = getattr(self.prediction_iterator, 'pool', None)
+    files_per_batch = max(1, self.prediction_iterator.batch_size // n_variants)
+    chunks = [X[i:i + files_per_batch] for i in range(0, len(X), files_per_batch)]
+
+    def submit(fnames):
+      if pool is not None:
+        return pool.map_async(augment_fn, fnames)
+      return [augment_fn(fname) for fname in fnames]
+
+    def wait(pending):
+      return pending.get() if pool is not None else pending
+
+    data_predictions = []
+    pending = submit(chunks[0])
+    for i, fnames in enumerate(chunks):
+      Xb = np.vstack(wait(pending))
+      if i + 1 < len(chunks):
+        pending = submit(chunks[i + 1])
+      predictions_e = self.sess.run(self.predictions, feed_dict={self.inputs: Xb})
+      predictions_e = predictions_e.reshape((len(fnames), n_variants) + predictions_e.shape[1:])
+      data_predictions.append(predictions_e.mean(axis=1))
+    data_predictions = np.vstack(data_predictions)
+    print('took %6.1f seconds' % (time.time() - tic))
+    return data_predictions
+
 
 class QuasiCropPredictor(PredictSession):
   """Quasi transform predictor.
@@ -90,11 +139,15 @@ class QuasiCropPredictor(PredictSession):
       prediction_iterator: iterator to access and augment the data for prediction
       number_of_transform: number of determinastic augmentaions to be performed on the input data
           resulted predictions are averaged over the augmentated transformation prediction outputs
+      fused: bool, decode every image once and predict all its transforms together,
+          instead of one full pass over the data per transform
       gpu_memory_fraction: fraction of gpu memory to use, if not cpu prediction
   """
 
-  def __init__(self, model, cnf, weights_from, prediction_iterator, number_of_transforms):
+  def __init__(self, model, cnf, weights_from, prediction_iterator, number_of_transforms,
+               fused=False):
     self.number_of_transforms = number_of_transforms
+    self.fused = fused
     self.cnf = cnf
     self.prediction_iterator = prediction_iterator
     self.predictor = OneCropPredictor(model, cnf, weights_from, prediction_iterator)
@@ -108,13 +161,27 @@ class QuasiCropPredictor(PredictSession):
     color_sigma = da_params.get('sigma', 0.0)
     tfs, color_vecs = tta.build_quasirandom_transforms(
         self.number_of_transforms, color_sigma=color_sigma, **self.cnf['aug_params'])
-    multiple_predictions = []
+    if self.fused:
+      it = self.prediction_iterator
+      augment_fn = functools.partial(
+          data.load_augment_tta,
+          preprocessor=it.preprocessor,
+          w=it.w,
+          h=it.h,
+          transforms=tfs,
+          color_vecs=color_vecs,
+          fill_mode=it.fill_mode,
+          fill_mode_cval=it.fill_mode_cval,
+          standardizer=standardizer,
+          image_cache=it.image_cache)
+      return self.predictor._real_predict_fused(X, augment_fn, len(tfs))
+    # running sum, so memory does not grow with the number of transforms
+    total_predictions = 0
     for i, (xform, color_vec) in enumerate(zip(tfs, color_vecs), start=1):
       print('Quasi-random tta iteration: %d' % i)
       standardizer.set_tta_args(color_vec=color_vec)
-      predictions = self.predictor._real_predict(X, xform=xform)
-      multiple_predictions.append(predictions)
-    return np.mean(multiple_predictions, axis=0)
+      total_predictions = total_predictions + self.predictor._real_predict(X, xform=xform)
+    return total_predictions / len(tfs)
 
 
 class TenCropPredictor(PredictSession):
@@ -128,10 +195,14 @@ class TenCropPredictor(PredictSession):
       crop_size: crop size for network input
       im_size: original image size
       number_of_crops: total number of crops to extract from the input image
+      fused: bool, decode every image once and predict all its crops together,
+          instead of one full pass over the data per crop
       gpu_memory_fraction: fraction of gpu memory to use, if not cpu prediction
   """
 
-  def __init__(self, model, cnf, weights_from, prediction_iterator, im_size, crop_size):
+  def __init__(self, model, cnf, weights_from, prediction_iterator, im_size, crop_size,
+               fused=False):
+    self.fused = fused
     self.crop_size = crop_size
     self.im_size = im_size
     self.cnf = cnf
@@ -143,12 +214,186 @@ class TenCropPredictor(PredictSession):
     crop_size = np.array(self.crop_size)
     im_size = np.array(self.im_size)
     bboxs = util.get_bbox_10crop(crop_size, im_size)
-    multiple_predictions = []
+    if self.fused:
+      it = self.prediction_iterator
+      augment_fn = functools.partial(
+          data.load_augment_crops,
+          preprocessor=it.preprocessor,
+          bboxs=bboxs,
+          standardizer=it.standardizer,
+          image_cache=it.image_cache)
+      return self.predictor._real_predict_fused(X, augment_fn, len(bboxs))
+    total_predictions = 0
     for i, bbox in enumerate(bboxs, start=1):
       print('Crop-deterministic iteration: %d' % i)
-      predictions = self.predictor._real_predict(X, crop_bbox=bbox)
-      multiple_predictions.append(predictions)
-    return np.mean(multiple_predictions, axis=0)
+      total_predictions = total_predictions + self.predictor._real_predict(X, crop_bbox=bbox)
+    return total_predictions / len(bboxs)
+
+
+class CSVPredictionWriter(object):
+  """Writes predictions to a csv file, one row per image, as they are made.
+
+  The file has the layout written by `predict.py`: an `image` column with the
+  image names followed by one `score` column per class. Rows are flushed to
+  disk block by block, then the number of completed rows and their byte size
+  are committed to `<path>.rows`; reopening an existing file drops anything
+  written after the last commit and resumes from there.
+
+  Args:
+      path: a string, output csv file
+      names: a list of all image names, in prediction order
+  """
+
+  def __init__(self, path, names):
+    self.path = path
+    self.names = np.asarray(names)
+    self.rows_path = path + '.rows'
+    self.rows_written = 0
+    self.n_columns = None
+    self.size = 0
+    if os.path.exists(path):
+      self._resume()
+    else:
+      self._commit()
+
+  def _resume(self):
+    if not os.path.exists(self.rows_path):
+      raise IOError('%s exists without a %s row counter, remove it to start over' %
+                    (self.path, self.rows_path))
+    with open(self.rows_path) as f:
+      self.rows_written, self.size = [int(v) for v in f.read().split()]
+    if self.rows_written > len(self.names):
+      raise ValueError('%s holds %d rows, more than the %d images to predict' %
+                       (self.path, self.rows_written, len(self.names)))
+    with open(self.path, 'rb+') as f:
+      # drop rows written after the last commit, possibly partial
+      f.truncate(self.size)
+      if not self.size:
+        return
+      header = f.readline().rstrip(b'\n').split(b',')
+      if header[0] != b'image':
+        raise ValueError('%s is not a prediction csv, its header is %r' % (self.path, header))
+      self.n_columns = len(header)
+      if self.rows_written:
+        last_name = _last_line(f, self.size).rsplit(b',', self.n_columns - 1)[0]
+        expected = self.names[self.rows_written - 1]
+        if last_name.decode('utf-8') != expected:
+          raise ValueError('%s row %d is for %s, not %s: the images changed since it was written' %
+                           (self.path, self.rows_written, last_name.decode('utf-8'), expected))
+
+  def _commit(self):
+    tmp_path = self.rows_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write('%d %d' % (self.rows_written, self.size))
+    os.rename(tmp_path, self.rows_path)
+
+  def write(self, predictions):
+    """Appends the rows for the next `len(predictions)` images."""
+    if self.n_columns is not None and self.n_columns != predictions.shape[1] + 1:
+      raise ValueError('%s has %d score columns, predictions have %d' %
+                       (self.path, self.n_columns - 1, predictions.shape[1]))
+    names = self.names[self.rows_written:self.rows_written + len(predictions)]
+    with open(self.path, 'ab') as f:
+      if self.n_columns is None:
+        headers = ['score%d' % (i + 1) for i in range(predictions.shape[1])]
+        np.savetxt(f, np.array([['image'] + headers]), delimiter=",", fmt="%s")
+        self.n_columns = len(headers) + 1
+      np.savetxt(f, np.column_stack([names, predictions]), delimiter=",", fmt="%s")
+      f.flush()
+      os.fsync(f.fileno())
+      self.size = f.tell()
+    self.rows_written += len(predictions)
+    self._commit()
+
+  def close(self):
+    pass
+
+
+def _last_line(f, end, block_size=4096):
+  """Returns the last line of the file `f` ending at `end`, without its newline.
+
+  Reads backwards from `end` block by block, so only the tail of the file is
+  read.
+  """
+  tail = b''
+  pos = end - 1  # skip the newline ending the last line
+  while pos > 0:
+    start = max(pos - block_size, 0)
+    f.seek(start)
+    tail = f.read(pos - start) + tail
+    newline = tail.rfind(b'\n')
+    if newline >= 0:
+      return tail[newline + 1:]
+    pos = start
+  return tail
+
+
+class NpyPredictionWriter(object):
+  """Writes predictions to a memory mapped `.npy` file as they are made.
+
+  The array of shape (n_images, n_classes) is created with the first block;
+  the number of completed rows is kept in `<path>.rows` and the image names
+  in `<path>.names`, so that reopening resumes after the last completed row.
+
+  Args:
+      path: a string, output `.npy` file
+      names: a list of all image names, in prediction order
+  """
+
+  def __init__(self, path, names):
+    self.path = path
+    self.names = list(names)
+    self.rows_path = path + '.rows'
+    self.predictions = None
+    self.rows_written = 0
+    if os.path.exists(path) and os.path.exists(self.rows_path):
+      with open(path + '.names') as f:
+        resumed_names = f.read().splitlines()
+      if resumed_names != self.names:
+        raise ValueError('%s was written for other images, remove it to start over' % path)
+      self.predictions = np.lib.format.open_memmap(path, mode='r+')
+      with open(self.rows_path) as f:
+        self.rows_written = int(f.read())
+
+  def write(self, predictions):
+    """Stores the rows for the next `len(predictions)` images."""
+    if self.predictions is None:
+      self.predictions = np.lib.format.open_memmap(
+          self.path, mode='w+', dtype=np.float32, shape=(len(self.names), predictions.shape[1]))
+      with open(self.path + '.names', 'w') as f:
+        f.write('\n'.join(self.names) + '\n')
+    self.predictions[self.rows_written:self.rows_written + len(predictions)] = predictions
+    self.predictions.flush()
+    self.rows_written += len(predictions)
+    tmp_path = self.rows_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write('%d' % self.rows_written)
+    os.rename(tmp_path, self.rows_path)
+
+  def close(self):
+    self.predictions = None
+
+
+def stream_predictions(predictor, X, writer, block_size=4096):
+  """Predicts `X` block by block, handing every block to `writer` when done.
+
+  Memory use depends on `block_size`, not on the number of images, and
+  prediction resumes after the rows the writer already holds, e.g. after a
+  crash. `X` must be in the same order as when the writer was created.
+
+  Args:
+      predictor: a predictor instance
+      X: a list of image filenames
+      writer: a `CSVPredictionWriter` or `NpyPredictionWriter`
+      block_size: int, number of images predicted per block
+  """
+  if writer.rows_written:
+    print('Resuming predictions after %d of %d images' % (writer.rows_written, len(X)))
+  try:
+    for start in range(writer.rows_written, len(X), block_size):
+      writer.write(predictor.predict(X[start:start + block_size]))
+  finally:
+    writer.close()
 
 
 class EnsemblePredictor(object):
@@ -156,12 +401,31 @@ class EnsemblePredictor(object):
 
   Ensembled predictions from multiples models using ensemble type
 
+  By default every member predictor runs end to end over the inputs. With a
+  `prediction_iterator`, the inputs are loaded and augmented once by that
+  iterator and every batch is fed to the sessions of all members, optionally
+  from one thread per member; the members must then take the same inputs,
+  their own iterators are not used, and test time augmentation predictors,
+  e.g. `QuasiCropPredictor` or `TenCropPredictor`, are rejected, as their
+  augmentations would be skipped.
+
   Args:
       predictors: predictor instances
+      prediction_iterator: an optional iterator shared by all members
+      parallel: bool, run the member sessions from parallel threads, used
+          with `prediction_iterator`
   """
 
-  def __init__(self, predictors):
+  def __init__(self, predictors, prediction_iterator=None, parallel=False):
+    if prediction_iterator is not None:
+      for p in predictors:
+        # tta predictors wrap the one crop predictor holding their session
+        if hasattr(p, 'predictor'):
+          raise ValueError('%s does test time augmentation, which a shared prediction_iterator '
+                           'would skip: ensemble it without prediction_iterator' % p)
     self.predictors = predictors
+    self.prediction_iterator = prediction_iterator
+    self.parallel = parallel
 
   def predict(self, X, ensemble_type='mean'):
     """Returns ensembled predictions for an input or batch of inputs.
@@ -171,18 +435,68 @@ class EnsemblePredictor(object):
         ensemble_type: operation to combine models probabilities
                 available type: ['mean', 'gmean', 'log_mean']
     """
-    multiple_predictions = []
+    if self.prediction_iterator is not None:
+      return self._predict_shared(X, ensemble_type)
+    ensemble = _StreamingEnsemble(ensemble_type)
     for p in self.predictors:
       print('Ensembler - running predictions using: %s' % p)
-      predictions = p.predict(X)
-      multiple_predictions.append(predictions)
-    multiple_predictions = np.array(multiple_predictions, dtype=np.float32)
-    return _ensemble(ensemble_type, multiple_predictions)
-
-
-def _ensemble(en_type, x):
-  return {
-      'mean': np.mean(x, axis=0),
-      'gmean': gmean(x, axis=0),
-      'log_mean': np.mean(np.log(x + (x == 0)), axis=0),
-  }[en_type]
+      ensemble.update(p.predict(X))
+    return ensemble.result()
+
+  def _predict_shared(self, X, ensemble_type):
+    tic = time.time()
+    print('Ensembler - making %d predictions with %d models' % (len(X), len(self.predictors)))
+    members = self.predictors
+
+    def run(member, Xb):
+      return member.sess.run(member.predictions, feed_dict={member.inputs: Xb})
+
+    thread_pool = ThreadPool(len(members)) if self.parallel else None
+    try:
+      data_predictions = []
+      for Xb, _ in self.prediction_iterator(X):
+        if thread_pool is not None:
+          predictions = thread_pool.map(lambda member: run(member, Xb), members)
+        else:
+          predictions = [run(member, Xb) for member in members]
+        ensemble = _StreamingEnsemble(ensemble_type)
+        for predictions_e in predictions:
+          ensemble.update(predictions_e)
+        data_predictions.append(ensemble.result())
+    finally:
+      if thread_pool is not None:
+        thread_pool.close()
+    print('took %6.1f seconds' % (time.time() - tic))
+    return np.vstack(data_predictions)
+
+
+class _StreamingEnsemble(object):
+  """Combines models probabilities, accumulated one model at a time.
+
+  Only running sums of the size of one model's predictions are kept.
+  Available types: `mean`, `gmean` and `log_mean`.
+  """
+
+  def __init__(self, en_type):
+    if en_type not in ('mean', 'gmean', 'log_mean'):
+      raise KeyError(en_type)
+    self.en_type = en_type
+    self.total = None
+    self.count = 0
+
+  def update(self, x):
+    x = np.asarray(x, dtype=np.float32)
+    if self.en_type == 'mean':
+      term = x.astype(np.float64)
+    elif self.en_type == 'gmean':
+      with np.errstate(divide='ignore'):
+        term = np.log(x.astype(np.float64))
+    else:
+      term = np.log(x + (x == 0))
+    self.total = term if self.total is None else self.total + term
+    self.count += 1
+
+  def result(self):
+    if self.en_type == 'gmean':
+      return np.exp(self.total / self.count).astype(np.float32)
+    return (self.total / self.count).astype(np.float32)
@@ -3,6 +3,8 @@ from __future__ import division, print_function, absolute_import
 import abc
 import six
 import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
 from scipy.stats.mstats import gmean
 import numpy as np
 import tensorflow as tf
@@ -225,14 +227,87 @@ class SegmentPredictor(PredictSession):
     return predictions
 
 
+def _crf_refine(args):
+  prob, img, n_classes, n_iters = args
+  prob = dense_crf(prob[np.newaxis], img[np.newaxis], n_classes, n_iters)
+  return np.argmax(prob, axis=3)[0]
+
+
+class _SyncResult(object):
+
+  def __init__(self, value):
+    self.value = value
+
+  def get(self):
+    return self.value
+
+
+class DenseCRFStage(object):
+  """DenseCRF refinement as a separate pipeline stage.
+
+  Refines batches of softmax probabilities with `dense_crf`, returning the
+  refined masks (argmax over classes). With worker processes the masks are
+  returned asynchronously, so the CRF of a batch overlaps with the forward
+  pass of the next one; the workers run until `close`.
+
+  Args:
+      n_classes: number of segmentation classes
+      n_iters: number of iterations of MAP inference
+      workers: number of worker processes, `None` for one per cpu, 0 to
+          refine on the calling process
+  """
+
+  def __init__(self, n_classes, n_iters=10, workers=0):
+    self.n_classes = n_classes
+    self.n_iters = n_iters
+    if workers is None:
+      workers = cpu_count()
+    self.pool = Pool(workers) if workers > 0 else None
+
+  def refine_async(self, probs, imgs):
+    """Starts refining a batch.
+
+    Args:
+        probs: 4D array, per pixel class probabilities, NHWC
+        imgs: 4D array, the uint8 RGB images, NHWC
+
+    Returns:
+        a result whose `get()` returns the list of refined masks
+    """
+    args = [(prob, img, self.n_classes, self.n_iters) for prob, img in zip(probs, imgs)]
+    if self.pool is None:
+      return _SyncResult([_crf_refine(arg) for arg in args])
+    return self.pool.map_async(_crf_refine, args)
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool = None
+
+
 class SegmentPredictor_v2(PredictSession):
   """Segmentation Predictor, it predict mask from an RGB image.
 
+  The softmax is added to the graph once, at construction; the DenseCRF and
+  argmax post-processing run on its outputs in a `DenseCRFStage`, so the
+  graph does not grow with the number of predicted images. With
+  `crf_workers`, the CRF of a batch runs on worker processes while the next
+  batch is predicted; they are stopped by `close`, which is called on exit of
+  a `with` block. Each image is decoded once, and a list of images is
+  predicted `batch_size` images per `sess.run`; images may be given
+  decoded by `load_image`, e.g. on loader threads.
+
   Args:
       graph: `tf.Graph` object, graph with weights and variables
       standardizer: standardizer for the  input data for prediction
       preprocessor: image preprocessor to use
-      gpu_memory_fraction: fraction of gpu memory to use, if not cpu prediction
+      num_classes: number of segmentation classes
+      batch_size: number of images per `sess.run`, the images of a batch must
+          have the same size
+      crf_workers: number of DenseCRF worker processes, `None` for one per
+          cpu, 0 to run the CRF on the calling process; the workers are
+          forked before the session is created
+      crf_iters: number of DenseCRF iterations of MAP inference
   """
 
   def __init__(self,
@@ -241,27 +316,61 @@ class SegmentPredictor_v2(PredictSession):
                preprocessor,
                input_tensor_name='model/inputs/input:0',
                predict_tensor_name='model/final_map_logits/BiasAdd:0',
-               num_classes=17):
+               num_classes=17,
+               batch_size=8,
+               crf_workers=0,
+               crf_iters=10):
     self.standardizer = standardizer
     self.preprocessor = preprocessor
     self.inputs = graph.get_tensor_by_name(input_tensor_name)
     self.predictions = graph.get_tensor_by_name(predict_tensor_name)
     self.num_classes = num_classes
+    self.batch_size = batch_size
+    with graph.as_default():
+      self.probabilities = tf.nn.softmax(self.predictions)
+    # workers are forked before the session starts its threads
+    self.crf = DenseCRFStage(num_classes, crf_iters, crf_workers)
     super(SegmentPredictor_v2, self).__init__(graph)
 
+  def load_image(self, fname):
+    """Decodes an image filename for `predict`; safe to call from threads."""
+    return data.load_image(fname, preprocessor=self.preprocessor)
+
   def _real_predict(self, X, xform=None, crop_bbox=None):
+    """Predicts the masks of an image filename, or a list of filenames or of
+    images decoded by `load_image`.
+
+    Returns:
+        a 3D array, the masks, one per image
+    """
     tic = time.time()
-    img_orig = data.load_image(X, preprocessor=self.preprocessor)
-    img_orig = np.asarray(img_orig.transpose(1, 2, 0), dtype=np.uint8)
-    X = data.load_image(X, preprocessor=self.preprocessor)
-    X = self.standardizer(X, False)
-    X = X.transpose(1, 2, 0)
-    X = np.expand_dims(X, 0)
-    raw_output_up = tf.nn.softmax(self.predictions)
-    raw_output_up = tf.py_func(
-        dense_crf, [raw_output_up, tf.expand_dims(img_orig, axis=0), self.num_classes], tf.float32)
-    raw_output_up = tf.argmax(raw_output_up, dimension=3)
-    predictions = self.sess.run(raw_output_up, {self.inputs: X})
-    predictions = predictions.transpose(0, 2, 1)
+    fnames = [X] if isinstance(X, six.string_types) else X
+    predictions = []
+    pending = None
+    for i in range(0, len(fnames), self.batch_size):
+      imgs_orig, inputs = [], []
+      for fname in fnames[i:i + self.batch_size]:
+        img = self.load_image(fname) if isinstance(fname, six.string_types) else fname
+        # copied to uint8 before the standardizer, which may work in place
+        imgs_orig.append(np.asarray(img.transpose(1, 2, 0), dtype=np.uint8))
+        inputs.append(self.standardizer(img, False).transpose(1, 2, 0))
+      probs = self.sess.run(self.probabilities, {self.inputs: np.stack(inputs)})
+      refined = self.crf.refine_async(probs, imgs_orig)
+      if pending is not None:
+        predictions.extend(pending.get())
+      pending = refined
+    if pending is not None:
+      predictions.extend(pending.get())
+    predictions = np.stack(predictions).transpose(0, 2, 1)
     print('took %6.1f seconds' % (time.time() - tic))
     return predictions
+
+  def close(self):
+    """Stops the DenseCRF worker processes."""
+    self.crf.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
@@ -176,30 +176,67 @@ class Occlusion(SaliencyMask):
   occlusion affects the class score. When the class score decreases,
   this is positive evidence for the class, otherwise it is negative
   evidence.
+
+  Occluded images are evaluated in batches when `batch_y` is given: the
+  output tensor of `y` for every image of a batch, e.g. `logits[:, label]`
+  for `y = logits[0, label]`. Without it they are evaluated one by one,
+  through a callable made once per mask, which skips the feed processing
+  of every `session.run` call.
   """
 
-  def __init__(self, graph, session, y, x):
+  def __init__(self, graph, session, y, x, batch_y=None):
     super(Occlusion, self).__init__(graph, session, y, x)
+    self.batch_y = batch_y
 
-  def GetMask(self, x_value, feed_dict={}, size=15, value=0):
-    """Returns an occlusion mask."""
-    occlusion_window = np.array([size, size, x_value.shape[2]])
-    occlusion_window.fill(value)
-
-    occlusion_scores = np.zeros_like(x_value)
+  def GetMask(self, x_value, feed_dict={}, size=15, value=0, stride=1, batch_size=64):
+    """Returns an occlusion mask.
 
+    Args:
+        x_value: Input value, not batched.
+        feed_dict: (Optional) feed dictionary to pass to the session.run call.
+        size: size of the square occlusion window
+        value: value of the occluded pixels
+        stride: step between two window positions
+        batch_size: number of occluded images per session.run call, used
+            with `batch_y`
+    """
     feed_dict[self.x] = [x_value]
-    original_y_value = self.session.run(self.y, feed_dict=feed_dict)
-
-    for row in range(x_value.shape[0] - size):
-      for col in range(x_value.shape[1] - size):
-        x_occluded = np.array(x_value)
+    original_y_value = np.reshape(self.session.run(self.y, feed_dict=feed_dict), -1)[0]
+
+    rows = np.arange(0, x_value.shape[0] - size, stride)
+    cols = np.arange(0, x_value.shape[1] - size, stride)
+    positions = [(row, col) for row in rows for col in cols]
+    if self.batch_y is None:
+      batch_size = 1
+      feed_list = [self.x] + [key for key in feed_dict if key is not self.x]
+      run_y = self.session.make_callable(self.y, feed_list=feed_list)
+      feed_values = [feed_dict[key] for key in feed_list[1:]]
+    x_occluded = np.empty((min(batch_size, len(positions)),) + x_value.shape, dtype=x_value.dtype)
+    score_diffs = np.zeros(x_value.shape[:2])
+    for start in range(0, len(positions), batch_size):
+      chunk = positions[start:start + batch_size]
+      x_occluded[:len(chunk)] = x_value
+      for x_o, (row, col) in zip(x_occluded, chunk):
+        x_o[row:row + size, col:col + size, :] = value
+      if self.batch_y is None:
+        y_value = np.reshape(run_y(x_occluded[:1], *feed_values), -1)
+      else:
+        feed_dict[self.x] = x_occluded[:len(chunk)]
+        y_value = np.reshape(self.session.run(self.batch_y, feed_dict=feed_dict), -1)
+      chunk = np.array(chunk)
+      score_diffs[chunk[:, 0], chunk[:, 1]] = original_y_value - y_value
+
+    # every window adds its score difference to the pixels it covers: a box sum
+    # of the differences over size x size, computed from the summed area table
+    table = np.zeros((x_value.shape[0] + 1, x_value.shape[1] + 1))
+    table[1:, 1:] = score_diffs.cumsum(0).cumsum(1)
+    top = np.maximum(np.arange(x_value.shape[0]) - size + 1, 0)
+    left = np.maximum(np.arange(x_value.shape[1]) - size + 1, 0)
+    bottom = np.arange(1, x_value.shape[0] + 1)
+    right = np.arange(1, x_value.shape[1] + 1)
+    box_sums = (table[bottom][:, right] - table[top][:, right] - table[bottom][:, left] +
+                table[top][:, left])
 
-        x_occluded[row:row + size, col:col + size, :] = occlusion_window
-
-        feed_dict[self.x] = [x_occluded]
-        y_value = self.session.run(self.y, feed_dict=feed_dict)
-
-        score_diff = original_y_value - y_value
-        occlusion_scores[row:row + size, col:col + size, :] += score_diff
+    occlusion_scores = np.zeros_like(x_value)
+    occlusion_scores += box_sums[:, :, np.newaxis]
     return occlusion_scores
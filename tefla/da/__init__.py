@@ -3,6 +3,9 @@ from __future__ import absolute_import
 from . import data
 from . import data_augmentation
 from . import data_normalization
+from . import dataset_stats
+from . import image_cache
+from . import packed_images
 from . import iterator
 from . import standardizer
 from . import tta
@@ -63,6 +63,134 @@ def fast_warp(img, tf, output_shape, mode='constant', mode_cval=0, order=0):
   return t_img
 
 
+def batch_warp(imgs,
+               tforms,
+               output_shape,
+               mode='constant',
+               mode_cval=0,
+               order=0,
+               channels_last=False):
+  """Warp a batch of images, each according to its own coordinate transformation.
+
+      Nearest-neighbor and bi-linear interpolation are computed for the whole
+  batch at once with numpy; higher orders fall back to `fast_warp` per image.
+  Output matches `fast_warp` applied image by image. Integer images keep
+  their dtype, interpolated values are rounded.
+
+  Args:
+      imgs: `ndarray`, a batch of images, shape (N, C, rows, cols), or
+          (N, rows, cols, C) with `channels_last`
+      tforms: a list of N transformation objects e.g.
+          skimage.transform.SimilarityTransform, or (N, 3, 3) matrices
+      output_shape: tuple, (rows, cols)
+      mode: mode for transformation
+          available modes: {`constant`, `edge`, `symmetric`, `reflect`, `wrap`}
+      mode_cval: float, Used in conjunction with mode `constant`, the value
+          outside the image boundaries
+      order: int, The order of interpolation, 0-5, see `fast_warp`
+      channels_last: bool, images are in (rows, cols, C) layout
+
+  Returns:
+      warped `ndarray`, shape (N, C) + output_shape, or
+      (N,) + output_shape + (C,) with `channels_last`
+  """
+  imgs = np.asarray(imgs)
+  if order not in (0, 1):
+    if channels_last:
+      return np.array([
+          fast_warp(
+              img.transpose(2, 0, 1), tf, output_shape, mode=mode, mode_cval=mode_cval,
+              order=order).transpose(1, 2, 0) for img, tf in zip(imgs, tforms)
+      ])
+    return np.array([
+        fast_warp(img, tf, output_shape, mode=mode, mode_cval=mode_cval, order=order)
+        for img, tf in zip(imgs, tforms)
+    ])
+  if channels_last:
+    n_imgs, rows, cols, n_channels = imgs.shape
+  else:
+    n_imgs, n_channels, rows, cols = imgs.shape
+  matrices = np.array([getattr(tf, 'params', tf) for tf in tforms], dtype=np.float64)
+  out_rows, out_cols = np.mgrid[0:output_shape[0], 0:output_shape[1]]
+  grid = np.vstack([out_cols.ravel(), out_rows.ravel(), np.ones(out_rows.size)])
+  src = np.dot(matrices, grid)
+  c = src[:, 0] / src[:, 2]
+  r = src[:, 1] / src[:, 2]
+
+  if channels_last:
+    flat = imgs.reshape(n_imgs, rows * cols, n_channels)
+    batch_idx = np.arange(n_imgs)[:, np.newaxis]
+
+    def per_pixel(x):
+      return x[:, :, np.newaxis]
+
+    def gather(idx):
+      return flat[batch_idx, idx]
+  else:
+    flat = imgs.reshape(n_imgs, n_channels, rows * cols)
+    batch_idx = np.arange(n_imgs)[:, np.newaxis, np.newaxis]
+    channel_idx = np.arange(n_channels)[np.newaxis, :, np.newaxis]
+
+    def per_pixel(x):
+      return x[:, np.newaxis, :]
+
+    def gather(idx):
+      return flat[batch_idx, channel_idx, per_pixel(idx)]
+
+  def pixels(r_idx, c_idx):
+    if mode == 'constant':
+      outside = (r_idx < 0) | (r_idx >= rows) | (c_idx < 0) | (c_idx >= cols)
+      r_idx = np.clip(r_idx, 0, rows - 1)
+      c_idx = np.clip(c_idx, 0, cols - 1)
+    else:
+      r_idx = _map_coords(r_idx, rows, mode)
+      c_idx = _map_coords(c_idx, cols, mode)
+    values = gather(r_idx * cols + c_idx)
+    if mode == 'constant':
+      values = np.where(per_pixel(outside), mode_cval, values)
+    return values
+
+  if order == 0:
+    # round half away from zero, like the C round used by skimage
+    warped = pixels(
+        np.trunc(r + np.copysign(0.5, r)).astype(np.intp),
+        np.trunc(c + np.copysign(0.5, c)).astype(np.intp))
+  else:
+    min_r = np.floor(r)
+    min_c = np.floor(c)
+    dr = per_pixel(r - min_r)
+    dc = per_pixel(c - min_c)
+    min_r = min_r.astype(np.intp)
+    min_c = min_c.astype(np.intp)
+    max_r = np.ceil(r).astype(np.intp)
+    max_c = np.ceil(c).astype(np.intp)
+    top = (1 - dc) * pixels(min_r, min_c) + dc * pixels(min_r, max_c)
+    bottom = (1 - dc) * pixels(max_r, min_c) + dc * pixels(max_r, max_c)
+    warped = (1 - dr) * top + dr * bottom
+    if np.issubdtype(imgs.dtype, np.integer):
+      warped = np.rint(warped)
+  if channels_last:
+    return warped.reshape((n_imgs,) + tuple(output_shape) + (n_channels,)).astype(imgs.dtype)
+  return warped.reshape((n_imgs, n_channels) + tuple(output_shape)).astype(imgs.dtype)
+
+
+def _map_coords(coords, dim, mode):
+  """Maps out of bounds integer coordinates back into [0, dim) for a fill mode."""
+  if mode == 'edge':
+    return np.clip(coords, 0, dim - 1)
+  elif mode == 'wrap':
+    return np.mod(coords, dim)
+  elif mode == 'symmetric':
+    coords = np.mod(coords, 2 * dim)
+    return np.where(coords >= dim, 2 * dim - 1 - coords, coords)
+  elif mode == 'reflect':
+    if dim == 1:
+      return np.zeros_like(coords)
+    coords = np.mod(coords, 2 * (dim - 1))
+    return np.where(coords >= dim, 2 * (dim - 1) - coords, coords)
+  raise ValueError("Unknown fill mode: %s" % mode)
+
+
 def contrast_transform(img, contrast_min=0.8, contrast_max=1.2):
   """Transform input image contrast.
 
@@ -291,6 +419,24 @@ def random_perturbation_transform(zoom_range,
   return build_augmentation_transform((zoom_x, zoom_y), rotation, shear, translation, flip)
 
 
+def build_warp_transform(image_shape, target_shape, tform_augment):
+  """Full warp transform used by `perturb` and `perturb_fixed`.
+
+  Args:
+      image_shape: tuple(rows, cols), input image shape
+      target_shape: tuple(rows, cols), output image shape
+      tform_augment: augment transform instance, applied around the image center
+
+  Returns:
+      a centered augmentation transform instance
+  """
+  tform_centering = build_centering_transform(image_shape, target_shape)
+  tform_center, tform_uncenter = build_center_uncenter_transforms(image_shape)
+  # shift to center, augment, shift back (for the rotation/shearing)
+  tform_augment = tform_uncenter + tform_augment + tform_center
+  return tform_centering + tform_augment
+
+
 def definite_crop(img, bbox):
   """crop an image.
 
@@ -324,15 +470,10 @@ def perturb(img, augmentation_params, target_shape, rng=np.random, mode='constan
   Returns:
       a `ndarray` of transformed image
   """
-  shape = img.shape[1:]
-  tform_centering = build_centering_transform(shape, target_shape)
-  tform_center, tform_uncenter = build_center_uncenter_transforms(shape)
   tform_augment = random_perturbation_transform(rng=rng, **augmentation_params)
-  # shift to center, augment, shift back (for the rotation/shearing)
-  tform_augment = tform_uncenter + tform_augment + tform_center
   return fast_warp(
       img,
-      tform_centering + tform_augment,
+      build_warp_transform(img.shape[1:], target_shape, tform_augment),
       output_shape=target_shape,
       mode=mode,
       mode_cval=mode_cval)
@@ -392,14 +533,9 @@ def perturb_fixed(img, tform_augment, target_shape=(50, 50), mode='constant', mo
   Returns:
       a `ndarray` of transformed image
   """
-  shape = img.shape[1:]
-  tform_centering = build_centering_transform(shape, target_shape)
-  tform_center, tform_uncenter = build_center_uncenter_transforms(shape)
-  # shift to center, augment, shift back (for the rotation/shearing)
-  tform_augment = tform_uncenter + tform_augment + tform_center
   return fast_warp(
       img,
-      tform_centering + tform_augment,
+      build_warp_transform(img.shape[1:], target_shape, tform_augment),
       output_shape=target_shape,
       mode=mode,
       mode_cval=mode_cval)
@@ -422,10 +558,87 @@ def load_augmented_images(fnames,
                           fill_mode_cval=0,
                           standardizer=None,
                           save_to_dir=None,
-                          cutout=None):
+                          cutout=None,
+                          image_cache=None,
+                          batch_warp=False,
+                          uint8_hwc=False):
+  if batch_warp and bbox is None:
+    return load_augmented_batch(fnames, preprocessor, w, h, is_training, aug_params, transform,
+                                fill_mode, fill_mode_cval, standardizer, save_to_dir, cutout,
+                                image_cache, uint8_hwc)
+  if uint8_hwc:
+    imgs = np.array([
+        load_augment_uint8(f, preprocessor, w, h, aug_params, transform, bbox, fill_mode,
+                           fill_mode_cval, save_to_dir, image_cache) for f in fnames
+    ])
+    return standardize_batch(imgs, is_training, standardizer, cutout)
   return np.array([
       load_augment(f, preprocessor, w, h, is_training, aug_params, transform, bbox, fill_mode,
-                   fill_mode_cval, standardizer, save_to_dir, cutout) for f in fnames
+                   fill_mode_cval, standardizer, save_to_dir, cutout, image_cache) for f in fnames
+  ])
+
+
+def load_augmented_batch(fnames,
+                         preprocessor,
+                         w,
+                         h,
+                         is_training,
+                         aug_params=no_augmentation_params,
+                         transform=None,
+                         fill_mode='constant',
+                         fill_mode_cval=0,
+                         standardizer=None,
+                         save_to_dir=None,
+                         cutout=None,
+                         image_cache=None,
+                         uint8_hwc=False):
+  """Load a batch of augmented images, warping all of them with `batch_warp`.
+
+  Same as `load_augment` for every file, but images of the same input shape
+  are warped together in one vectorized call.
+
+  Args:
+      fnames: a list of image filenames
+      uint8_hwc: bool, warp the source pixels in tf layout, see `load_augment_uint8`
+      see `load_augment` for the other arguments
+
+  Returns:
+      a `ndarray` with the batch of augmented images
+  """
+  if uint8_hwc:
+    imgs = [load_image_hwc(f, preprocessor, image_cache) for f in fnames]
+  else:
+    imgs = [load_image(f, preprocessor, image_cache) for f in fnames]
+  tforms = []
+  for img in imgs:
+    if transform is not None:
+      tform_augment = transform
+    else:
+      tform_augment = random_perturbation_transform(**aug_params)
+    shape = img.shape[:2] if uint8_hwc else img.shape[1:]
+    tforms.append(build_warp_transform(shape, (w, h), tform_augment))
+
+  warped = [None] * len(imgs)
+  shape_groups = {}
+  for i, img in enumerate(imgs):
+    shape_groups.setdefault(img.shape, []).append(i)
+  for indices in shape_groups.values():
+    batch = batch_warp(
+        np.array([imgs[i] for i in indices]), [tforms[i] for i in indices],
+        output_shape=(w, h),
+        mode=fill_mode,
+        mode_cval=fill_mode_cval,
+        channels_last=uint8_hwc)
+    for i, img in zip(indices, batch):
+      warped[i] = img
+
+  if uint8_hwc:
+    for f, img in zip(fnames, warped):
+      save_augmented_image(img.transpose(2, 0, 1), f, save_to_dir)
+    return standardize_batch(np.array(warped), is_training, standardizer, cutout)
+  return np.array([
+      finish_augment(img, f, is_training, standardizer, save_to_dir, cutout)
+      for f, img in zip(fnames, warped)
   ])
 
 
@@ -441,7 +654,8 @@ def load_augment(fname,
                  fill_mode_cval=0,
                  standardizer=None,
                  save_to_dir=None,
-                 cutout=None):
+                 cutout=None,
+                 image_cache=None):
   """Load augmented image with output shape (w, h).
 
   Default arguments return non augmented image of shape (w, h).
@@ -465,11 +679,12 @@ def load_augment(fname,
       standardizer: image standardizer, zero mean, unit variance image
            e.g.: samplewise standardized each image based on its own value
       save_to_dir: a string, path to save image, save output image to a dir
+      image_cache: an optional `ImageCache`, to skip decoding files seen before
 
   Returns:
       augmented image
   """
-  img = load_image(fname, preprocessor)
+  img = load_image(fname, preprocessor, image_cache)
 
   # target shape should be (h, w) i.e. (rows, cols). need to revisit when we
   # do non-square shapes
@@ -493,12 +708,101 @@ def load_augment(fname,
         mode=fill_mode,
         mode_cval=fill_mode_cval)
   # img = brightness_transform(img, brightness_min=0.93, brightness_max=1.4)
+  return finish_augment(img, fname, is_training, standardizer, save_to_dir, cutout)
 
-  if save_to_dir is not None:
-    file_full_name = os.path.basename(fname)
-    file_name, file_ext = os.path.splitext(file_full_name)
-    fname2 = "%s/%s_DA_%d%s" % (save_to_dir, file_name, np.random.randint(1e4), file_ext)
-    save_image(img, fname2)
+
+def load_augment_tta(fname,
+                     preprocessor,
+                     w,
+                     h,
+                     transforms,
+                     color_vecs=None,
+                     fill_mode='constant',
+                     fill_mode_cval=0,
+                     standardizer=None,
+                     image_cache=None):
+  """Load an image once and return all its test time augmented versions.
+
+  Same as calling `load_augment` with each of `transforms` (and the matching
+  color vec set on the standardizer), but the file is decoded only once.
+
+  Args:
+      fname: string, image filename
+      preprocessor: real-time image processing/crop
+      w: int, width of target image
+      h: int, height of target image
+      transforms: a list of transform instances, e.g. from
+          `tta.build_quasirandom_transforms`
+      color_vecs: an optional list of color vecs, one per transform
+      fill_mode: mode for transformation
+          available modes: {`constant`, `edge`, `symmetric`, `reflect`, `wrap`}
+      fill_mode_cval: float, Used in conjunction with mode `constant`,
+          the value outside the image boundaries
+      standardizer: image standardizer
+      image_cache: an optional `ImageCache`, to skip decoding files seen before
+
+  Returns:
+      a `ndarray` of augmented images, shape (len(transforms), w, h, C)
+  """
+  img = load_image(fname, preprocessor, image_cache)
+  imgs = []
+  for i, transform in enumerate(transforms):
+    t_img = perturb_fixed(
+        img, tform_augment=transform, target_shape=(w, h), mode=fill_mode, mode_cval=fill_mode_cval)
+    if standardizer is not None:
+      if color_vecs is not None:
+        standardizer.set_tta_args(color_vec=color_vecs[i])
+      t_img = standardizer(t_img, False)
+    imgs.append(t_img.transpose(1, 2, 0))
+  return np.array(imgs)
+
+
+def load_augment_crops(fname, preprocessor, bboxs, standardizer=None, image_cache=None):
+  """Load an image once and return all its crops.
+
+  Same as calling `load_augment` with each of `bboxs` in prediction mode, but
+  the file is decoded only once and the crops are sliced from it.
+
+  Args:
+      fname: string, image filename
+      preprocessor: real-time image processing/crop
+      bboxs: a list of crop boxes [x, y, width, height, flip], e.g. from
+          `util.get_bbox_10crop`
+      standardizer: image standardizer
+      image_cache: an optional `ImageCache`, to skip decoding files seen before
+
+  Returns:
+      a `ndarray` of crops, shape (len(bboxs), width, height, C)
+  """
+  img = load_image(fname, preprocessor, image_cache)
+  imgs = []
+  for bbox in bboxs:
+    crop = definite_crop(img, bbox)
+    if bbox[4] == 1:
+      crop = crop[:, :, ::-1]
+    # standardizers work in place, keep the decoded image intact
+    crop = np.array(crop)
+    if standardizer is not None:
+      crop = standardizer(crop, False)
+    imgs.append(crop.transpose(1, 2, 0))
+  return np.array(imgs)
+
+
+def finish_augment(img, fname, is_training, standardizer=None, save_to_dir=None, cutout=None):
+  """Last steps of `load_augment`, after the geometric augmentation.
+
+  Args:
+      img: a `ndarray`, warped image, shape (C, rows, cols)
+      fname: string, image filename
+      is_training: bool, if True then training else validation
+      standardizer: image standardizer
+      save_to_dir: a string, path to save image, save output image to a dir
+      cutout: an optional `Cutout` instance
+
+  Returns:
+      augmented image, in tf format
+  """
+  save_augmented_image(img, fname, save_to_dir)
 
   if standardizer is not None:
     img = standardizer(img, is_training)
@@ -510,6 +814,97 @@ def load_augment(fname,
   return img.transpose(1, 2, 0)
 
 
+def save_augmented_image(img, fname, save_to_dir=None):
+  """Save an augmented image (C, rows, cols) to `save_to_dir`, if given."""
+  if save_to_dir is not None:
+    file_full_name = os.path.basename(fname)
+    file_name, file_ext = os.path.splitext(file_full_name)
+    fname2 = "%s/%s_DA_%d%s" % (save_to_dir, file_name, np.random.randint(1e4), file_ext)
+    save_image(img, fname2)
+
+
+def load_augment_uint8(fname,
+                       preprocessor,
+                       w,
+                       h,
+                       aug_params=no_augmentation_params,
+                       transform=None,
+                       bbox=None,
+                       fill_mode='constant',
+                       fill_mode_cval=0,
+                       save_to_dir=None,
+                       image_cache=None):
+  """Load augmented image with output shape (w, h), without converting its pixels.
+
+  Geometric part of `load_augment`, done directly on the decoded pixels
+  (usually uint8) in tf format. Standardization and cutout are left to
+  `standardize_batch`, so the conversion to float happens once per batch.
+  With nearest-neighbor warping the result equals `load_augment` without a
+  standardizer.
+
+  Args:
+      see `load_augment`
+
+  Returns:
+      augmented image, in tf format and the source dtype
+  """
+  img = load_image_hwc(fname, preprocessor, image_cache)
+  if bbox is not None:
+    img = img[bbox[0]:bbox[2], bbox[1]:bbox[3]]
+    if bbox[4] == 1:
+      img = img[:, ::-1]
+  else:
+    if transform is None:
+      transform = random_perturbation_transform(**aug_params)
+    img = batch_warp(
+        img[np.newaxis], [build_warp_transform(img.shape[:2], (w, h), transform)],
+        output_shape=(w, h),
+        mode=fill_mode,
+        mode_cval=fill_mode_cval,
+        channels_last=True)[0]
+  save_augmented_image(img.transpose(2, 0, 1), fname, save_to_dir)
+  return img
+
+
+def standardize_batch(imgs, is_training, standardizer=None, cutout=None):
+  """Standardize a batch of images in tf format, converting it to float32 once.
+
+  Standardizers with a `standardize_batch` method process the whole batch in
+  one call, others are applied image by image.
+
+  Args:
+      imgs: a `ndarray`, batch of images, shape (N, rows, cols, C)
+      is_training: bool, if True then training else validation
+      standardizer: image standardizer
+      cutout: an optional `Cutout` instance
+
+  Returns:
+      a float32 `ndarray`, or `imgs` unchanged if there is nothing to apply,
+      a `NoOpStandardizer` counting as no standardizer
+  """
+  if isinstance(standardizer, NoOpStandardizer):
+    standardizer = None
+  if standardizer is None and cutout is None:
+    return imgs
+  imgs = np.array(imgs, dtype=np.float32)
+  batch_standardizer = getattr(standardizer, 'standardize_batch', None)
+  if batch_standardizer is not None:
+    imgs = batch_standardizer(imgs, is_training)
+    standardizer = None
+  if standardizer is None and cutout is None:
+    return imgs
+  for i in range(len(imgs)):
+    # standardizers and cutout work on channels first views
+    img = imgs[i].transpose(2, 0, 1)
+    if standardizer is not None:
+      img = standardizer(img, is_training)
+    if cutout is not None:
+      if np.random.randint(2) > 0:
+        img = cutout(img)
+    imgs[i] = img.transpose(1, 2, 0)
+  return imgs
+
+
 def image_no_preprocessing(fname):
   """Open Image.
 
@@ -535,18 +930,22 @@ def load_images(imgs, preprocessor=image_no_preprocessing):
   return np.array([load_image(f, preprocessor) for f in imgs])
 
 
-def load_image(img, preprocessor=image_no_preprocessing):
+def load_image(img, preprocessor=image_no_preprocessing, image_cache=None):
   """Load image.
 
   Args:
       img: a image filename
       preprocessor: image processing function
+      image_cache: an optional `ImageCache` holding decoded images
 
   Returns:
       a processed image
   """
   if isinstance(img, string_types):
-    p_img = preprocessor(img)
+    if image_cache is not None:
+      p_img = image_cache.load(img, preprocessor)
+    else:
+      p_img = preprocessor(img)
     return np.array(p_img, dtype=np.float32).transpose(2, 1, 0)
   elif isinstance(img, np.ndarray):
     return preprocessor(img)
@@ -554,6 +953,32 @@ def load_image(img, preprocessor=image_no_preprocessing):
     raise AssertionError("Unknown image type")
 
 
+def load_image_hwc(img, preprocessor=image_no_preprocessing, image_cache=None):
+  """Load image in tf format without converting its pixels.
+
+  Same pixels as `load_image`, laid out (rows, cols, C) and in the dtype
+  returned by the preprocessor; uses views where possible instead of copies.
+
+  Args:
+      img: a image filename
+      preprocessor: image processing function
+      image_cache: an optional `ImageCache` holding decoded images
+
+  Returns:
+      a processed image
+  """
+  if isinstance(img, string_types):
+    if image_cache is not None:
+      p_img = image_cache.load(img, preprocessor)
+    else:
+      p_img = preprocessor(img)
+    return np.asarray(p_img).transpose(1, 0, 2)
+  elif isinstance(img, np.ndarray):
+    return preprocessor(img).transpose(1, 2, 0)
+  else:
+    raise AssertionError("Unknown image type")
+
+
 def save_image(x, fname):
   """Save image.
 
@@ -579,7 +1004,8 @@ def balance_per_class_indices(y, weights):
   """
   y = np.array(y)
   weights = np.array(weights, dtype=float)
-  p = np.zeros(len(y))
-  for i, weight in enumerate(weights):
-    p[y == i] = weight
+  # labels without a weight are never sampled
+  class_p = np.zeros(max(len(weights), y.max() + 1 if len(y) else 0))
+  class_p[:len(weights)] = weights
+  p = class_p[y]
   return np.random.choice(np.arange(len(y)), size=len(y), replace=True, p=np.array(p) / p.sum())
@@ -7,6 +7,10 @@ from __future__ import division, print_function, absolute_import
 import numpy as np
 import pickle
 import tensorflow as tf
+from six import string_types
+
+from . import data
+from . import dataset_stats
 
 _EPSILON = 1e-8
 
@@ -19,12 +23,28 @@ class DataNormalization(object):
   and global mean and std of the dataset.
   It can be use to compute ZCA whitening also.
 
+  Datasets that are not a single ndarray, e.g. a list of image filenames
+  or a memory map, are processed in one streaming pass over chunks of
+  samples, see `dataset_stats`.
+
   Args:
       name: an optional name of the ops
+      global_mean_pc: whether to compute the mean per channel
+      global_std_pc: whether to compute the std per channel
+      processes: number of processes decoding image filenames, `None` for one
+          per cpu
   """
 
-  def __init__(self, name="DataNormalization"):
+  def __init__(self,
+               name="DataNormalization",
+               global_mean_pc=False,
+               global_std_pc=False,
+               processes=None):
     self.session = None
+    self.global_mean_pc = global_mean_pc
+    self.global_std_pc = global_std_pc
+    self.processes = processes
+    self._stats = None
     # Data Persistence
     with tf.name_scope(name) as scope:
       self.scope = scope
@@ -94,16 +114,19 @@ class DataNormalization(object):
     """ZCA wgitening.
 
     Args:
-        image: input image
+        image: input image, or a batch of images (N, H, W, C), whitened
+            with a single matrix product
 
     Returns:
-        ZCA whitened image
+        ZCA whitened image or batch
     """
-    flat = np.reshape(image, image.size)
+    image = np.asarray(image)
+    if image.ndim == 4:
+      flat = np.reshape(image, (image.shape[0], -1))
+    else:
+      flat = np.reshape(image, image.size)
     white = np.dot(flat, self.global_pc.value)
-    s1, s2, s3 = image.shape[0], image.shape[1], image.shape[2]
-    image = np.reshape(white, (s1, s2, s3))
-    return image
+    return np.reshape(white, image.shape)
 
   def normalize_image(self, batch):
     """Normalize image to [0,1] range.
@@ -166,60 +189,124 @@ class DataNormalization(object):
       im_zero_std = image / (im_std + _EPSILON)
     return im_zero_std
 
-  def compute_global_mean(self, dataset, session, limit=None):
+  def compute_global_mean(self,
+                          dataset,
+                          session,
+                          limit=None,
+                          preprocessor=data.image_no_preprocessing):
     """Compute mean of a dataset. A limit can be specified for faster
     computation, considering only 'limit' first elements.
 
     Args:
-        dataset: A `ndarray`, its a ndarray representation of the whole dataset.
+        dataset: A `ndarray`, its a ndarray representation of the whole dataset,
+            or a list of images or image filenames
         session: The session use to perform the computation
         limit: Number of data sample to use, if None, computes on the whole dataset
+        preprocessor: image loading function for image filenames, returning
+            a HWC image
 
     Returns:
         global dataset mean
     """
     _dataset = dataset
-    mean = 0.
     if isinstance(limit, int):
       _dataset = _dataset[:limit]
     if isinstance(_dataset, np.ndarray) and not self.global_mean_pc:
       mean = np.mean(_dataset)
     else:
-      # Iterate in case of non numpy data
-      for i in range(len(dataset)):
-        if not self.global_mean_pc:
-          mean += np.mean(dataset[i]) / len(dataset)
-        else:
-          mean += (np.mean(dataset[i], axis=(0, 1), keepdims=True) / len(dataset))[0][0]
+      stats = self.channel_stats(dataset, limit, preprocessor)
+      if self.global_mean_pc:
+        mean = stats.mean
+      else:
+        mean = dataset_stats.global_mean_std(stats)[0]
     self.global_mean.assign(mean, session)
     return mean
 
-  def compute_global_std(self, dataset, session, limit=None):
+  def compute_global_std(self,
+                         dataset,
+                         session,
+                         limit=None,
+                         preprocessor=data.image_no_preprocessing):
     """ Compute std of a dataset. A limit can be specified for faster
         computation, considering only 'limit' first elements.
         Args:
-            dataset: A `ndarray`, its a ndarray representation of the whole dataset.
+            dataset: A `ndarray`, its a ndarray representation of the whole dataset,
+                or a list of images or image filenames
             session: The session use to perform the computation
             limit: Number of data sample to use, if None, computes on the whole dataset
+            preprocessor: image loading function for image filenames, returning
+                a HWC image
 
         Returns:
             global dataset std
         """
     _dataset = dataset
-    std = 0.
     if isinstance(limit, int):
       _dataset = _dataset[:limit]
     if isinstance(_dataset, np.ndarray) and not self.global_std_pc:
       std = np.std(_dataset)
     else:
-      for i in range(len(dataset)):
-        if not self.global_std_pc:
-          std += np.std(dataset[i]) / len(dataset)
-        else:
-          std += (np.std(dataset[i], axis=(0, 1), keepdims=True) / len(dataset))[0][0]
+      stats = self.channel_stats(dataset, limit, preprocessor)
+      if self.global_std_pc:
+        std = stats.std
+      else:
+        std = dataset_stats.global_mean_std(stats)[1]
     self.global_std.assign(std, session)
     return std
 
+  def compute_global_pc(self,
+                        dataset,
+                        session,
+                        limit=None,
+                        preprocessor=data.image_no_preprocessing):
+    """Compute the ZCA whitening matrix of a dataset. A limit can be specified
+    for faster computation, considering only 'limit' first elements.
+
+    Args:
+        dataset: A `ndarray`, its a ndarray representation of the whole dataset,
+            or a list of images or image filenames
+        session: The session use to perform the computation
+        limit: Number of data sample to use, if None, computes on the whole dataset
+        preprocessor: image loading function for image filenames, returning
+            a HWC image
+
+    Returns:
+        global dataset ZCA matrix, (D, D) for images of D values
+    """
+    stats = dataset_stats.sample_stats(
+        dataset, preprocessor, processes=self.processes, limit=limit)
+    eigvals, u = np.linalg.eigh(stats.cov)
+    pc = np.dot(u * (1. / np.sqrt(np.maximum(eigvals, 0) + _EPSILON)), u.T)
+    self.global_pc.assign(pc, session)
+    return pc
+
+  def channel_stats(self, dataset, limit=None, preprocessor=data.image_no_preprocessing):
+    """Per channel statistics of a dataset.
+
+    The statistics of a list of image filenames are computed once for mean
+    and std, keyed on the list object, its length, `limit` and
+    `preprocessor`; arrays and lists of images, whose content can change in
+    place, are read again.
+
+    Args:
+        dataset: A `ndarray`, a list of images or image filenames
+        limit: Number of data sample to use, if None, computes on the whole dataset
+        preprocessor: image loading function for image filenames, returning
+            a HWC image
+
+    Returns:
+        a `dataset_stats.RunningStats`
+    """
+    key = None
+    if len(dataset) and isinstance(dataset[0], string_types):
+      # the dataset is kept with the stats, so that its id is not reused
+      key = (id(dataset), len(dataset), limit, preprocessor)
+    if key is None or self._stats is None or self._stats[1] != key:
+      stats = dataset_stats.channel_stats(
+          dataset, preprocessor, processes=self.processes, limit=limit)
+      self._stats = (dataset, key, stats)
+    return self._stats[2]
+
   class PersistentParameter:
     """Create a persistent variable that will be stored into the Graph."""
 
@@ -0,0 +1,185 @@
+"""Streaming dataset statistics.
+
+Computes exact mean, std and covariance of a dataset in one pass over
+chunks of samples, merging the partial moments of each chunk with the
+pairwise update of Chan et al., so the dataset is never loaded whole and
+chunks can be processed on a pool of worker processes.
+"""
+from __future__ import division, print_function, absolute_import
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+
+import numpy as np
+from six import string_types
+
+from . import data
+
+
+class RunningStats(object):
+  """Running mean and co-moments of vectors.
+
+  Args:
+      dim: int, size of the vectors, e.g. 3 for RGB pixels
+  """
+
+  def __init__(self, dim):
+    self.n = 0
+    self.mean = np.zeros(dim, dtype=np.float64)
+    self.m2 = np.zeros((dim, dim), dtype=np.float64)
+
+  def update(self, x):
+    """Adds a batch of vectors.
+
+    Args:
+        x: a 2D array, (num vectors, dim)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if not len(x):
+      return self
+    other = RunningStats(x.shape[1])
+    other.n = len(x)
+    other.mean = x.mean(axis=0)
+    centered = x - other.mean
+    other.m2 = np.dot(centered.T, centered)
+    return self.merge(other)
+
+  def merge(self, other):
+    """Adds the vectors counted by another `RunningStats`."""
+    if not other.n:
+      return self
+    n = self.n + other.n
+    delta = other.mean - self.mean
+    self.m2 = self.m2 + other.m2 + np.outer(delta, delta) * (self.n * other.n / n)
+    self.mean = self.mean + delta * (other.n / n)
+    self.n = n
+    return self
+
+  @property
+  def cov(self):
+    """Population covariance matrix."""
+    return self.m2 / max(self.n, 1)
+
+  @property
+  def std(self):
+    """Population standard deviation of each component."""
+    return np.sqrt(np.diag(self.cov))
+
+  def pca(self, standardized=True):
+    """Principal components of the covariance.
+
+    Args:
+        standardized: whether to decompose the covariance of the
+            standardized vectors (the correlation matrix)
+
+    Returns:
+        a tuple, (u, ev): the eigenvectors as columns and the square roots of
+        the eigenvalues, largest first; e.g. the `u` and `ev` of an
+        `AggregateStandardizer`
+    """
+    cov = self.cov
+    if standardized:
+      std = self.std
+      cov = cov / np.outer(std, std)
+    eigvals, u = np.linalg.eigh(cov)
+    order = np.argsort(eigvals)[::-1]
+    return u[:, order], np.sqrt(np.maximum(eigvals[order], 0))
+
+
+def _channel_stats(images, stats=None):
+  for img in images:
+    img = np.asarray(img)
+    pixels = img.reshape(-1, img.shape[-1]) if img.ndim > 2 else img.reshape(-1, 1)
+    if stats is None:
+      stats = RunningStats(pixels.shape[1])
+    stats.update(pixels)
+  return stats
+
+
+def _flat_stats(images, stats=None):
+  flat = np.asarray(images, dtype=np.float64).reshape(len(images), -1)
+  if stats is None:
+    stats = RunningStats(flat.shape[1])
+  return stats.update(flat)
+
+
+def _chunk_stats(args):
+  fnames, preprocessor, per_sample = args
+  images = [preprocessor(fname) for fname in fnames]
+  if per_sample:
+    return _flat_stats(images)
+  return _channel_stats(images)
+
+
+def _merged(partials):
+  stats = None
+  for partial in partials:
+    if partial is None:
+      continue
+    if stats is None:
+      stats = partial
+    else:
+      stats.merge(partial)
+  return stats
+
+
+def _compute_stats(dataset, per_sample, preprocessor, processes, chunk_size, limit):
+  if isinstance(limit, int):
+    dataset = dataset[:limit]
+  chunks = range(0, len(dataset), chunk_size)
+  if not len(dataset) or not isinstance(dataset[0], string_types):
+    # arrays, memory maps and lists of images are read chunk by chunk in this process
+    fn = _flat_stats if per_sample else _channel_stats
+    return _merged(fn(dataset[i:i + chunk_size]) for i in chunks)
+  args = [(dataset[i:i + chunk_size], preprocessor, per_sample) for i in chunks]
+  pool = Pool(processes or cpu_count())
+  try:
+    return _merged(pool.imap_unordered(_chunk_stats, args))
+  finally:
+    pool.terminate()
+
+
+def channel_stats(dataset,
+                  preprocessor=data.image_no_preprocessing,
+                  processes=None,
+                  chunk_size=64,
+                  limit=None):
+  """Per channel pixel statistics of a dataset, in one pass.
+
+  Args:
+      dataset: a NHWC `ndarray`, memory map or list of images, read in
+          chunks in this process, or a list of image filenames, decoded with `preprocessor`
+          on a pool of worker processes, e.g. the `names` of a `PackedImages`
+          with the `PackedImages` as preprocessor
+      preprocessor: image loading function, returning a HWC image
+      processes: number of worker processes, `None` for one per cpu
+      chunk_size: number of images per chunk
+      limit: number of samples to use, `None` for the whole dataset
+
+  Returns:
+      a `RunningStats` over the pixels, with a component per channel
+  """
+  return _compute_stats(dataset, False, preprocessor, processes, chunk_size, limit)
+
+
+def sample_stats(dataset,
+                 preprocessor=data.image_no_preprocessing,
+                 processes=None,
+                 chunk_size=64,
+                 limit=None):
+  """Statistics of the flattened samples of a dataset, in one pass.
+
+  The covariance is (D, D) for samples of D values, e.g. for ZCA whitening.
+  Takes the same arguments as `channel_stats`.
+
+  Returns:
+      a `RunningStats` over the samples, with a component per value
+  """
+  return _compute_stats(dataset, True, preprocessor, processes, chunk_size, limit)
+
+
+def global_mean_std(stats):
+  """Mean and std over all the components of per channel `stats`."""
+  mean = stats.mean.mean()
+  var = (np.diag(stats.cov) + (stats.mean - mean)**2).mean()
+  return mean, np.sqrt(var)
@@ -0,0 +1,258 @@
+"""Decoded image cache.
+
+Keeps decoded images around between epochs so that augmentation runs on
+cached pixels instead of decoding every file again.
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import copy
+import shutil
+import hashlib
+import tempfile
+import functools
+import types
+from collections import OrderedDict
+from uuid import uuid4
+
+import numpy as np
+
+# per process cache stores, keyed by cache id; worker processes build their own
+_stores = {}
+
+
+class ImageCache(object):
+  """Bounded LRU cache of decoded images.
+
+  Images are cached as returned by the preprocessor (usually uint8, HWC), so
+  the preprocessor must be deterministic. Entries are keyed by the filename,
+  the size and modification time of the file and the preprocessor with its
+  arguments, so that a changed file or preprocessor misses the cache. A
+  preprocessor is named by its module and name, or by its `repr` for a
+  callable object; a callable object without a `__repr__` of its own is only
+  matched within this run and process. The cache object itself is only a
+  handle: the cached pixels live in a per process store, which makes it cheap
+  to pass to the workers of a `ParallelDAIterator`.
+
+  A RAM store is private to its process, so pool workers would not hit the
+  images decoded by the others and would each end up holding the whole
+  dataset; `ParallelDAIterator` therefore swaps a RAM cache for a disk cache
+  in shared memory, see `shared`.
+
+  With `cache_dir` set, decoded images are written there as `.npy` files and
+  read back memory mapped; the files are read by all processes and reused
+  across runs. Each process only evicts the files it wrote, within an even
+  share of `max_bytes` between `processes`; files of earlier runs are
+  trimmed to `max_bytes`, oldest first, when the cache is created. A disk
+  cache thus takes at most twice `max_bytes`. Otherwise images are kept in
+  RAM.
+
+  Args:
+      max_bytes: int, maximum size of the cached pixels per process in RAM,
+          or of the `.npy` files written in this run on disk
+          e.g.: 4 * 1024**3
+      cache_dir: a string, directory for a disk backed cache, `None` to
+          cache in RAM
+      processes: int, number of processes filling a disk cache;
+          `ParallelDAIterator` sets it to the size of its worker pool
+  """
+
+  def __init__(self, max_bytes, cache_dir=None, processes=1):
+    self.max_bytes = max_bytes
+    self.cache_dir = cache_dir
+    self.processes = processes
+    self.id = str(uuid4())
+    self.temporary = False
+    if cache_dir is not None:
+      if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+      self._trim(cache_dir, max_bytes)
+
+  def load(self, fname, preprocessor):
+    """Returns the decoded image for `fname`, decoding it on a miss.
+
+    Args:
+        fname: a string, image filename
+        preprocessor: image processing function, used on a cache miss
+
+    Returns:
+        a `ndarray`, the decoded image
+    """
+    store = self._store()
+    key = self.key(fname, preprocessor)
+    img = store.get(key)
+    if img is None:
+      img = np.asarray(preprocessor(fname))
+      img = store.put(key, img)
+    return img
+
+  def key(self, fname, preprocessor):
+    """Returns the cache key of `fname` decoded by `preprocessor`."""
+    try:
+      stat = os.stat(fname)
+      version = '%d:%r' % (stat.st_size, stat.st_mtime)
+    except OSError:
+      version = ''
+    return '%s|%s|%s' % (fname, version, self._preprocessor_name(preprocessor))
+
+  def _preprocessor_name(self, preprocessor):
+    if isinstance(preprocessor, functools.partial):
+      return '%s(*%r, **%r)' % (self._preprocessor_name(preprocessor.func), preprocessor.args,
+                                sorted((preprocessor.keywords or {}).items()))
+    if isinstance(preprocessor, (types.FunctionType, types.BuiltinFunctionType)):
+      name = getattr(preprocessor, '__qualname__', preprocessor.__name__)
+      if '<' not in name:
+        return '%s.%s' % (preprocessor.__module__, name)
+    elif type(preprocessor).__repr__ is not object.__repr__:
+      return repr(preprocessor)
+    # lambdas, closures and objects named by their address
+    return '%r@%s:%d' % (preprocessor, self.id, os.getpid())
+
+  def clear(self):
+    """Drops all entries cached by this process."""
+    store = _stores.pop(self.id, None)
+    if store is not None:
+      store.clear()
+
+  def shared(self, processes):
+    """Returns a cache that `processes` processes can fill and read together.
+
+    A disk cache is returned as a copy whose budget is shared between
+    `processes`. A RAM cache is swapped for a disk cache of the same size in
+    a new directory under `/dev/shm` (the temp directory where there is
+    none), whose files are read by all the processes; the directory is
+    deleted by `remove`.
+
+    Args:
+        processes: int, number of processes using the cache
+
+    Returns:
+        an `ImageCache`
+    """
+    if self.cache_dir is not None:
+      cache = copy.copy(self)
+      cache.processes = processes
+      cache.id = str(uuid4())
+      return cache
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    cache = ImageCache(
+        self.max_bytes, tempfile.mkdtemp(prefix='tefla-image-cache-', dir=shm_dir), processes)
+    cache.temporary = True
+    return cache
+
+  def remove(self):
+    """Deletes the cache directory made by `shared`; a no-op for other caches."""
+    self.clear()
+    if self.temporary:
+      shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+  def _store(self):
+    store = _stores.get(self.id)
+    if store is None:
+      if self.cache_dir is None:
+        store = _MemoryStore(self.max_bytes)
+      else:
+        store = _DiskStore(self.max_bytes // self.processes, self.cache_dir)
+      _stores[self.id] = store
+    return store
+
+  @staticmethod
+  def _trim(cache_dir, max_bytes):
+    """Removes the oldest files left in `cache_dir` until they fit in `max_bytes`."""
+    files = []
+    for fname in os.listdir(cache_dir):
+      if not fname.endswith('.npy'):
+        continue
+      path = os.path.join(cache_dir, fname)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        # removed by another process
+        continue
+      files.append((stat.st_mtime, stat.st_size, path))
+    nbytes = 0
+    for _, size, path in sorted(files, reverse=True):
+      nbytes += size
+      if nbytes > max_bytes:
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+
+
+class _MemoryStore(object):
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self.entries = OrderedDict()
+
+  def get(self, key):
+    img = self.entries.pop(key, None)
+    if img is not None:
+      self.entries[key] = img
+    return img
+
+  def put(self, key, img):
+    if img.nbytes > self.max_bytes:
+      return img
+    self.entries[key] = img
+    self.nbytes += img.nbytes
+    while self.nbytes > self.max_bytes:
+      _, evicted = self.entries.popitem(last=False)
+      self.nbytes -= evicted.nbytes
+    return img
+
+  def clear(self):
+    self.entries.clear()
+    self.nbytes = 0
+
+
+class _DiskStore(object):
+  """Reads all the files of `cache_dir`; tracks and evicts only those it wrote."""
+
+  def __init__(self, max_bytes, cache_dir):
+    self.max_bytes = max_bytes
+    self.cache_dir = cache_dir
+    self.nbytes = 0
+    self.entries = OrderedDict()
+
+  def path(self, key):
+    return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+  def get(self, key):
+    path = self.path(key)
+    try:
+      img = np.load(path, mmap_mode='r')
+    except (IOError, OSError, ValueError):
+      # missing, evicted by another process or partially written
+      return None
+    if path in self.entries:
+      self.entries[path] = self.entries.pop(path)
+    return img
+
+  def put(self, key, img):
+    path = self.path(key)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      np.save(f, img)
+      nbytes = f.tell()
+    os.rename(tmp_path, path)
+    self.nbytes -= self.entries.pop(path, 0)
+    self.entries[path] = nbytes
+    self.nbytes += nbytes
+    self._evict()
+    return img
+
+  def _evict(self):
+    while self.nbytes > self.max_bytes and self.entries:
+      path, nbytes = self.entries.popitem(last=False)
+      self.nbytes -= nbytes
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+  def clear(self):
+    self.entries.clear()
+    self.nbytes = 0
@@ -5,6 +5,7 @@ import SharedArray
 import multiprocessing
 import os
 import threading
+from collections import deque
 from uuid import uuid4
 import numpy as np
 
@@ -25,34 +26,59 @@ class BatchIterator(object):
     self.shuffle = shuffle
 
   def __call__(self, X, y=None):
-    if self.shuffle:
-      index_array = np.random.permutation(len(X))
-      self.X = X[index_array]
-      self.y = y[index_array] if y is not None else y
-    else:
-      self.X, self.y = X, y
+    self.X, self.y = X, y
+    # batches are gathered through the permutation, X and y are never copied whole
+    self.index_array = np.random.permutation(len(X)) if self.shuffle else None
     return self
 
   def __iter__(self):
+    return self.transform_batches(self.batches())
+
+  def batches(self):
+    """Yields the untransformed (Xb, yb) slices of the current epoch."""
+    for index in self.index_batches():
+      Xb = self.X[index]
+      if self.y is not None:
+        yb = self.y[index]
+      else:
+        yb = None
+      yield Xb, yb
+
+  def index_batches(self):
+    """Yields the indices of the samples of each batch, slices or index arrays."""
     n_samples = self.X.shape[0]
     bs = self.batch_size
     for i in range((n_samples + bs - 1) // bs):
       sl = slice(i * bs, (i + 1) * bs)
-      Xb = self.X[sl]
-      if self.y is not None:
-        yb = self.y[sl]
+      if self.index_array is not None:
+        yield self.index_array[sl]
       else:
-        yb = None
+        yield sl
+
+  def transform_batches(self, batches):
+    for Xb, yb in batches:
       yield self.transform(Xb, yb)
 
   def transform(self, Xb, yb):
     return Xb, yb
 
+  def close(self):
+    """Releases the resources of the iterator, if any."""
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
   def __getstate__(self):
     state = dict(self.__dict__)
     for attr in (
         'X',
         'y',
+        'index_array',
+        'sampler',
     ):
       if attr in state:
         del state[attr]
@@ -61,24 +87,55 @@ class BatchIterator(object):
 
 class QueuedMixin(object):
 
+  def queue_batch(self, Xb, yb):
+    """Prepares a batch for the queue; copies it by default."""
+    return np.array(Xb), np.array(yb)
+
+  def release_batch(self):
+    """Called once the consumer is done with the oldest yielded batch."""
+    pass
+
   def __iter__(self):
     queue = Queue.Queue(maxsize=20)
     end_marker = object()
+    stop = threading.Event()
+    errors = []
 
     def producer():
-      for Xb, yb in super(QueuedMixin, self).__iter__():
-        queue.put((np.array(Xb), np.array(yb)))
-      queue.put(end_marker)
+      batches = super(QueuedMixin, self).__iter__()
+      try:
+        for Xb, yb in batches:
+          queue.put(self.queue_batch(Xb, yb))
+          if stop.is_set():
+            break
+      except Exception as e:
+        errors.append(e)
+      finally:
+        # lets the batches still in flight finish
+        batches.close()
+        queue.put(end_marker)
 
     thread = threading.Thread(target=producer)
     thread.daemon = True
     thread.start()
 
     item = queue.get()
-    while item is not end_marker:
-      yield item
-      queue.task_done()
-      item = queue.get()
+    try:
+      while item is not end_marker:
+        yield item
+        self.release_batch()
+        queue.task_done()
+        item = queue.get()
+    finally:
+      if item is not end_marker:
+        # the epoch was abandoned; stop the producer and release the batches it queued
+        stop.set()
+        while item is not end_marker:
+          self.release_batch()
+          item = queue.get()
+      thread.join()
+    if errors:
+      raise errors[0]
 
 
 class QueuedIterator(QueuedMixin, BatchIterator):
@@ -103,7 +160,10 @@ class DAIterator(BatchIterator):
                fill_mode_cval=0,
                standardizer=None,
                save_to_dir=None,
-               cutout=None):
+               cutout=None,
+               image_cache=None,
+               batch_warp=False,
+               uint8_hwc=False):
     self.preprocessor = preprocessor if preprocessor else data.image_no_preprocessing
     self.w = crop_size[0]
     self.h = crop_size[1]
@@ -113,6 +173,9 @@ class DAIterator(BatchIterator):
     self.fill_mode_cval = fill_mode_cval
     self.standardizer = standardizer
     self.cutout = cutout
+    self.image_cache = image_cache
+    self.batch_warp = batch_warp
+    self.uint8_hwc = uint8_hwc
     self.save_to_dir = save_to_dir
     if save_to_dir and not os.path.exists(save_to_dir):
       os.makedirs(save_to_dir)
@@ -128,7 +191,8 @@ class DAIterator(BatchIterator):
         'fill_mode_cval': self.fill_mode_cval,
         'standardizer': self.standardizer,
         'save_to_dir': self.save_to_dir,
-        'cutout': self.cutout
+        'cutout': self.cutout,
+        'image_cache': self.image_cache
     }
     if self.crop_bbox is not None:
       assert not self.is_training, "crop bbox only in validation/prediction mode"
@@ -142,8 +206,26 @@ class DAIterator(BatchIterator):
 
   def transform(self, Xb, yb):
     fnames, labels = Xb, yb
-    Xb = data.load_augmented_images(fnames, **self.da_args())
-    return Xb, labels
+    da_args = self.da_args()
+    if self.batch_standardized():
+      da_args.update(standardizer=None, cutout=None)
+    Xb = data.load_augmented_images(
+        fnames, batch_warp=self.batch_warp, uint8_hwc=self.uint8_hwc, **da_args)
+    return self.standardize(Xb), labels
+
+  def batch_standardized(self):
+    """Whether standardizer and cutout run once per batch, in `standardize`.
+
+    True with `uint8_hwc`, or with a standardizer that has a
+    `standardize_batch` method; otherwise they run image by image while the
+    images are loaded.
+    """
+    return self.uint8_hwc or hasattr(self.standardizer, 'standardize_batch')
+
+  def standardize(self, Xb):
+    if not self.batch_standardized():
+      return Xb
+    return data.standardize_batch(Xb, self.is_training, self.standardizer, self.cutout)
 
 
 class QueuedDAIterator(QueuedMixin, DAIterator):
@@ -162,10 +244,77 @@ def load_shared(args):
     pool_process_seed = os.getpid()
     # print("random seed: %d in pid %d" % (pool_process_seed, os.getpid()))
     np.random.seed(pool_process_seed)
-  array[i] = data.load_augment(fname, **kwargs)
+  array[i] = augment(fname, kwargs)
+
+
+def augment(fname, kwargs):
+  """Runs `data.load_augment`, or `data.load_augment_uint8` if `uint8_hwc` is set."""
+  if kwargs.get('uint8_hwc'):
+    kwargs = dict(kwargs)
+    for key in ('uint8_hwc', 'is_training', 'standardizer', 'cutout'):
+      del kwargs[key]
+    img = data.load_augment_uint8(fname, **kwargs)
+    # the shared arrays are uint8, other pixels would be truncated
+    if img.dtype != np.uint8:
+      raise TypeError('uint8_hwc needs uint8 images from the preprocessor, got %s' % img.dtype)
+    return img
+  return data.load_augment(fname, **kwargs)
+
+
+attached_slots = {}
+
+
+def load_shared_slot(args):
+  """Like `load_shared`, but keeps the slot attached for the life of the worker."""
+  i, array_name, fname, kwargs = args
+  array = attached_slots.get(array_name)
+  if array is None:
+    array = attached_slots[array_name] = SharedArray.attach(array_name)
+  global pool_process_seed
+  if not pool_process_seed:
+    pool_process_seed = os.getpid()
+    np.random.seed(pool_process_seed)
+  array[i] = augment(fname, kwargs)
 
 
 class ParallelDAIterator(QueuedDAIterator):
+  """Data augmentation iterator backed by a process pool.
+
+  By default every batch is written to a freshly created shared array which is
+  copied out and deleted. With `shared_slots` set, that many batch sized shared
+  arrays are allocated once and reused as a ring buffer: workers write into a
+  free slot and the batch is handed out without a copy. A yielded batch then
+  stays valid only until the next batch is requested from the iterator, so
+  consumers that keep batches around must copy them.
+
+  With `prefetch_batches` set, that many batches beyond the one being handed
+  out are submitted to the pool ahead of time and collected in order, so
+  decoding and augmentation overlap with the consumer.
+
+  The worker pool and the shared slots live until `close`, which is called
+  on exit of a `with` block or when the iterator is garbage collected.
+  Starting a new epoch stops the previous one if it was not run to the end.
+
+  With `uint8_hwc` set, workers warp the decoded uint8 pixels in tf format
+  into uint8 shared arrays, raising a `TypeError` if the preprocessor returns
+  pixels of another dtype; standardizer and cutout then run once per batch
+  in `data.standardize_batch`. Without a standardizer (a `NoOpStandardizer`
+  counts as none) and without cutout, batches stay uint8.
+  Standardizers with a `standardize_batch` method also run once per batch,
+  in this process, on the float32 batch written by the workers.
+
+  An `image_cache` caching in RAM is replaced by a disk cache of the same
+  size under `/dev/shm` (see `ImageCache.shared`), so that every worker hits
+  the images decoded by the others; its directory is deleted on `close`.
+
+  Args:
+      shared_slots: int, number of preallocated shared memory batch slots,
+          `None` to allocate a new shared array per batch.
+      prefetch_batches: int, number of batches kept in flight ahead of the
+          current one, `None` to process one batch at a time. When used with
+          `shared_slots` it is capped at `shared_slots - 1`.
+      uint8_hwc: bool, keep images uint8 until the whole batch is standardized.
+  """
 
   def __init__(self,
                batch_size,
@@ -178,37 +327,179 @@ class ParallelDAIterator(QueuedDAIterator):
                fill_mode_cval=0,
                standardizer=None,
                save_to_dir=None,
-               cutout=None):
-    self.pool = multiprocessing.Pool()
-    super(ParallelDAIterator,
-          self).__init__(batch_size, shuffle, preprocessor, crop_size, is_training, aug_params,
-                         fill_mode, fill_mode_cval, standardizer, save_to_dir, cutout)
+               cutout=None,
+               shared_slots=None,
+               prefetch_batches=None,
+               image_cache=None,
+               uint8_hwc=False):
+    self.slot_names = []
+    self.slots = []
+    self.active_epoch = None
+    processes = multiprocessing.cpu_count()
+    self.pool = multiprocessing.Pool(processes)
+    self.prefetch_batches = prefetch_batches
+    if image_cache is not None:
+      image_cache = image_cache.shared(processes)
+    super(ParallelDAIterator, self).__init__(
+        batch_size,
+        shuffle,
+        preprocessor,
+        crop_size,
+        is_training,
+        aug_params,
+        fill_mode,
+        fill_mode_cval,
+        standardizer,
+        save_to_dir,
+        cutout,
+        image_cache=image_cache,
+        uint8_hwc=uint8_hwc)
+    self.dtype = np.uint8 if uint8_hwc else np.float32
+    if shared_slots:
+      prefix = str(uuid4())
+      for i in range(shared_slots):
+        name = '%s-%d' % (prefix, i)
+        self.slots.append(
+            SharedArray.create(name, [batch_size, self.w, self.h, 3], dtype=self.dtype))
+        self.slot_names.append(name)
+
+  def __iter__(self):
+    # an epoch that was not run to the end may still be writing to the slots
+    self.end_epoch()
+    if self.slots:
+      # slots are handed out in order, so the oldest busy slot is always the one released
+      self.free_slots = Queue.Queue()
+      self.busy_slots = Queue.Queue()
+      for i in range(len(self.slots)):
+        self.free_slots.put(i)
+    self.active_epoch = super(ParallelDAIterator, self).__iter__()
+    return self.active_epoch
+
+  def end_epoch(self):
+    """Stops the current epoch, waiting for the batches in flight; a no-op once it is done."""
+    epoch, self.active_epoch = self.active_epoch, None
+    if epoch is not None:
+      epoch.close()
+
+  def queue_batch(self, Xb, yb):
+    if not self.slots:
+      return super(ParallelDAIterator, self).queue_batch(Xb, yb)
+    return Xb, np.array(yb)
+
+  def release_batch(self):
+    if self.slots:
+      self.free_slots.put(self.busy_slots.get())
+
+  def transform_batches(self, batches):
+    if not self.prefetch_batches:
+      for item in super(ParallelDAIterator, self).transform_batches(batches):
+        yield item
+      return
+    depth = self.prefetch_batches
+    if self.slots:
+      # every pending batch holds a slot; keep one for the consumer
+      depth = max(min(depth, len(self.slots) - 1), 0)
+    pending = deque()
+    try:
+      for Xb, yb in batches:
+        pending.append(self.transform_async(Xb, yb))
+        if len(pending) > depth:
+          yield self.collect(pending.popleft())
+      while pending:
+        yield self.collect(pending.popleft())
+    finally:
+      for item in pending:
+        self.discard(item)
 
   def transform(self, Xb, yb):
+    return self.collect(self.transform_async(Xb, yb))
+
+  def transform_async(self, Xb, yb):
+    """Submits a batch to the worker pool without waiting for it.
+
+    Returns:
+        a pending batch, to be passed to `collect`
+    """
+    da_args = self.da_args()
+    if self.uint8_hwc:
+      da_args['uint8_hwc'] = True
+    if self.batch_standardized():
+      da_args.update(standardizer=None, cutout=None)
+    if self.slots:
+      slot = self.free_slots.get()
+      self.busy_slots.put(slot)
+      args = [(i, self.slot_names[slot], fname, da_args) for i, fname in enumerate(Xb)]
+      return slot, len(Xb), self.pool.map_async(load_shared_slot, args), yb
+
     shared_array_name = str(uuid4())
+    shared_array = SharedArray.create(
+        shared_array_name, [len(Xb), self.w, self.h, 3], dtype=self.dtype)
+    args = [(i, shared_array_name, fname, da_args) for i, fname in enumerate(Xb)]
     try:
-      shared_array = SharedArray.create(
-          shared_array_name, [len(Xb), self.w, self.h, 3], dtype=np.float32)
+      result = self.pool.map_async(load_shared, args)
+    except Exception:
+      SharedArray.delete(shared_array_name)
+      raise
+    return shared_array_name, shared_array, result, yb
 
-      fnames, labels = Xb, yb
-      args = []
-      da_args = self.da_args()
-      for i, fname in enumerate(fnames):
-        args.append((i, shared_array_name, fname, da_args))
+  def collect(self, pending):
+    """Waits for a batch submitted with `transform_async`.
 
-      self.pool.map(load_shared, args)
-      Xb = np.array(shared_array, dtype=np.float32)
+    Returns:
+        a tuple, (augmented images, labels)
+    """
+    if self.slots:
+      slot, n_samples, result, labels = pending
+      result.get()
+      return self.standardize(self.slots[slot][:n_samples]), labels
 
+    shared_array_name, shared_array, result, labels = pending
+    try:
+      result.get()
+      Xb = self.standardize(shared_array)
+      if Xb is shared_array:
+        Xb = np.array(shared_array)
     finally:
       SharedArray.delete(shared_array_name)
-
     return Xb, labels
 
+  def discard(self, pending):
+    """Waits for a batch submitted with `transform_async` that will not be collected."""
+    pending[2].wait()
+    if not self.slots:
+      SharedArray.delete(pending[0])
+
+  def close(self):
+    """Releases the shared memory slots and the worker pool; safe to call more than once."""
+    self.end_epoch()
+    pool = getattr(self, 'pool', None)
+    if pool is not None:
+      pool.terminate()
+    for name in self.slot_names:
+      SharedArray.delete(name)
+    self.slot_names = []
+    self.slots = []
+    image_cache = getattr(self, 'image_cache', None)
+    if image_cache is not None:
+      image_cache.remove()
+
+  def __del__(self):
+    self.close()
+
+
+def balance_class_weights(balance_ratio, count, balance_weights, final_balance_weights):
+  """Returns the class weights of epoch `count` of the balancing schedule.
+
+  The weights decay geometrically, by `balance_ratio` per epoch, from
+  `balance_weights` towards `final_balance_weights`.
+  """
+  alpha = balance_ratio**count
+  return balance_weights * alpha + final_balance_weights * (1 - alpha)
+
 
 def balance_data(X, y, balance_ratio, count, balance_weights, final_balance_weights):
-  alpha = balance_ratio**count
-  class_weights = balance_weights * alpha + \
-      final_balance_weights * (1 - alpha)
+  class_weights = balance_class_weights(balance_ratio, count, balance_weights,
+                                        final_balance_weights)
   count += 1
   indices = data.balance_per_class_indices(y, weights=class_weights)
   X = X[indices]
@@ -216,7 +507,97 @@ def balance_data(X, y, balance_ratio, count, balance_weights, final_balance_weig
   return X, y, count
 
 
-class BalancingDAIterator(ParallelDAIterator):
+class BalancedSampler(object):
+  """Samples indices with replacement, with per class sampling weights.
+
+  A sample of class `c` is drawn with probability proportional to
+  `class_weights[c]`, as with `data.balance_per_class_indices`. The class of
+  each draw is picked in constant time from an alias table (Vose's method)
+  over the classes, then a sample uniformly within that class, so sampling
+  costs O(n) for n draws and needs no per sample probability array.
+
+  Args:
+      y: a 1D int array, class labels
+      class_weights: a 1D array, sampling weight per class; labels without a
+          weight are never sampled
+  """
+
+  def __init__(self, y, class_weights):
+    y = np.asarray(y)
+    class_weights = np.asarray(class_weights, dtype=np.float64)
+    self.counts = np.bincount(y, minlength=len(class_weights))
+    weights = np.zeros(len(self.counts))
+    weights[:len(class_weights)] = class_weights
+    class_p = weights * self.counts
+    if class_p.sum() <= 0:
+      raise ValueError('class weights select no sample')
+    # sample indices grouped by class
+    self.order = np.argsort(y, kind='mergesort')
+    self.starts = np.cumsum(self.counts) - self.counts
+    self.prob, self.alias = self.alias_table(class_p / class_p.sum())
+
+  @staticmethod
+  def alias_table(p):
+    """Returns the (probability, alias) tables of the distribution `p`."""
+    n = len(p)
+    scaled = p * n
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+      s, l = small.pop(), large.pop()
+      prob[s] = scaled[s]
+      alias[s] = l
+      scaled[l] -= 1.0 - scaled[s]
+      if scaled[l] < 1.0:
+        small.append(l)
+      else:
+        large.append(l)
+    # leftovers are 1 up to rounding errors, unless they are never drawn
+    never = p == 0
+    prob[never] = 0.0
+    alias[never] = np.argmax(p)
+    return prob, alias
+
+  def sample(self, n):
+    """Returns `n` sample indices, drawn with replacement."""
+    classes = np.random.randint(len(self.prob), size=n)
+    classes = np.where(np.random.random_sample(n) < self.prob[classes], classes,
+                       self.alias[classes])
+    offsets = (np.random.random_sample(n) * self.counts[classes]).astype(np.int64)
+    return self.order[self.starts[classes] + offsets]
+
+  def batches(self, batch_size, n_samples):
+    """Yields index arrays of `n_samples` draws, `batch_size` at a time."""
+    for i in range(0, n_samples, batch_size):
+      yield self.sample(min(batch_size, n_samples - i))
+
+
+class BalancingMixin(object):
+  """Samples the training epochs with a `BalancedSampler`.
+
+  Each call with labels advances the `balance_ratio` schedule by one epoch;
+  batches are then drawn lazily from the sampler, as many samples as in `X`,
+  instead of resampling copies of `X` and `y`.
+  """
+
+  def __call__(self, X, y=None, *args, **kwargs):
+    self.sampler = None
+    if y is not None:
+      class_weights = balance_class_weights(self.balance_ratio, self.count, self.balance_weights,
+                                            self.final_balance_weights)
+      self.count += 1
+      self.sampler = BalancedSampler(y, class_weights)
+    return super(BalancingMixin, self).__call__(X, y, *args, **kwargs)
+
+  def index_batches(self):
+    if self.sampler is None:
+      return super(BalancingMixin, self).index_batches()
+    return self.sampler.batches(self.batch_size, len(self.X))
+
+
+class BalancingDAIterator(BalancingMixin, ParallelDAIterator):
 
   def __init__(self,
                batch_size,
@@ -233,24 +614,22 @@ class BalancingDAIterator(ParallelDAIterator):
                fill_mode_cval=0,
                standardizer=None,
                save_to_dir=None,
-               cutout=None):
+               cutout=None,
+               shared_slots=None,
+               prefetch_batches=None,
+               image_cache=None,
+               uint8_hwc=False):
     self.count = balance_epoch_count
     self.balance_weights = balance_weights
     self.final_balance_weights = final_balance_weights
     self.balance_ratio = balance_ratio
     super(BalancingDAIterator,
           self).__init__(batch_size, shuffle, preprocessor, crop_size, is_training, aug_params,
-                         fill_mode, fill_mode_cval, standardizer, save_to_dir, cutout)
-
-  def __call__(self, X, y=None):
-    if y is not None:
-      X, y, self.count = balance_data(X, y, self.balance_ratio, self.count, self.balance_weights,
-                                      self.final_balance_weights)
-    return super(BalancingDAIterator, self).__call__(X, y)
+                         fill_mode, fill_mode_cval, standardizer, save_to_dir, cutout,
+                         shared_slots, prefetch_batches, image_cache, uint8_hwc)
 
 
-# TODO(n3011) remove code duplication with BalancingDAIterator (call method)
-class BalancingQueuedDAIterator(QueuedDAIterator):
+class BalancingQueuedDAIterator(BalancingMixin, QueuedDAIterator):
 
   def __init__(self,
                batch_size,
@@ -267,17 +646,15 @@ class BalancingQueuedDAIterator(QueuedDAIterator):
                fill_mode_cval=0,
                standardizer=None,
                save_to_dir=None,
-               cutout=None):
+               cutout=None,
+               image_cache=None,
+               batch_warp=False,
+               uint8_hwc=False):
     self.count = balance_epoch_count
     self.balance_weights = balance_weights
     self.final_balance_weights = final_balance_weights
     self.balance_ratio = balance_ratio
     super(BalancingQueuedDAIterator,
           self).__init__(batch_size, shuffle, preprocessor, crop_size, is_training, aug_params,
-                         fill_mode, fill_mode_cval, standardizer, save_to_dir, cutout)
-
-  def __call__(self, X, y=None):
-    if y is not None:
-      X, y, self.count = balance_data(X, y, self.balance_ratio, self.count, self.balance_weights,
-                                      self.final_balance_weights)
-    return super(BalancingQueuedDAIterator, self).__call__(X, y)
+                         fill_mode, fill_mode_cval, standardizer, save_to_dir, cutout,
+                         image_cache, batch_warp, uint8_hwc)
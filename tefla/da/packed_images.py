@@ -0,0 +1,141 @@
+"""Packed image dataset.
+
+Stores a dataset of decoded, pre-resized uint8 images as one large binary
+blob plus an index of offsets, shapes and labels, so that images are read
+from a memory map instead of opening one file per sample.
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
+
+import numpy as np
+
+from . import data
+
+
+def _decode(args):
+  fname, preprocessor = args
+  return np.atleast_3d(np.asarray(preprocessor(fname), dtype=np.uint8))
+
+
+def pack_images(fnames, path, labels=None, preprocessor=data.image_no_preprocessing,
+                processes=None):
+  """Decodes images and writes them as a packed dataset.
+
+  Writes the pixels to `path` and the index to `path + '.index.npz'`. The
+  images are decoded on a pool of worker processes and written in order.
+
+  Args:
+      fnames: a list of image filenames
+      path: a string, the packed dataset file
+      labels: an optional array of labels, one per image
+      preprocessor: image processing function, applied before packing, must
+          return an uint8 image, HWC
+      processes: number of decoding processes, `None` for one per cpu
+
+  Returns:
+      a `PackedImages` reading the written dataset
+  """
+  # drop a reader opened on an earlier version of this file
+  _stores.pop(path, None)
+  offsets = np.zeros(len(fnames), dtype=np.int64)
+  shapes = np.zeros((len(fnames), 3), dtype=np.int64)
+  offset = 0
+  pool = Pool(processes or cpu_count())
+  try:
+    with open(path, 'wb') as f:
+      imgs = pool.imap(_decode, [(fname, preprocessor) for fname in fnames], chunksize=16)
+      for i, img in enumerate(imgs):
+        f.write(np.ascontiguousarray(img).tobytes())
+        offsets[i] = offset
+        shapes[i] = img.shape
+        offset += img.nbytes
+  finally:
+    pool.terminate()
+  if labels is None:
+    labels = np.zeros(len(fnames), dtype=np.int32)
+  np.savez(
+      path + '.index.npz',
+      names=np.asarray(fnames),
+      offsets=offsets,
+      shapes=shapes,
+      labels=np.asarray(labels))
+  return PackedImages(path)
+
+
+# per process readers, keyed by path; worker processes open their own
+_stores = {}
+
+
+class PackedImages(object):
+  """Reader of a packed dataset written by `pack_images`.
+
+  An instance is also an image preprocessor: called with one of its image
+  names, e.g. as the `preprocessor` of a `DAIterator` iterating over `names`,
+  it returns that image as an uint8 HWC view of the memory mapped pixels,
+  without any file system access beyond the page faults. The object itself
+  is only a handle holding the path: the index and the memory map live in a
+  per process store, which makes it cheap to pass to the workers of a
+  `ParallelDAIterator`, each opening the files on first use.
+
+  Args:
+      path: a string, the packed dataset file
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  @property
+  def names(self):
+    return self._store().names
+
+  @property
+  def labels(self):
+    return self._store().labels
+
+  def __len__(self):
+    return len(self._store().names)
+
+  def __getitem__(self, i):
+    """Returns the image at index `i`."""
+    return self._store().image(i)
+
+  def __call__(self, fname):
+    """Returns the image named `fname`."""
+    store = self._store()
+    return store.image(store.positions[fname])
+
+  def _store(self):
+    store = _stores.get(self.path)
+    if store is None:
+      store = _PackedStore(self.path)
+      _stores[self.path] = store
+    return store
+
+
+class _PackedStore(object):
+
+  def __init__(self, path):
+    index = np.load(path + '.index.npz')
+    self.names = index['names']
+    self.labels = index['labels']
+    self.offsets = index['offsets']
+    self.shapes = index['shapes']
+    self.positions = dict((name, i) for i, name in enumerate(self.names))
+    if os.path.getsize(path):
+      self.blob = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+      # a zero length file can not be memory mapped
+      self.blob = np.zeros(0, dtype=np.uint8)
+
+  def image(self, i):
+    shape = self.shapes[i]
+    offset = self.offsets[i]
+    return self.blob[offset:offset + shape.prod()].reshape(shape)
+
+
+def is_packed(path):
+  """Returns whether `path` is a packed dataset."""
+  return os.path.exists(path + '.index.npz')
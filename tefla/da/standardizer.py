@@ -25,6 +25,9 @@ class NoOpStandardizer(NoDAMixin):
   def __call__(self, img, is_training):
     return img
 
+  def standardize_batch(self, imgs, is_training):
+    return imgs
+
 
 class ScalingStandardizer(NoDAMixin):
   """Scaling Standardizer.
@@ -41,6 +44,11 @@ class ScalingStandardizer(NoDAMixin):
   def __call__(self, img, is_training):
     return img * self.scale
 
+  def standardize_batch(self, imgs, is_training):
+    """Standardizes a float32 batch (N, rows, cols, C) in place."""
+    imgs *= self.scale
+    return imgs
+
 
 class SamplewiseStandardizer(NoDAMixin):
   """Samplewise Standardizer.
@@ -71,6 +79,17 @@ class SamplewiseStandardizer(NoDAMixin):
     np.clip(img, -self.clip, self.clip, out=img)
     return img
 
+  def standardize_batch(self, imgs, is_training):
+    """Standardizes a float32 batch (N, rows, cols, C) in place."""
+    axis = (1, 2) if self.channel_wise else (1, 2, 3)
+    imgs_mean = imgs.mean(axis=axis, keepdims=True)
+    imgs_std = imgs.std(axis=axis, keepdims=True)
+    imgs -= imgs_mean
+    imgs_std += 1e-4
+    imgs /= imgs_std
+    np.clip(imgs, -self.clip, self.clip, out=imgs)
+    return imgs
+
 
 class SamplewiseStandardizerTF(NoDAMixin):
   """Samplewise Standardizer.
@@ -121,6 +140,20 @@ class AggregateStandardizer(object):
     self.sigma = sigma
     self.color_vec = color_vec
 
+  @classmethod
+  def from_stats(cls, stats, sigma=0.0, color_vec=None):
+    """Creates a standardizer from dataset statistics.
+
+    Args:
+        stats: a `RunningStats` of the dataset pixels, per channel,
+            e.g.: from `dataset_stats.channel_stats(training_files)`
+        sigma: float, noise factor
+        color_vec: an optional color vector
+    """
+    u, ev = stats.pca(standardized=True)
+    mean, std, u, ev = [np.asarray(a, dtype=np.float32) for a in (stats.mean, stats.std, u, ev)]
+    return cls(mean, std, u, ev, sigma=sigma, color_vec=color_vec)
+
   def da_processing_params(self):
     return {'sigma': self.sigma}
 
@@ -155,6 +188,91 @@ class AggregateStandardizer(object):
     noise = np.dot(self.u, alpha.T)
     return img + noise[:, np.newaxis, np.newaxis]
 
+  def standardize_batch(self, imgs, is_training):
+    """Standardizes a float32 batch (N, rows, cols, C) in place.
+
+    Same as calling the standardizer on every image: the color noise of the
+    images is drawn in the same order, and computed with one matrix product.
+    """
+    imgs -= self.mean
+    imgs /= self.std
+    if is_training:
+      if not self.sigma > 0.0:
+        return imgs
+      color_vecs = np.random.normal(0.0, self.sigma, (len(imgs), 3))
+    else:
+      color_vec = self.color_vec
+      if color_vec is None:
+        return imgs
+      color_vecs = np.asarray(color_vec)[np.newaxis]
+    noise = np.dot(color_vecs.astype(np.float32) * self.ev, np.transpose(self.u))
+    imgs += noise[:, np.newaxis, np.newaxis, :].astype(np.float32)
+    return imgs
+
+
+class ZCAStandardizer(NoDAMixin):
+  """ZCA whitening Standardizer.
+
+  Whitens flattened images, (rows, cols, C) in tf format, with the principal
+  components of the training set: x -> (x - mean) W with the symmetric
+  W = u diag(1 / sqrt(eigvals + epsilon)) u^T. With `rank` set, only the
+  largest `rank` components are kept: W is never formed and a batch costs two
+  (N, D) x (D, rank) products instead of a (D, D) projection.
+
+  Args:
+      mean: 1-D array, mean of the flattened images, size D
+      u: 2-D array, (D, K), principal components as columns, largest first
+      eigvals: 1-D array, the K eigenvalues of the components
+      rank: int, number of components to keep, `None` for all of them
+      epsilon: float, added to the eigenvalues
+  """
+
+  def __init__(self, mean, u, eigvals, rank=None, epsilon=1e-5):
+    u = np.asarray(u, dtype=np.float32)
+    eigvals = np.asarray(eigvals, dtype=np.float64)
+    if rank is not None:
+      u = u[:, :rank]
+      eigvals = eigvals[:rank]
+    self.mean = np.asarray(mean, dtype=np.float32).reshape(-1)
+    self.scale = (1. / np.sqrt(np.maximum(eigvals, 0) + epsilon)).astype(np.float32)
+    if u.shape[1] < u.shape[0]:
+      self.u = u
+      self.w = None
+    else:
+      self.u = None
+      self.w = np.dot(u * self.scale, u.T)
+    super(ZCAStandardizer, self).__init__()
+
+  @classmethod
+  def from_stats(cls, stats, rank=None, epsilon=1e-5):
+    """Creates a standardizer from dataset statistics.
+
+    Args:
+        stats: a `RunningStats` of the flattened images,
+            e.g.: from `dataset_stats.sample_stats(training_files)`
+        rank: int, number of components to keep, `None` for all of them
+        epsilon: float, added to the eigenvalues
+    """
+    eigvals, u = np.linalg.eigh(stats.cov)
+    order = np.argsort(eigvals)[::-1]
+    return cls(stats.mean, u[:, order], eigvals[order], rank=rank, epsilon=epsilon)
+
+  def __call__(self, img, is_training):
+    white = self.standardize_batch(np.array(img.transpose(1, 2, 0)[np.newaxis]), is_training)
+    return white[0].transpose(2, 0, 1)
+
+  def standardize_batch(self, imgs, is_training):
+    """Whitens a float32 batch (N, rows, cols, C)."""
+    flat = imgs.reshape(len(imgs), -1)
+    flat -= self.mean
+    if self.w is not None:
+      white = np.dot(flat, self.w)
+    else:
+      proj = np.dot(flat, self.u)
+      proj *= self.scale
+      white = np.dot(proj, self.u.T)
+    return white.reshape(imgs.shape)
+
 
 class AggregateStandardizerTF(object):
   """Aggregate Standardizer.
@@ -11,5 +11,6 @@ from . import textdataflow
 from . import textdecoder
 from . import textdataset
 from . import texttfrecords
+from . import tfrecord_index
 from . import tokenizer
 from . import vocabulary
@@ -13,6 +13,8 @@ import os
 import math
 import tensorflow as tf
 
+from . import tfrecord_index
+
 
 @six.add_metaclass(abc.ABCMeta)
 class Dataset(object):
@@ -79,13 +81,25 @@ class Dataset(object):
         ValueError: if there are not data_files matching the subset.
     """
     try:
-      data_files = [f for f in os.listdir(self.data_dir)]
+      # skip the record indexes, manifests and unfinished shards of the writer
+      data_files = [
+          f for f in os.listdir(self.data_dir)
+          if not f.endswith((tfrecord_index.INDEX_SUFFIX, '.manifest.json', '.tmp'))
+      ]
       data_files = [os.path.join(self.data_dir, f) for f in data_files]
       # return np.array(sorted(data_files))
       return data_files
     except Exception:
       raise ValueError('No files found for dataset %s at %s' % (self.name, self.data_dir))
 
+  def indexed_records(self, build_missing=True):
+    """Returns an `IndexedTFRecords` for random access to the data files.
+
+    Args:
+        build_missing: whether to build missing indexes by scanning the files
+    """
+    return tfrecord_index.IndexedTFRecords(sorted(self.data_files()), build_missing=build_missing)
+
   @property
   def reader_class(self):
     """Return a reader for a single entry from the data set.
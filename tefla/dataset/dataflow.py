@@ -3,6 +3,7 @@
 # Contact: mrinal.haloi11@gmail.com
 # Copyright 2016, Mrinal Haloi
 # -------------------------------------------------------------------#
+import numpy as np
 import tensorflow as tf
 from .reader import Reader
 from ..core import logger as log
@@ -206,3 +207,158 @@ class Dataflow(object):
     tf.train.queue_runner.add_queue_runner(
         tf.train.queue_runner.QueueRunner(prefetch_queue, [enqueue_op]))
     return prefetch_queue
+
+
+class TFDataflow(Dataflow):
+  """Dataflow built on `tf.data` instead of queue runners.
+
+  Same interface as `Dataflow`. Records are read by interleaving the shards
+  in parallel, decoded and preprocessed by a parallel map fused with the
+  batching, and prefetched. With `global_shuffle` set, records are read in
+  a new global permutation every epoch through the shard offset indexes
+  (see `tfrecord_index`), instead of shuffling through a buffer of
+  `min_queue_examples` records.
+
+  The balanced sampling of `get_batch` still resamples the batches with
+  `stratified_sample`, as its target probabilities are fed at every step;
+  that stage alone keeps a queue runner.
+
+  Args:
+      dataset: an instance of the dataset class
+      num_readers: num of shards read in parallel, or of records with
+          `global_shuffle`
+      shuffle: a bool, shuffle the dataset
+      num_epochs: total number of epoch for training or validation, `None`
+          to repeat forever
+      min_queue_examples: size of the shuffle buffer, in records
+      capacity: unused, kept for compatibility with `Dataflow`
+      prefetch_batches: number of batches prepared ahead of the consumer
+      global_shuffle: a bool, read the records in a global random order
+          every epoch; the shards must have offset indexes
+      seed: random seed of the global shuffle
+  """
+
+  def __init__(self,
+               dataset,
+               num_readers=1,
+               shuffle=True,
+               num_epochs=None,
+               min_queue_examples=1024,
+               capacity=2048,
+               prefetch_batches=2,
+               global_shuffle=False,
+               seed=0):
+    self.min_queue_examples = min_queue_examples
+    self.num_readers = num_readers
+    self.shuffle = shuffle
+    self.num_epochs = num_epochs
+    self.dataset = dataset
+    self.prefetch_batches = prefetch_batches
+    self.global_shuffle = global_shuffle
+    self.seed = seed
+
+  def records(self):
+    """Returns a `tf.data.Dataset` of the serialized records."""
+    if self.shuffle and self.global_shuffle:
+      return self._permuted_records()
+    data_files = sorted(self.dataset.data_files())
+    files = tf.data.Dataset.from_tensor_slices(data_files)
+    if self.shuffle:
+      files = files.shuffle(len(data_files))
+    records = files.apply(
+        tf.contrib.data.parallel_interleave(
+            tf.data.TFRecordDataset, cycle_length=self.num_readers, sloppy=self.shuffle))
+    if self.shuffle:
+      records = records.shuffle(self.min_queue_examples)
+    return records.repeat(self.num_epochs)
+
+  def _permuted_records(self):
+    try:
+      indexed_records = self.dataset.indexed_records(build_missing=False)
+    except IOError as e:
+      raise IOError('global_shuffle reads the records through the shard offset indexes: %s. '
+                    'Write the shards with `image_to_tfrecords`, or index them with '
+                    '`tfrecord_index.build_index`.' % e)
+    seed = self.seed
+
+    def permutation(epoch):
+      return indexed_records.permutation(epoch, seed=seed).astype(np.int64)
+
+    def read(i):
+      record = tf.py_func(lambda i: indexed_records[i], [i], tf.string, stateful=False)
+      record.set_shape([])
+      return record
+
+    num_epochs = self.num_epochs if self.num_epochs is not None else np.iinfo(np.int64).max
+    indices = tf.data.Dataset.range(num_epochs).flat_map(
+        lambda epoch: tf.data.Dataset.from_tensor_slices(
+            tf.py_func(permutation, [epoch], tf.int64, stateful=False)))
+    # pread releases the GIL, so the reads of parallel calls overlap
+    return indices.map(read, num_parallel_calls=self.num_readers)
+
+  def get(self, items, image_size, resize_size=None):
+    """Get a single example from the dataset.
+
+    Args:
+        items: a list, with items to get from the dataset
+            e.g.: ['image', 'label']
+        image_size: a list with original image size
+            e.g.: [width, height, channel]
+        resize_size: if image resize required, provide a list of width and height
+            e.g.: [width, height]
+    """
+    data = self.records().prefetch(self.min_queue_examples).make_one_shot_iterator().get_next()
+    outputs = self.dataset.decoder.decode(data, image_size, resize_size=resize_size)
+    self._validate_items(items, outputs.keys())
+    return [outputs[item] for item in items]
+
+  def batch_inputs(self,
+                   batch_size,
+                   train,
+                   tfrecords_image_size,
+                   crop_size,
+                   im_size=None,
+                   bbox=None,
+                   image_preprocessing=None,
+                   num_preprocess_threads=16):
+    """Contruct batches of training or evaluation examples from the image
+    dataset.
+
+    Args:
+        batch_size: integer
+        train: boolean
+        crop_size: training time image size. a int or tuple
+        tfrecords_image_size: a list with original image size used to encode image in tfrecords
+            e.g.: [width, height, channel]
+        image_processing: a function to process image
+        num_preprocess_threads: integer, number of images decoded and
+            preprocessed in parallel
+
+    Returns:
+        images: 4-D float Tensor of a batch of images
+        labels: 1-D integer Tensor of [batch_size].
+    """
+    if isinstance(crop_size, int):
+      crop_size = (crop_size, crop_size)
+
+    def parse(example_serialized):
+      outputs = self.dataset.decoder.decode(
+          example_serialized, tfrecords_image_size, resize_size=im_size)
+      image = outputs['image']
+      if image_preprocessing is not None:
+        image = image_preprocessing(image, crop_size[0], crop_size[1], train, bbox=bbox)
+      return tf.cast(image, tf.float32), outputs['label']
+
+    with tf.name_scope('batch_processing'):
+      batches = self.records().apply(
+          tf.contrib.data.map_and_batch(
+              parse,
+              batch_size,
+              num_parallel_calls=num_preprocess_threads,
+              drop_remainder=True))
+      images, labels = batches.prefetch(self.prefetch_batches).make_one_shot_iterator().get_next()
+
+      # Reshape images into these desired dimensions.
+      depth = 3
+      images = tf.reshape(images, shape=[batch_size, crop_size[0], crop_size[1], depth])
+      return images, tf.reshape(labels, [batch_size])
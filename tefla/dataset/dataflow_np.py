@@ -62,6 +62,11 @@ class Dataflow(object):
       self.validation_iter = iter(
           self.validation_iter_object(self.dataset.validation_X, self.dataset.validation_y))
 
+  def close(self):
+    """Releases the worker pools and shared memory of the iterators."""
+    self.training_iter_object.close()
+    self.validation_iter_object.close()
+
   def get_batch(self, mode='training'):
     """
         Args:
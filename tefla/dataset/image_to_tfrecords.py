@@ -8,14 +8,20 @@ from __future__ import division
 from __future__ import print_function
 import os
 import sys
-import threading
+import json
+import time
+import hashlib
+import warnings
 from datetime import datetime
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
 import tensorflow as tf
 import glob
 import numpy as np
 from PIL import Image
 import random
 from .decoder import ImageCoder
+from . import tfrecord_index
 
 
 class TFRecords(object):
@@ -45,10 +51,11 @@ class TFRecords(object):
     return self._is_jpg(filename)
 
   def _is_jpg(self, filename):
-    data = open(filename, 'rb').read(11)
-    if data[:4] != '\xff\xd8\xff\xe0':
+    with open(filename, 'rb') as f:
+      data = f.read(11)
+    if data[:4] != b'\xff\xd8\xff\xe0':
       return False
-    if data[6:] != 'JFIF\0':
+    if data[6:] != b'JFIF\0':
       return False
     return True
 
@@ -88,11 +95,10 @@ class TFRecords(object):
         width: integer, image width in pixels.
     """
     # Read the image file.
-    image_data = tf.gfile.FastGFile(filename, 'r').read()
+    image_data = tf.gfile.FastGFile(filename, 'rb').read()
 
     # Convert any PNG to JPEG's for consistency.
     if not self._is_jpg(filename):
-      print('Converting PNG to JPEG for %s' % filename)
       image_data = coder.png_to_jpeg(image_data)
 
     # Decode the RGB JPEG.
@@ -137,74 +143,50 @@ class TFRecords(object):
             feature={
                 'image/height': self._int64_feature(height),
                 'image/width': self._int64_feature(width),
-                'image/colorspace': self._bytes_feature(colorspace),
+                'image/colorspace': self._bytes_feature(tf.compat.as_bytes(colorspace)),
                 'image/channels': self._int64_feature(channels),
                 'image/class/label': self._int64_feature(label),
-                'image/class/text': self._bytes_feature(text),
-                'image/format': self._bytes_feature(image_format),
-                'image/filename': self._bytes_feature(bytes(os.path.basename(filename))),
+                'image/class/text': self._bytes_feature(tf.compat.as_bytes(text)),
+                'image/format': self._bytes_feature(tf.compat.as_bytes(image_format)),
+                'image/filename': self._bytes_feature(
+                    tf.compat.as_bytes(os.path.basename(filename))),
                 'image/encoded/image': self._bytes_feature(image_buffer)
             }))
     return example
 
-  def process_image_files_batch(self, coder, thread_index, ranges, name, filenames, texts, labels,
-                                num_shards, train_dir):
-    """Processes and saves list of images as TFRecord in 1 thread.
+  def write_shard(self, output_file, filenames, texts, labels):
+    """Processes and saves list of images as one TFRecord file.
+
+    The shard is written to a temporary file, renamed to `output_file` once
+    complete, so an interrupted shard is never mistaken for a finished one.
+    Its offset index, with the labels, is written next to it, see
+    `tfrecord_index`.
 
     Args:
-        coder: instance of ImageCoder to provide TensorFlow image coding utils.
-        thread_index: integer, unique batch to run index is within [0, len(ranges)).
-        ranges: list of pairs of integers specifying ranges of each batches to
-        analyze in parallel.
-        name: string, unique identifier specifying the data set
+        output_file: string, path of the shard
         filenames: list of strings; each string is a path to an image file
         texts: list of strings; each string is human readable, e.g. 'mild'
         labels: list of integer; each integer identifies the ground truth
-        num_shards: integer number of shards for this data set.
+
+    Returns:
+        number of images written
     """
-    # Each thread produces N shards where N = int(num_shards / num_threads).
-    # For instance, if num_shards = 128, and the num_threads = 2, then the first
-    # thread would produce shards [0, 64).
-    num_threads = len(ranges)
-    assert not num_shards % num_threads
-    num_shards_per_batch = int(num_shards / num_threads)
-
-    shard_ranges = np.linspace(ranges[thread_index][0], ranges[thread_index][1],
-                               num_shards_per_batch + 1).astype(int)
-    num_files_in_thread = ranges[thread_index][1] - ranges[thread_index][0]
-    counter = 0
-    for s in range(num_shards_per_batch):
-      # Generate a sharded version of the file name, e.g.
-      # 'train-00002-of-00010'
-      shard = thread_index * num_shards_per_batch + s
-      output_filename = '%s-%.5d-of-%.5d' % (name, shard, num_shards)
-      output_file = os.path.join(train_dir, output_filename)
-      writer = tf.python_io.TFRecordWriter(output_file)
-      print('processing')
-      shard_counter = 0
-      files_in_shard = np.arange(shard_ranges[s], shard_ranges[s + 1], dtype=int)
-      for i in files_in_shard:
-        filename = filenames[i] + '.jpg'
-        label = labels[i]
-        text = texts[i]
+    coder = _worker_coder()
+    tmp_file = output_file + '.tmp'
+    writer = tf.python_io.TFRecordWriter(tmp_file)
+    lengths = []
+    try:
+      for filename, text, label in zip(filenames, texts, labels):
         image_buffer, height, width = self.process_image(filename, coder)
         example = self.convert_to_example(filename, image_buffer, label, text, height, width)
-        writer.write(example.SerializeToString())
-        shard_counter += 1
-        counter += 1
-        print('Num of files %d' % (counter))
-        if not counter % 1000:
-          print('%s [thread %d]: Processed %d of %d images in thread batch.' %
-                (datetime.now(), thread_index, counter, num_files_in_thread))
-          sys.stdout.flush()
-
-      print('%s [thread %d]: Wrote %d images to %s' % (datetime.now(), thread_index, shard_counter,
-                                                       output_file))
-      sys.stdout.flush()
-      shard_counter = 0
-    print('%s [thread %d]: Wrote %d images to %d shards.' % (datetime.now(), thread_index, counter,
-                                                             num_files_in_thread))
-    sys.stdout.flush()
+        record = example.SerializeToString()
+        writer.write(record)
+        lengths.append(len(record))
+    finally:
+      writer.close()
+    tfrecord_index.write_index(output_file, lengths, labels)
+    os.rename(tmp_file, output_file)
+    return len(filenames)
 
   def process_image_files(self,
                           name,
@@ -213,43 +195,74 @@ class TFRecords(object):
                           labels,
                           num_shards,
                           output_dir,
-                          num_threads=4):
+                          num_workers=None,
+                          num_threads=None):
     """Process and save list of images as TFRecord of Example protos.
 
+    Shards are written by a pool of worker processes, one shard per task.
+    Consecutive files are grouped into shards of about the same size in
+    bytes. Finished shards are recorded in a manifest in `output_dir`, so
+    an interrupted conversion started again with the same files and number
+    of shards only writes the missing shards.
+
     Args:
         name: string, unique identifier specifying the data set
         filenames: list of strings; each string is a path to an image file
         texts: list of strings; each string is human readable, e.g. 'dog'
         labels: list of integer; each integer identifies the ground truth
         num_shards: integer number of shards for this data set.
+        output_dir: string, directory of the shards and the manifest
+        num_workers: number of worker processes, `None` for one per cpu
+        num_threads: deprecated alias of `num_workers`
     """
+    num_workers = _num_workers(num_workers, num_threads)
     assert len(filenames) == len(texts)
     assert len(filenames) == len(labels)
 
-    # Break all images into batches with a [ranges[i][0], ranges[i][1]].
-    spacing = np.linspace(0, len(filenames), num_threads + 1).astype(np.int)
-    ranges = []
-    threads = []
-    for i in range(len(spacing) - 1):
-      ranges.append([spacing[i], spacing[i + 1]])
+    filenames = [filename + '.jpg' for filename in filenames]
+    manifest_path = os.path.join(output_dir, '%s.manifest.json' % name)
+    fingerprint = files_fingerprint(filenames, labels)
+    shards = load_shard_manifest(manifest_path, fingerprint, num_shards)
+    # Generate the sharded version of the file names, e.g.
+    # 'train-00002-of-00010'
+    output_filenames = ['%s-%.5d-of-%.5d' % (name, shard, num_shards) for shard in range(num_shards)]
+    missing = [
+        shard for shard, output_filename in enumerate(output_filenames)
+        if output_filename not in shards or
+        not os.path.exists(os.path.join(output_dir, output_filename))
+    ]
+
+    num_workers = num_workers or cpu_count()
+    pool = Pool(num_workers)
+    try:
+      tasks = []
+      if missing:
+        # the files are stat'ed by the workers; one by one they are slow on
+        # network filesystems
+        chunksize = max(len(filenames) // (8 * num_workers), 1)
+        sizes = list(pool.imap(os.path.getsize, filenames, chunksize=chunksize))
+        bounds = byte_balanced_shards(sizes, num_shards)
+        for shard in missing:
+          start, end = bounds[shard], bounds[shard + 1]
+          tasks.append((self, os.path.join(output_dir, output_filenames[shard]),
+                        filenames[start:end], texts[start:end], labels[start:end]))
+      num_images = sum(len(task[2]) for task in tasks)
+      print('%s: Writing %d images to %d shards, %d shards up to date.' %
+            (datetime.now(), num_images, len(tasks), num_shards - len(tasks)))
+      sys.stdout.flush()
 
-    # Launch a thread for each batch.
-    print('Launching %d threads for spacings: %s' % (num_threads, ranges))
-    sys.stdout.flush()
-    # Create a mechanism for monitoring when all threads are finished.
-    coord = tf.train.Coordinator()
-    # Create a generic TensorFlow-based utility for converting all image
-    # codings.
-    coder = ImageCoder()
-    threads = []
-    for thread_index in range(len(ranges)):
-      args = (coder, thread_index, ranges, name, filenames, texts, labels, num_shards, output_dir)
-      t = threading.Thread(target=self.process_image_files_batch, args=args)
-      t.start()
-      threads.append(t)
-
-    # Wait for all the threads to terminate.
-    coord.join(threads)
+      start_time = time.time()
+      counter = 0
+      for output_file, count in pool.imap_unordered(_write_shard, tasks):
+        counter += count
+        shards[os.path.basename(output_file)] = count
+        save_shard_manifest(manifest_path, fingerprint, num_shards, shards)
+        rate = counter / max(time.time() - start_time, 1e-6)
+        print('%s: Wrote %d images to %s, %d of %d images, %.1f images/sec.' %
+              (datetime.now(), count, output_file, counter, num_images, rate))
+        sys.stdout.flush()
+    finally:
+      pool.terminate()
     print('%s: Finished writing all %d images in data set.' % (datetime.now(), len(filenames)))
     sys.stdout.flush()
 
@@ -297,7 +310,7 @@ class TFRecords(object):
     # Shuffle the ordering of all image files in order to guarantee
     # random ordering of the images with respect to label in the
     # saved TFRecord files. Make the randomization repeatable.
-    shuffled_index = range(len(filenames))
+    shuffled_index = list(range(len(filenames)))
     random.seed(12345)
     random.shuffle(shuffled_index)
 
@@ -309,7 +322,14 @@ class TFRecords(object):
                                                                data_dir))
     return filenames, texts, labels
 
-  def process_dataset(self, name, directory, output_directory, num_shards, labels_file):
+  def process_dataset(self,
+                      name,
+                      directory,
+                      output_directory,
+                      num_shards,
+                      labels_file,
+                      num_workers=None,
+                      num_threads=None):
     """Process a complete data set and save it as a TFRecord.
 
     Args:
@@ -317,9 +337,13 @@ class TFRecords(object):
         directory: string, root path to the data set.
         num_shards: integer number of shards for this data set.
         labels_file: string, path to the labels file.
+        num_workers: number of worker processes, `None` for one per cpu
+        num_threads: deprecated alias of `num_workers`
     """
+    num_workers = _num_workers(num_workers, num_threads)
     filenames, texts, labels = self.find_image_files(directory, labels_file)
-    self.process_image_files(name, filenames, texts, labels, num_shards, output_directory)
+    self.process_image_files(
+        name, filenames, texts, labels, num_shards, output_directory, num_workers=num_workers)
 
   def read_images_from(self, data_dir, imresize=[512, 512]):
     images = []
@@ -338,6 +362,80 @@ class TFRecords(object):
     return images_only
 
 
+_coder = None
+
+
+def _worker_coder():
+  # one coder, and tf session, per worker process
+  global _coder
+  if _coder is None:
+    _coder = ImageCoder()
+  return _coder
+
+
+def _write_shard(args):
+  tfrecords, output_file, filenames, texts, labels = args
+  return output_file, tfrecords.write_shard(output_file, filenames, texts, labels)
+
+
+def _num_workers(num_workers, num_threads):
+  if num_threads is not None:
+    warnings.warn('num_threads is deprecated, shards are written by processes: use num_workers',
+                  DeprecationWarning)
+    if num_workers is None:
+      num_workers = num_threads
+  return num_workers
+
+
+def byte_balanced_shards(sizes, num_shards):
+  """Splits consecutive files into shards of about the same size in bytes.
+
+  Args:
+      sizes: list of file sizes, in bytes
+      num_shards: number of shards
+
+  Returns:
+      a list of `num_shards + 1` file indices, the bounds of the shards
+  """
+  cum_sizes = np.cumsum(sizes)
+  total = cum_sizes[-1] if len(sizes) else 0
+  targets = total * np.arange(1, num_shards) / num_shards
+  # a file goes to the shard its middle byte falls into
+  bounds = np.searchsorted(cum_sizes - np.asarray(sizes) / 2., targets, side='left')
+  return [0] + [int(b) for b in bounds] + [len(sizes)]
+
+
+def files_fingerprint(filenames, labels):
+  """Digest of the list of files and labels of a conversion."""
+  digest = hashlib.sha1()
+  for filename, label in zip(filenames, labels):
+    digest.update(('%s\t%s\n' % (filename, label)).encode('utf-8'))
+  return digest.hexdigest()
+
+
+def load_shard_manifest(path, fingerprint, num_shards):
+  """Loads the shard manifest, a map of finished shard file to image count.
+
+  A missing manifest, or one written for other files or another number of
+  shards, gives an empty map.
+  """
+  try:
+    with open(path) as f:
+      manifest = json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+  if manifest.get('fingerprint') != fingerprint or manifest.get('num_shards') != num_shards:
+    return {}
+  return manifest.get('shards', {})
+
+
+def save_shard_manifest(path, fingerprint, num_shards, shards):
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump({'fingerprint': fingerprint, 'num_shards': num_shards, 'shards': shards}, f)
+  os.rename(tmp_path, path)
+
+
 if __name__ == '__main__':
   # Convert Images to tfRecords files
   im2r = TFRecords()
@@ -0,0 +1,194 @@
+"""Random access to TFRecord shards through sidecar offset indexes.
+
+A TFRecord file is a sequence of records framed as a little endian uint64
+length, its masked crc32, the serialized data and the data crc32. The index
+of a shard, `shard + '.index.npz'`, holds the offset and length of the data
+of every record, and optionally its label, so any record can be read with a
+single `pread`.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import struct
+import threading
+
+import numpy as np
+
+INDEX_SUFFIX = '.index.npz'
+# length and length crc before the data, data crc after it
+_HEADER_BYTES = 12
+_FOOTER_BYTES = 4
+
+
+def index_path(path):
+  """Returns the path of the index of the shard `path`."""
+  return path + INDEX_SUFFIX
+
+
+def data_offsets(lengths):
+  """Offsets of the data of consecutive records of the given lengths."""
+  lengths = np.asarray(lengths, dtype=np.int64)
+  return np.cumsum(lengths + _HEADER_BYTES + _FOOTER_BYTES) - lengths - _FOOTER_BYTES
+
+
+def write_index(path, lengths, labels=None):
+  """Writes the index of a shard written with records of the given lengths.
+
+  Args:
+      path: string, path of the shard
+      lengths: list of the serialized record lengths, in file order
+      labels: an optional list of record labels, -1 for unknown
+  """
+  lengths = np.asarray(lengths, dtype=np.int64)
+  if labels is None:
+    labels = np.full(len(lengths), -1, dtype=np.int64)
+  tmp_path = index_path(path) + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    np.savez(
+        f,
+        offsets=data_offsets(lengths),
+        lengths=lengths,
+        labels=np.asarray(labels, dtype=np.int64))
+  os.rename(tmp_path, index_path(path))
+
+
+def build_index(path):
+  """Scans a shard without index and writes its index, without labels."""
+  lengths = []
+  with open(path, 'rb') as f:
+    while True:
+      header = f.read(_HEADER_BYTES)
+      if len(header) < _HEADER_BYTES:
+        break
+      length = struct.unpack('<Q', header[:8])[0]
+      lengths.append(length)
+      f.seek(length + _FOOTER_BYTES, os.SEEK_CUR)
+  write_index(path, lengths)
+
+
+def load_index(path, build=True):
+  """Returns the (offsets, lengths, labels) index of a shard.
+
+  Args:
+      path: string, path of the shard
+      build: whether to build a missing index by scanning the shard
+  """
+  if not os.path.exists(index_path(path)):
+    if not build:
+      raise IOError('No index for %s' % path)
+    build_index(path)
+  with np.load(index_path(path)) as index:
+    return index['offsets'], index['lengths'], index['labels']
+
+
+def _pread(fd, length, offset):
+  if hasattr(os, 'pread'):
+    return os.pread(fd, length, offset)
+  os.lseek(fd, offset, os.SEEK_SET)
+  return os.read(fd, length)
+
+
+class IndexedTFRecords(object):
+  """Random access reader of indexed TFRecord shards.
+
+  Records are numbered across the shards in the given order. Files are
+  opened lazily, once per process: the reader pickles without its file
+  descriptors, so it can be passed to worker processes.
+
+  Args:
+      data_files: list of TFRecord shard paths
+      build_missing: whether to build missing indexes by scanning the shards
+  """
+
+  def __init__(self, data_files, build_missing=True):
+    self.data_files = list(data_files)
+    shards, offsets, lengths, labels = [], [], [], []
+    for shard, path in enumerate(self.data_files):
+      shard_offsets, shard_lengths, shard_labels = load_index(path, build=build_missing)
+      shards.append(np.full(len(shard_offsets), shard, dtype=np.int32))
+      offsets.append(shard_offsets)
+      lengths.append(shard_lengths)
+      labels.append(shard_labels)
+    self.shards = np.concatenate(shards) if shards else np.zeros(0, dtype=np.int32)
+    self.offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+    self.lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    self.labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int64)
+    self._fds = {}
+    self._fds_lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __getitem__(self, i):
+    """Returns the serialized record `i`."""
+    return _pread(self._fd(self.shards[i]), int(self.lengths[i]), int(self.offsets[i]))
+
+  def read(self, indices):
+    """Returns the list of serialized records at `indices`."""
+    return [self[i] for i in indices]
+
+  def permutation(self, epoch, seed=0):
+    """A permutation of all the records, the same for a given epoch and seed."""
+    return np.random.RandomState((seed, epoch)).permutation(len(self))
+
+  def stratified_indices(self, target_probs, num_samples, seed=None):
+    """Samples record indices with the given class proportions.
+
+    Every draw picks a class with probability `target_probs[label]`, then a
+    record of that class uniformly, so no record read is discarded.
+
+    Args:
+        target_probs: list of per class probabilities, summing to 1
+        num_samples: number of indices to draw, with replacement
+        seed: an optional random seed
+
+    Returns:
+        an int array of record indices
+    """
+    if (self.labels < 0).any():
+      raise ValueError('Stratified sampling needs indexes with labels')
+    rng = np.random.RandomState(seed)
+    target_probs = np.asarray(target_probs, dtype=np.float64)
+    counts = np.bincount(self.labels, minlength=len(target_probs))[:len(target_probs)]
+    if (counts[target_probs > 0] == 0).any():
+      raise ValueError('No records for a class with a nonzero target probability')
+    order = np.argsort(self.labels, kind='mergesort')
+    starts = np.cumsum(counts) - counts
+    classes = rng.choice(len(target_probs), size=num_samples, p=target_probs / target_probs.sum())
+    offsets = (rng.random_sample(num_samples) * counts[classes]).astype(np.int64)
+    return order[starts[classes] + offsets]
+
+  def subset(self, num_samples, seed=0):
+    """A fixed random subset of record indices, in file order."""
+    indices = np.random.RandomState(seed).permutation(len(self))[:num_samples]
+    return np.sort(indices)
+
+  def close(self):
+    """Closes the files opened by this process."""
+    with self._fds_lock:
+      for fd in self._fds.values():
+        os.close(fd)
+      self._fds = {}
+
+  def _fd(self, shard):
+    fd = self._fds.get(shard)
+    if fd is None:
+      # records are read from several threads, e.g. by tf.py_func
+      with self._fds_lock:
+        fd = self._fds.get(shard)
+        if fd is None:
+          fd = os.open(self.data_files[shard], os.O_RDONLY)
+          self._fds[shard] = fd
+    return fd
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state['_fds'] = {}
+    del state['_fds_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._fds_lock = threading.Lock()
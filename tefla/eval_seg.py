@@ -19,21 +19,30 @@ from tefla.core.metrics import IOUSeg as IOU
 @click.option('--output_path', default='/tmp/test', help='Output Dir to save the segmented image')
 @click.option(
     '--gpu_memory_fraction', default=0.92, show_default=True, help='GPU memory fraction to use.')
+@click.option(
+    '--crf_workers',
+    default=0,
+    show_default=True,
+    help='DenseCRF worker processes, 0 to run it in process.')
+@click.option('--crf_iters', default=10, show_default=True, help='DenseCRF inference iterations.')
 def predict(frozen_model, training_cnf, predict_dir, image_size, output_path, num_classes,
-            gpu_memory_fraction):
+            gpu_memory_fraction, crf_workers, crf_iters):
   cnf = util.load_module(training_cnf).cnf
   standardizer = cnf['standardizer']
   graph = util.load_frozen_graph(frozen_model)
   preprocessor = convert_preprocessor(image_size)
-  predictor = SegmentPredictor(graph, standardizer, preprocessor)
   # images = data.get_image_files(predict_dir)
   image_names = [
       filename.strip() for filename in os.listdir(predict_dir) if filename.endswith('.jpg')
   ]
 
-  iou = IOU()
-  per_class_iou = iou.per_class_iou(predictor, predict_dir, image_size)
-  meaniou = iou.meaniou(predictor, predict_dir, image_size)
+  iou = IOU(num_classes=num_classes)
+  with SegmentPredictor(
+      graph, standardizer, preprocessor, crf_workers=crf_workers,
+      crf_iters=crf_iters) as predictor:
+    hist = iou.evaluate(predictor, predict_dir, image_size)
+    per_class_iou = iou.per_class_iou(predictor, predict_dir, image_size, hist=hist)
+    meaniou = iou.meaniou(predictor, predict_dir, image_size, hist=hist)
   print(per_class_iou)
   print('Mean IOU %5.5f' % meaniou)
 
@@ -0,0 +1,33 @@
+"""Pack a training and validation directory into packed dataset files."""
+from __future__ import division, print_function
+
+import click
+
+from tefla.core import data_load_ops as data
+from tefla.da.packed_images import pack_images
+
+# pylint: disable=no-value-for-parameter
+
+
+@click.command()
+@click.option(
+    '--data_dir',
+    default=None,
+    show_default=True,
+    help='Dataset directory, with training_<size> and validation_<size> images and label files.')
+@click.option('--img_size', default=256, show_default=True, help='Size of the converted images.')
+@click.option(
+    '--processes', default=None, type=int, help='Decoding processes, one per cpu by default.')
+def main(data_dir, img_size, processes):
+  for split in ['training', 'validation']:
+    files = data.get_image_files("%s/%s_%d" % (data_dir, split, img_size))
+    names = data.get_names(files)
+    labels = data.get_labels(names, label_file="%s/%s_labels.csv" % (data_dir, split))
+    path = "%s/%s_%d.packed" % (data_dir, split, img_size)
+    print("Packing %d %s images into %s" % (len(files), split, path))
+    pack_images(files, path, labels=labels, processes=processes)
+  print('done')
+
+
+if __name__ == '__main__':
+  main()
@@ -4,7 +4,8 @@ import click
 import numpy as np
 
 from tefla.core.iter_ops import create_prediction_iter, convert_preprocessor
-from tefla.core.prediction import QuasiCropPredictor
+from tefla.core.prediction import QuasiCropPredictor, CSVPredictionWriter, NpyPredictionWriter, \
+    stream_predictions
 from tefla.da import data
 from tefla.utils import util
 
@@ -22,8 +23,18 @@ from tefla.utils import util
 @click.option('--image_size', default=256, show_default=True, help='Image size for conversion.')
 @click.option('--sync', is_flag=True, help='Do all processing on the calling thread.')
 @click.option('--test_type', default='quasi', help='Specify test type, crop_10 or quasi')
+@click.option(
+    '--fused_tta', is_flag=True, help='Decode each image once and predict all its tta variants.')
+@click.option(
+    '--stream',
+    is_flag=True,
+    help='Write predictions block by block with constant memory; resumes an interrupted run.')
+@click.option(
+    '--output_format', default='csv', show_default=True, help='Streamed output format, csv or npy.')
+@click.option(
+    '--block_size', default=4096, show_default=True, help='Images per streamed prediction block.')
 def predict(model, training_cnf, predict_dir, weights_from, dataset_name, convert, image_size, sync,
-            test_type):
+            test_type, fused_tta, stream, output_format, block_size):
   model_def = util.load_module(model)
   model = model_def.model
   cnf = util.load_module(training_cnf).cnf
@@ -36,23 +47,37 @@ def predict(model, training_cnf, predict_dir, weights_from, dataset_name, conver
   prediction_iterator = create_prediction_iter(cnf, standardizer, model_def.crop_size, preprocessor,
                                                sync)
 
-  if test_type == 'quasi':
-    predictor = QuasiCropPredictor(model, cnf, weights_from, prediction_iterator, 20)
-    predictions = predictor.predict(images)
+  try:
+    if test_type == 'quasi':
+      predictor = QuasiCropPredictor(
+          model, cnf, weights_from, prediction_iterator, 20, fused=fused_tta)
+
+    if not os.path.exists(os.path.join(predict_dir, '..', 'results')):
+      os.mkdir(os.path.join(predict_dir, '..', 'results'))
+    if not os.path.exists(os.path.join(predict_dir, '..', 'results', dataset_name)):
+      os.mkdir(os.path.join(predict_dir, '..', 'results', dataset_name))
 
-  if not os.path.exists(os.path.join(predict_dir, '..', 'results')):
-    os.mkdir(os.path.join(predict_dir, '..', 'results'))
-  if not os.path.exists(os.path.join(predict_dir, '..', 'results', dataset_name)):
-    os.mkdir(os.path.join(predict_dir, '..', 'results', dataset_name))
-
-  names = data.get_names(images)
-  image_prediction_prob = np.column_stack([names, predictions])
-  headers = ['score%d' % (i + 1) for i in range(predictions.shape[1])]
-  title = np.array(['image'] + headers)
-  image_prediction_prob = np.vstack([title, image_prediction_prob])
-  labels_file_prob = os.path.abspath(
-      os.path.join(predict_dir, '..', 'results', dataset_name, 'predictions.csv'))
-  np.savetxt(labels_file_prob, image_prediction_prob, delimiter=",", fmt="%s")
+    names = data.get_names(images)
+    if stream:
+      labels_file_prob = os.path.abspath(
+          os.path.join(predict_dir, '..', 'results', dataset_name, 'predictions.' + output_format))
+      if output_format == 'npy':
+        writer = NpyPredictionWriter(labels_file_prob, names)
+      else:
+        writer = CSVPredictionWriter(labels_file_prob, names)
+      stream_predictions(predictor, images, writer, block_size)
+      return
+
+    predictions = predictor.predict(images)
+    image_prediction_prob = np.column_stack([names, predictions])
+    headers = ['score%d' % (i + 1) for i in range(predictions.shape[1])]
+    title = np.array(['image'] + headers)
+    image_prediction_prob = np.vstack([title, image_prediction_prob])
+    labels_file_prob = os.path.abspath(
+        os.path.join(predict_dir, '..', 'results', dataset_name, 'predictions.csv'))
+    np.savetxt(labels_file_prob, image_prediction_prob, delimiter=",", fmt="%s")
+  finally:
+    prediction_iterator.close()
 
 
 if __name__ == '__main__':
@@ -99,13 +99,22 @@ def plot_masks(cropped_image_path, prediction_map, output_image_path):
 @click.option('--output_path', default='/tmp/test', help='Output Dir to save the segmented image')
 @click.option(
     '--gpu_memory_fraction', default=0.92, show_default=True, help='GPU memory fraction to use.')
-def predict(frozen_model, training_cnf, image_path, image_size, output_path, gpu_memory_fraction):
+@click.option(
+    '--crf_workers',
+    default=0,
+    show_default=True,
+    help='DenseCRF worker processes, 0 to run it in process.')
+@click.option('--crf_iters', default=10, show_default=True, help='DenseCRF inference iterations.')
+def predict(frozen_model, training_cnf, image_path, image_size, output_path, gpu_memory_fraction,
+            crf_workers, crf_iters):
   cnf = util.load_module(training_cnf).cnf
   standardizer = cnf['standardizer']
   graph = util.load_frozen_graph(frozen_model)
   preprocessor = convert_preprocessor(448)
-  predictor = SegmentPredictor(graph, standardizer, preprocessor)
-  final_prediction_map = predictor.predict(image_path)
+  with SegmentPredictor(
+      graph, standardizer, preprocessor, crf_workers=crf_workers,
+      crf_iters=crf_iters) as predictor:
+    final_prediction_map = predictor.predict(image_path)
   final_prediction_map = final_prediction_map.transpose(0, 2, 1).squeeze()
   image = data.load_image(image_path, preprocessor=preprocessor)
   img = image.transpose(2, 1, 0)
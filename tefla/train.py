@@ -8,7 +8,7 @@ import tensorflow as tf
 
 tf.set_random_seed(127)
 
-from tefla.core.dir_dataset import DataSet
+from tefla.core.dir_dataset import DataSet, PackedDataSet
 from tefla.core.iter_ops import create_training_iters
 from tefla.core.learning import SupervisedLearner
 from tefla.da.standardizer import NoOpStandardizer
@@ -43,8 +43,10 @@ from tefla.utils import util
 @click.option('--weighted', default=False, show_default=True, help='Whether to use weighted loss.')
 @click.option('--log_file_name', default='train_seg.log', show_default=True, help='Log file name.')
 @click.option('--is_summary', default=False, show_default=True, help='Path to initial weights file.')
+@click.option(
+    '--packed', is_flag=True, help='Read the images from the packed files of pack_dataset.py.')
 def main(model, training_cnf, data_dir, parallel, start_epoch, weights_from, weights_dir, resume_lr,
-         gpu_memory_fraction, num_classes, is_summary, loss_type, weighted, log_file_name):
+         gpu_memory_fraction, num_classes, is_summary, loss_type, weighted, log_file_name, packed):
   model_def = util.load_module(model)
   model = model_def.model
   cnf = util.load_module(training_cnf).cnf
@@ -52,7 +54,10 @@ def main(model, training_cnf, data_dir, parallel, start_epoch, weights_from, wei
   if weights_from:
     weights_from = str(weights_from)
 
-  data_set = DataSet(data_dir, model_def.image_size[0])
+  if packed:
+    data_set = PackedDataSet(data_dir, model_def.image_size[0])
+  else:
+    data_set = DataSet(data_dir, model_def.image_size[0])
   standardizer = cnf.get('standardizer', NoOpStandardizer())
   cutout = cnf.get('cutout', None)
 
@@ -77,8 +82,13 @@ def main(model, training_cnf, data_dir, parallel, start_epoch, weights_from, wei
       loss_type=loss_type,
       weighted=weighted,
       log_file_name=log_file_name)
-  learner.fit(
-      data_set, weights_from, start_epoch=start_epoch, weights_dir=weights_dir, summary_every=399)
+  try:
+    learner.fit(
+        data_set, weights_from, start_epoch=start_epoch, weights_dir=weights_dir, summary_every=399)
+  finally:
+    # frees the worker pools and shared memory of the parallel iterators
+    training_iter.close()
+    validation_iter.close()
 
 
 if __name__ == '__main__':
@@ -65,7 +65,12 @@ def main(model, training_cnf, data_dir, parallel, start_epoch, weights_from, res
       is_summary=is_summary,
       verbosity=1,
       log_file_name=log_file_name)
-  trainer.fit(data_set, num_classes, weights_from, start_epoch, summary_every=399)
+  try:
+    trainer.fit(data_set, num_classes, weights_from, start_epoch, summary_every=399)
+  finally:
+    # frees the worker pools and shared memory of the parallel iterators
+    training_iter.close()
+    validation_iter.close()
 
 
 if __name__ == '__main__':
@@ -10,15 +10,21 @@ import numpy as np
 def confusion_matrix(rater_a, rater_b, min_rating=None, max_rating=None):
   """Returns the confusion matrix between rater's ratings."""
   assert (len(rater_a) == len(rater_b))
+  rater_a = np.asarray(rater_a, dtype=np.int64).ravel()
+  rater_b = np.asarray(rater_b, dtype=np.int64).ravel()
   if min_rating is None:
-    min_rating = min(rater_a + rater_b)
+    min_rating = min(rater_a.min(), rater_b.min())
   if max_rating is None:
-    max_rating = max(rater_a + rater_b)
+    max_rating = max(rater_a.max(), rater_b.max())
   num_ratings = int(max_rating - min_rating + 1)
-  conf_mat = [[0 for i in range(num_ratings)] for j in range(num_ratings)]
-  for a, b in zip(rater_a, rater_b):
-    conf_mat[a - min_rating][b - min_rating] += 1
-  return conf_mat
+  rater_a = rater_a - min_rating
+  rater_b = rater_b - min_rating
+  if len(rater_a) and (min(rater_a.min(), rater_b.min()) < 0 or
+                       max(rater_a.max(), rater_b.max()) >= num_ratings):
+    raise IndexError('rating out of range')
+  return np.bincount(
+      rater_a * num_ratings + rater_b, minlength=num_ratings * num_ratings).reshape(
+          num_ratings, num_ratings)
 
 
 def calculate_kappa(y_true, y_pred):
@@ -49,15 +55,42 @@ def calculate_auc(y_true, y_pred):
 
 def histogram(ratings, min_rating=None, max_rating=None):
   """Returns the counts of each type of rating that a rater made."""
+  ratings = np.asarray(ratings, dtype=np.int64).ravel()
   if min_rating is None:
-    min_rating = min(ratings)
+    min_rating = ratings.min()
   if max_rating is None:
-    max_rating = max(ratings)
+    max_rating = ratings.max()
   num_ratings = int(max_rating - min_rating + 1)
-  hist_ratings = [0 for x in range(num_ratings)]
-  for r in ratings:
-    hist_ratings[r - min_rating] += 1
-  return hist_ratings
+  return np.bincount(ratings - min_rating, minlength=num_ratings)[:num_ratings]
+
+
+def kappa_from_confusion_matrix(conf_mat):
+  """Calculates the quadratic weighted kappa of a confusion matrix.
+
+  Args:
+      conf_mat: 2D array, counts of the rating pairs, rater_a ratings along
+          the rows
+
+  Returns:
+      the quadratic weighted kappa
+
+  Raises:
+      ZeroDivisionError: if there are no items or fewer than two ratings, or
+          if the expected disagreement is zero
+  """
+  conf_mat = np.asarray(conf_mat, dtype=np.float64)
+  num_ratings = len(conf_mat)
+  num_scored_items = conf_mat.sum()
+  if num_scored_items == 0 or num_ratings < 2:
+    raise ZeroDivisionError('float division by zero')
+  ratings = np.arange(num_ratings)
+  weights = np.subtract.outer(ratings, ratings)**2 / float((num_ratings - 1)**2)
+  expected = np.outer(conf_mat.sum(1), conf_mat.sum(0)) / num_scored_items
+  numerator = (weights * conf_mat).sum() / num_scored_items
+  denominator = (weights * expected).sum() / num_scored_items
+  if denominator == 0:
+    raise ZeroDivisionError('float division by zero')
+  return 1.0 - numerator / denominator
 
 
 def quadratic_weighted_kappa(rater_a, rater_b, min_rating=0, max_rating=4):
@@ -93,22 +126,7 @@ def quadratic_weighted_kappa(rater_a, rater_b, min_rating=0, max_rating=4):
   if max_rating is None:
     max_rating = max(max(rater_a), max(rater_b))
   conf_mat = confusion_matrix(rater_a, rater_b, min_rating, max_rating)
-  num_ratings = len(conf_mat)
-  num_scored_items = float(len(rater_a))
-
-  hist_rater_a = histogram(rater_a, min_rating, max_rating)
-  hist_rater_b = histogram(rater_b, min_rating, max_rating)
-
-  numerator = 0.0
-  denominator = 0.0
-
-  for i in range(num_ratings):
-    for j in range(num_ratings):
-      expected_count = (hist_rater_a[i] * hist_rater_b[j] / num_scored_items)
-      d = pow(i - j, 2.0) / pow(num_ratings - 1, 2.0)
-      numerator += d * conf_mat[i][j] / num_scored_items
-      denominator += d * expected_count / num_scored_items
   try:
-    return 1.0 - numerator / denominator
+    return kappa_from_confusion_matrix(conf_mat)
   except ZeroDivisionError:
     return 0.001
@@ -165,6 +165,20 @@ class CaptionGeneratorTest(tf.test.TestCase):
     ]
     self._assertExpectedCaptions(expected, beam_size=4, length_normalization_factor=3)
 
+  def testBeamSearchBatch(self):
+    for beam_size in [1, 2, 3, 4]:
+      generator = caption_gen.CaptionGenerator(
+          model=FakeModel(), vocab=FakeVocab(), beam_size=beam_size)
+      expected_captions = generator.beam_search(sess=None, encoded_image=None)
+      batch_captions = generator.beam_search_batch(sess=None, encoded_images=[None] * 3)
+
+      self.assertEqual(3, len(batch_captions))
+      for actual_captions in batch_captions:
+        self.assertEqual([c.sentence for c in expected_captions],
+                         [c.sentence for c in actual_captions])
+        self.assertAllClose([c.logprob for c in expected_captions],
+                            [c.logprob for c in actual_captions])
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal
+
+from tefla.da import data
+
+
+@pytest.mark.parametrize('mode', ['constant', 'edge', 'symmetric', 'reflect', 'wrap'])
+@pytest.mark.parametrize('order', [0, 1])
+def test_batch_warp_matches_fast_warp(mode, order):
+  rng = np.random.RandomState(42)
+  imgs = rng.uniform(0, 255, size=(5, 3, 13, 11)).astype(np.float32)
+  tforms = [
+      data.random_perturbation_transform(
+          zoom_range=(1 / 1.3, 1.3),
+          rotation_range=(0, 360),
+          shear_range=(0, 10),
+          translation_range=(-5, 5),
+          rng=rng) for _ in range(5)
+  ]
+  warped = data.batch_warp(imgs, tforms, (9, 10), mode=mode, mode_cval=7, order=order)
+  expected = np.array([
+      data.fast_warp(img, tform, (9, 10), mode=mode, mode_cval=7, order=order)
+      for img, tform in zip(imgs, tforms)
+  ])
+  assert_array_almost_equal(expected, warped, decimal=3)
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from PIL import Image
+from numpy.testing import assert_allclose, assert_equal
+
+from tefla.da import dataset_stats
+
+
+@pytest.fixture
+def images():
+  rng = np.random.RandomState(0)
+  return rng.randint(0, 256, size=(10, 6, 5, 3)).astype(np.uint8)
+
+
+def test_running_stats_merge():
+  rng = np.random.RandomState(1)
+  x = rng.normal(3.0, 2.0, size=(1000, 4))
+  stats = dataset_stats.RunningStats(4)
+  for i in range(0, 1000, 128):
+    stats.update(x[i:i + 128])
+  assert_equal(stats.n, 1000)
+  assert_allclose(stats.mean, x.mean(axis=0))
+  assert_allclose(stats.cov, np.cov(x, rowvar=False, bias=True))
+  assert_allclose(stats.std, x.std(axis=0))
+
+
+def test_channel_stats_files_and_array(tmpdir, images):
+  fnames = []
+  for i, img in enumerate(images):
+    fname = str(tmpdir.join('%d.png' % i))
+    Image.fromarray(img).save(fname)
+    fnames.append(fname)
+  pixels = images[:7].reshape(-1, 3).astype(np.float64)
+  for dataset in (images, fnames):
+    stats = dataset_stats.channel_stats(dataset, processes=2, chunk_size=3, limit=7)
+    assert_equal(stats.n, len(pixels))
+    assert_allclose(stats.mean, pixels.mean(axis=0))
+    assert_allclose(stats.std, pixels.std(axis=0))
+    u, ev = stats.pca()
+    corr = np.corrcoef(pixels, rowvar=False)
+    assert_allclose(np.dot(u * ev**2, u.T), corr, atol=1e-10)
+    mean, std = dataset_stats.global_mean_std(stats)
+    assert_allclose([mean, std], [pixels.mean(), pixels.std()])
+
+
+def test_sample_stats(images):
+  flat = images.reshape(len(images), -1).astype(np.float64)
+  stats = dataset_stats.sample_stats(list(images), chunk_size=4)
+  assert_allclose(stats.mean, flat.mean(axis=0))
+  assert_allclose(stats.cov, np.cov(flat, rowvar=False, bias=True), atol=1e-8)
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -0,0 +1,130 @@
+import functools
+import os
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal, assert_equal
+
+from tefla.da.image_cache import ImageCache
+
+
+# size of the .npy file of a cached image, header included
+NPY_BYTES = 128 + 48
+
+
+class CountingPreprocessor(object):
+
+  def __init__(self):
+    self.calls = 0
+
+  def __repr__(self):
+    return 'CountingPreprocessor()'
+
+  def __call__(self, fname):
+    self.calls += 1
+    return np.full((4, 4, 3), int(fname), dtype=np.uint8)
+
+
+def test_memory_cache_hits():
+  preprocessor = CountingPreprocessor()
+  cache = ImageCache(max_bytes=10 * 48)
+  for _ in range(3):
+    for fname in ['1', '2', '3']:
+      assert_array_equal(cache.load(fname, preprocessor), preprocessor(fname))
+  assert_equal(preprocessor.calls, 3 + 9)
+
+
+def test_memory_cache_lru_eviction():
+  preprocessor = CountingPreprocessor()
+  cache = ImageCache(max_bytes=2 * 48)
+  cache.load('1', preprocessor)
+  cache.load('2', preprocessor)
+  cache.load('1', preprocessor)
+  cache.load('3', preprocessor)
+  assert_equal(preprocessor.calls, 3)
+  cache.load('1', preprocessor)
+  assert_equal(preprocessor.calls, 3)
+  cache.load('2', preprocessor)
+  assert_equal(preprocessor.calls, 4)
+
+
+def test_disk_cache(tmpdir):
+  preprocessor = CountingPreprocessor()
+  cache = ImageCache(max_bytes=10 * NPY_BYTES, cache_dir=str(tmpdir), processes=1)
+  for fname in ['1', '2', '1']:
+    assert_array_equal(cache.load(fname, preprocessor), np.full((4, 4, 3), int(fname)))
+  assert_equal(preprocessor.calls, 2)
+  assert_equal(len(tmpdir.listdir()), 2)
+
+
+def read_scaled(fname, scale):
+  with open(fname) as f:
+    return np.full((4, 4, 3), int(f.read()) * scale, dtype=np.uint8)
+
+
+def test_disk_cache_key(tmpdir):
+  fname = str(tmpdir.join('img.txt'))
+  with open(fname, 'w') as f:
+    f.write('1')
+  cache = ImageCache(max_bytes=10 * NPY_BYTES, cache_dir=str(tmpdir.join('cache')), processes=1)
+  for scale in [1, 2, 1]:
+    assert_array_equal(
+        cache.load(fname, functools.partial(read_scaled, scale=scale)), np.full((4, 4, 3), scale))
+  assert_equal(len(tmpdir.join('cache').listdir()), 2)
+  # a changed file misses the cache
+  with open(fname, 'w') as f:
+    f.write('10')
+  assert_array_equal(
+      cache.load(fname, functools.partial(read_scaled, scale=1)), np.full((4, 4, 3), 10))
+  assert_equal(len(tmpdir.join('cache').listdir()), 3)
+
+
+def test_disk_cache_evicts_own_files(tmpdir):
+  preprocessor = CountingPreprocessor()
+  # the files of a run fit in 2 images, split between 2 processes
+  first = ImageCache(max_bytes=2 * NPY_BYTES, cache_dir=str(tmpdir), processes=2)
+  for fname in ['1', '2', '3']:
+    first.load(fname, preprocessor)
+  assert_equal(len(tmpdir.listdir()), 1)
+  second = ImageCache(max_bytes=2 * NPY_BYTES, cache_dir=str(tmpdir), processes=2)
+  second.load('3', preprocessor)
+  assert_equal(preprocessor.calls, 3)
+  second.load('4', preprocessor)
+  second.load('5', preprocessor)
+  assert_equal(len(tmpdir.listdir()), 2)
+  first.load('3', preprocessor)
+  assert_equal(preprocessor.calls, 5)
+
+
+def test_disk_cache_trims_earlier_runs(tmpdir):
+  preprocessor = CountingPreprocessor()
+  cache = ImageCache(max_bytes=3 * NPY_BYTES, cache_dir=str(tmpdir), processes=1)
+  for fname in ['1', '2', '3']:
+    cache.load(fname, preprocessor)
+  ImageCache(max_bytes=2 * NPY_BYTES, cache_dir=str(tmpdir))
+  assert_equal(len(tmpdir.listdir()), 2)
+
+
+def test_shared_cache(tmpdir):
+  # a single process disk cache keeps its whole budget
+  disk_cache = ImageCache(max_bytes=NPY_BYTES, cache_dir=str(tmpdir))
+  assert_equal(disk_cache.processes, 1)
+  shared_disk_cache = disk_cache.shared(2)
+  assert_equal(shared_disk_cache.cache_dir, disk_cache.cache_dir)
+  assert_equal((disk_cache.processes, shared_disk_cache.processes), (1, 2))
+  preprocessor = CountingPreprocessor()
+  cache = ImageCache(max_bytes=2 * NPY_BYTES).shared(2)
+  assert_equal(cache.processes, 2)
+  cache.load('1', preprocessor)
+  cache.clear()
+  # another process reads the files of the cache dir
+  cache.load('1', preprocessor)
+  assert_equal(preprocessor.calls, 1)
+  cache.remove()
+  assert not os.path.exists(cache.cache_dir)
+  shared_disk_cache.remove()
+  assert tmpdir.check()
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -0,0 +1,34 @@
+import pytest
+from numpy.testing import assert_equal
+
+from tefla.dataset import image_to_tfrecords
+
+
+def test_byte_balanced_shards():
+  sizes = [10, 10, 10, 70, 5, 5, 5, 5, 80]
+  bounds = image_to_tfrecords.byte_balanced_shards(sizes, 4)
+  assert_equal(bounds, [0, 3, 4, 8, 9])
+  assert_equal(image_to_tfrecords.byte_balanced_shards([], 2), [0, 0, 0])
+
+
+def test_shard_manifest(tmpdir):
+  path = str(tmpdir.join('train.manifest.json'))
+  fingerprint = image_to_tfrecords.files_fingerprint(['a.jpg', 'b.jpg'], [0, 1])
+  assert_equal(image_to_tfrecords.load_shard_manifest(path, fingerprint, 2), {})
+  image_to_tfrecords.save_shard_manifest(path, fingerprint, 2, {'train-00000-of-00002': 1})
+  assert_equal(
+      image_to_tfrecords.load_shard_manifest(path, fingerprint, 2), {'train-00000-of-00002': 1})
+  assert_equal(image_to_tfrecords.load_shard_manifest(path, fingerprint, 4), {})
+  other = image_to_tfrecords.files_fingerprint(['a.jpg', 'b.jpg'], [1, 1])
+  assert_equal(image_to_tfrecords.load_shard_manifest(path, other, 2), {})
+
+
+def test_num_threads_alias():
+  with pytest.warns(DeprecationWarning):
+    assert_equal(image_to_tfrecords._num_workers(None, 3), 3)
+  assert_equal(image_to_tfrecords._num_workers(2, None), 2)
+  assert_equal(image_to_tfrecords._num_workers(None, None), None)
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
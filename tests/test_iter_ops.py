@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+
+from tefla.core import iter_ops
+
+
+def no_op_preprocessor(img):
+  return img
+
+
+@pytest.mark.parametrize('sync', [True, False])
+def test_create_prediction_iter(sync):
+  data = np.arange(6 * 3 * 4 * 4).reshape(6, 3, 4, 4).astype(np.float32)
+  prediction_iter = iter_ops.create_prediction_iter({
+      'batch_size_test': 4
+  }, None, (4, 4), preprocessor=no_op_preprocessor, sync=sync)
+  assert prediction_iter.preprocessor is no_op_preprocessor
+  data2 = np.vstack([items[0] for items in prediction_iter(data)])
+  assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -1,8 +1,13 @@
+import os
+
+import SharedArray
 import numpy as np
 import pytest
 from numpy.testing import assert_array_equal, assert_equal
 
 from tefla.da import iterator
+from tefla.da.image_cache import ImageCache
+from tefla.da.standardizer import NoOpStandardizer, ScalingStandardizer
 
 
 def no_op_preprocessor(img):
@@ -13,6 +18,25 @@ def times_two_preprocessor(img):
   return img * 2
 
 
+class LoggingPreprocessor(object):
+  """Loads `.npy` images, logging every call to a file shared by the workers."""
+
+  def __init__(self, log_fname):
+    self.log_fname = log_fname
+
+  def __repr__(self):
+    return 'LoggingPreprocessor(%r)' % self.log_fname
+
+  def __call__(self, fname):
+    with open(self.log_fname, 'a') as f:
+      f.write(fname + '\n')
+    return np.load(fname)
+
+  def calls(self):
+    with open(self.log_fname) as f:
+      return len(f.readlines())
+
+
 def test_batch_iter():
   data = np.arange(36).reshape(12, 3)
   bi = iterator.BatchIterator(4, False)
@@ -49,6 +73,35 @@ def test_da_iter_with_pre_processing():
   assert_array_equal(data.transpose(0, 2, 3, 1) * 2, data2)
 
 
+def test_da_iter_with_batch_warp():
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4).astype(np.float32)
+  dai = iterator.DAIterator(4, False, no_op_preprocessor, (4, 4), is_training=False, batch_warp=True)
+  data2 = np.vstack([items[0] for items in dai(data)])
+  assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
+def test_da_iter_with_uint8_hwc():
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4).astype(np.uint8)
+  dai = iterator.DAIterator(4, False, no_op_preprocessor, (4, 4), is_training=False, uint8_hwc=True)
+  data2 = np.vstack([items[0] for items in dai(data)])
+  assert_equal(data2.dtype, np.uint8)
+  assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
+def test_da_iter_with_uint8_hwc_no_op_standardizer():
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4).astype(np.uint8)
+  dai = iterator.DAIterator(
+      4,
+      False,
+      no_op_preprocessor, (4, 4),
+      is_training=False,
+      standardizer=NoOpStandardizer(),
+      uint8_hwc=True)
+  data2 = np.vstack([items[0] for items in dai(data)])
+  assert_equal(data2.dtype, np.uint8)
+  assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
 def test_queued_da_iter():
   data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
   dai = iterator.QueuedDAIterator(4, False, no_op_preprocessor, (4, 4), is_training=False)
@@ -70,6 +123,112 @@ def test_parallel_da_iter_with_pre_processing():
   assert_array_equal(data.transpose(0, 2, 3, 1) * 2, data2)
 
 
+def test_parallel_da_iter_with_shared_slots():
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+  dai = iterator.ParallelDAIterator(
+      4, False, no_op_preprocessor, (4, 4), is_training=False, shared_slots=2)
+  for _ in range(2):
+    data2 = np.vstack([np.array(items[0]) for items in dai(data)])
+    assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+  dai.close()
+
+
+def test_parallel_da_iter_close_on_exit():
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+  with iterator.ParallelDAIterator(
+      4, False, no_op_preprocessor, (4, 4), is_training=False, shared_slots=2) as dai:
+    slot_names = list(dai.slot_names)
+    data2 = np.vstack([np.array(items[0]) for items in dai(data)])
+  assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+  assert_equal(dai.slot_names, [])
+  existing = set(item.name.decode() for item in SharedArray.list())
+  assert not existing.intersection(slot_names)
+  dai.close()
+
+
+def test_parallel_da_iter_with_prefetch():
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+  dai = iterator.ParallelDAIterator(
+      4, False, no_op_preprocessor, (4, 4), is_training=False, prefetch_batches=2)
+  data2 = np.vstack([items[0] for items in dai(data)])
+  assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
+def test_parallel_da_iter_with_image_cache(tmpdir):
+  data = np.arange(12 * 4 * 4 * 3).reshape(12, 4, 4, 3).astype(np.uint8)
+  fnames = []
+  for i, img in enumerate(data):
+    fnames.append(str(tmpdir.join('%d.npy' % i)))
+    np.save(fnames[-1], img)
+  preprocessor = LoggingPreprocessor(str(tmpdir.join('calls.log')))
+  with iterator.ParallelDAIterator(
+      4,
+      False,
+      preprocessor, (4, 4),
+      is_training=False,
+      image_cache=ImageCache(max_bytes=1024**2),
+      uint8_hwc=True) as dai:
+    for _ in range(2):
+      data2 = np.vstack([items[0] for items in dai(np.array(fnames))])
+      assert_array_equal(data.transpose(0, 2, 1, 3), data2)
+      # every worker reads the images decoded by the others
+      assert_equal(preprocessor.calls(), len(fnames))
+    cache_dir = dai.image_cache.cache_dir
+  assert not os.path.exists(cache_dir)
+
+
+@pytest.mark.parametrize('shared_slots', [None, 3])
+def test_parallel_da_iter_abandoned_epoch(shared_slots):
+  data = np.arange(40 * 3 * 4 * 4).reshape(40, 3, 4, 4)
+  with iterator.ParallelDAIterator(
+      4,
+      False,
+      no_op_preprocessor, (4, 4),
+      is_training=False,
+      shared_slots=shared_slots,
+      prefetch_batches=2) as dai:
+    for i, items in enumerate(dai(data)):
+      if i == 1:
+        break
+    abandoned = iter(dai(data))
+    next(abandoned)
+    epoch = iter(dai(data))
+    # starting an epoch stops the previous one
+    with pytest.raises(StopIteration):
+      next(abandoned)
+    data2 = np.vstack([np.array(items[0]) for items in epoch])
+    assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
+def test_parallel_da_iter_with_uint8_hwc():
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4).astype(np.uint8)
+  dai = iterator.ParallelDAIterator(
+      4, False, times_two_preprocessor, (4, 4), is_training=False, uint8_hwc=True)
+  data2 = np.vstack([items[0] for items in dai(data)])
+  assert_equal(data2.dtype, np.uint8)
+  assert_array_equal(data.transpose(0, 2, 3, 1) * 2, data2)
+
+
+@pytest.mark.parametrize('shared_slots', [None, 2])
+def test_parallel_da_iter_with_uint8_hwc_rejects_float(shared_slots):
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4).astype(np.float32)
+  with iterator.ParallelDAIterator(
+      4, False, no_op_preprocessor, (4, 4), is_training=False, shared_slots=shared_slots,
+      uint8_hwc=True) as dai:
+    with pytest.raises(TypeError):
+      list(dai(data))
+
+
+def test_parallel_da_iter_with_batch_standardizer():
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4).astype(np.float32)
+  dai = iterator.ParallelDAIterator(
+      4, False, no_op_preprocessor, (4, 4), is_training=False,
+      standardizer=ScalingStandardizer(0.5))
+  assert dai.batch_standardized()
+  data2 = np.vstack([items[0] for items in dai(data)])
+  assert_array_equal(data.transpose(0, 2, 3, 1) * 0.5, data2)
+
+
 def test_balancing_da_iter():
   data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
   dai = iterator.BalancingDAIterator(4, False, no_op_preprocessor, (4, 4), False, np.array([1.,
@@ -79,5 +238,31 @@ def test_balancing_da_iter():
   assert_array_equal(data.transpose(0, 2, 3, 1), data2)
 
 
+def test_balanced_sampler_class_frequencies():
+  np.random.seed(0)
+  y = np.array([0] * 80 + [1] * 15 + [2] * 5)
+  sampler = iterator.BalancedSampler(y, np.array([1., 2., 8.]))
+  indices = np.hstack(list(sampler.batches(1000, 100000)))
+  assert_equal(len(indices), 100000)
+  freqs = np.bincount(y[indices], minlength=3) / len(indices)
+  expected = np.array([80., 30., 40.]) / 150.
+  assert np.allclose(freqs, expected, atol=0.01)
+
+
+def test_balancing_da_iter_with_labels():
+  data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+  labels = np.array([0] * 6 + [1] * 6)
+  dai = iterator.BalancingDAIterator(4, True, no_op_preprocessor, (4, 4), False, np.array([0.,
+                                                                                           1.]),
+                                     np.array([1., 1.]), 0.5)
+  batches = list(dai(data, labels))
+  assert_equal(dai.count, 1)
+  assert_equal([len(yb) for _, yb in batches], [4, 4, 4])
+  assert_array_equal(np.hstack([yb for _, yb in batches]), np.ones(12))
+  for Xb, yb in batches:
+    for x in Xb:
+      assert any(np.array_equal(x, d) for d in data[6:].transpose(0, 2, 3, 1))
+
+
 if __name__ == '__main__':
   pytest.main([__file__])
@@ -1,9 +1,13 @@
+import os
+
 import tensorflow as tf
 import numpy as np
 import pytest
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 
 from tefla.core import metrics
+from tefla.convert_labels import convert_labels, pascal_palette
+from tefla.utils import quadratic_weighted_kappa as qwk
 
 
 @pytest.fixture(autouse=True)
@@ -26,5 +30,99 @@ def test_kappav2_op():
   assert_array_almost_equal(_kappa_metric, kappa_metric_)
 
 
+def test_confusion_matrix_accumulates_batches():
+  num_classes = 5
+  label_v = np.random.randint(low=0, high=num_classes, size=(100, ))
+  pred_v = np.random.rand(100, num_classes)
+  conf_mat = metrics.ConfusionMatrix(num_classes)
+  for i in range(0, 100, 32):
+    conf_mat.update(pred_v[i:i + 32], label_v[i:i + 32])
+
+  assert conf_mat.conf_mat.sum() == 100
+  assert_array_almost_equal(conf_mat.kappa(), metrics.Kappa().metric(pred_v, label_v, num_classes))
+  assert_array_almost_equal(conf_mat.accuracy(), np.mean(np.argmax(pred_v, axis=1) == label_v))
+
+
+def test_confusion_matrix_masks_out_of_range_labels():
+  conf_mat = metrics.ConfusionMatrix(3)
+  conf_mat.update(np.array([0, 1, 2, 3, -1, 1]), np.array([0, 1, 5, 2, 1, -2]))
+  assert_array_equal(conf_mat.conf_mat, np.diag([1, 1, 0]))
+
+
+def test_kappa_single_rating():
+  with pytest.raises(ZeroDivisionError):
+    qwk.kappa_from_confusion_matrix([[2]])
+  assert qwk.quadratic_weighted_kappa([1, 1], [1, 1], min_rating=1, max_rating=1) == 0.001
+  assert metrics.Kappa().metric(np.array([0, 0]), np.array([0, 0]), 1) == 0.0001
+  conf_mat = metrics.ConfusionMatrix(1)
+  conf_mat.update(np.array([0, 0]), np.array([0, 0]))
+  assert conf_mat.kappa() == 0.0001
+
+
+def test_kappa_all_agree():
+  assert qwk.quadratic_weighted_kappa([0, 1, 4, 2], [0, 1, 4, 2]) == 1.0
+  conf_mat = metrics.ConfusionMatrix(5)
+  conf_mat.update(np.array([0, 1, 4, 2]), np.array([0, 1, 4, 2]))
+  assert conf_mat.kappa() == 1.0
+  # a single rating used by both raters leaves no expected disagreement
+  assert qwk.quadratic_weighted_kappa([2, 2], [2, 2]) == 0.001
+
+
+def test_convert_labels_matches_palette_lookup():
+  palette = pascal_palette()
+  colors = np.array(list(palette.keys()) + [(1, 2, 3), (255, 255, 255)], dtype=np.uint8)
+  label_image = colors[np.random.randint(len(colors), size=(6, 7))]
+  expected = np.array([[palette.get(tuple(pixel), 0) for pixel in row] for row in label_image])
+  assert_array_equal(convert_labels(label_image, 6, 7), expected)
+
+
+def test_fast_hist_counts_pixels():
+  num_classes = 4
+  gt = np.random.randint(-1, num_classes + 1, size=200)
+  preds = np.random.randint(0, num_classes, size=200)
+  expected = np.zeros((num_classes, num_classes))
+  for g, p in zip(gt, preds):
+    if 0 <= g < num_classes:
+      expected[g, p] += 1
+  assert_array_equal(metrics.fast_hist(gt, preds, num_classes), expected)
+
+
+class MaskPredictor(object):
+  """Predicts the mask of an image, the image being the transposed mask."""
+
+  def __init__(self, masks):
+    self.masks = masks
+    self.calls = 0
+
+  def load_image(self, fname):
+    return self.masks[os.path.basename(fname)[:-4]].T
+
+  def predict(self, imgs):
+    self.calls += 1
+    assert all(isinstance(img, np.ndarray) for img in imgs)
+    return np.array(imgs)
+
+
+def test_iou_seg_evaluate(tmpdir, monkeypatch):
+  num_classes = 3
+  gts = dict(('%d' % i, np.random.randint(num_classes, size=(5, 5))) for i in range(5))
+  preds = dict((name, np.random.randint(num_classes, size=(5, 5))) for name in gts)
+  for name in gts:
+    tmpdir.join(name + '.jpg').write('')
+  colors = dict((label, color) for color, label in pascal_palette().items())
+  monkeypatch.setattr(
+      metrics, 'convert', lambda gt_name, image_size: np.array(
+          [[colors[c] for c in row] for row in gts[os.path.basename(gt_name)[:-15]]]))
+  predictor = MaskPredictor(preds)
+  iou = metrics.IOUSeg(num_classes=num_classes, batch_size=2, workers=2, prefetch_batches=1)
+  hist = iou.evaluate(predictor, str(tmpdir), 5)
+  expected = sum(metrics.compute_hist(preds[name], gts[name], num_classes) for name in gts)
+  assert_array_equal(hist, expected)
+  assert predictor.calls == 3
+  iou.meaniou(predictor, str(tmpdir), 5, hist=hist)
+  iou.per_class_iou(predictor, str(tmpdir), 5, hist=hist)
+  assert predictor.calls == 3
+
+
 if __name__ == '__main__':
   pytest.main([__file__])
@@ -11,7 +11,8 @@ import numpy as np
 
 import tensorflow as tf
 
-from tefla.core.metrics import BleuMetricSpec, RougeMetricSpec, moses_multi_bleu, rouge
+from tefla.core.metrics import BleuMetricSpec, RougeMetricSpec, moses_multi_bleu, rouge, \
+    bleu_stats, bleu_from_stats
 
 
 class TestMosesBleu(tf.test.TestCase):
@@ -49,6 +50,18 @@ class TestMosesBleu(tf.test.TestCase):
         lowercase=True,
         expected_bleu=46.51)
 
+  def test_bleu_stats_accumulate(self):
+    hypotheses = [
+        "The brown fox jumps over the dog 笑", "The brown fox jumps over the dog 2 笑", "A B"
+    ]
+    references = [
+        "The quick brown fox jumps over the lazy dog 笑",
+        "The quick brown fox jumps over the lazy dog 笑", "A B C"
+    ]
+    stats = bleu_stats(hypotheses[:1], references[:1]) + bleu_stats(hypotheses[1:], references[1:])
+    self.assertAllEqual(stats, bleu_stats(hypotheses, references))
+    self.assertEqual(bleu_from_stats(stats), moses_multi_bleu(hypotheses, references))
+
 
 class TestTextMetricSpec(tf.test.TestCase):
   """Abstract class for testing TextMetricSpecs
@@ -148,6 +161,11 @@ class TestRougeMetric(tf.test.TestCase):
     self.assertNDArrayNear(output["rouge_2/f_score"], 0.548, 0.01)
     self.assertNDArrayNear(output["rouge_l/f_score"], 0.852, 0.01)
 
+  def test_rouge_processes(self):
+    hypotheses = ["The brown fox jumps over the dog 笑", "A B C D E F", "A", ""] * 5
+    references = ["The quick brown fox jumps over the lazy dog 笑", "A B A D E F", "B", ""] * 5
+    self.assertEqual(rouge(hypotheses, references), rouge(hypotheses, references, processes=2))
+
 
 if __name__ == "__main__":
   tf.test.main()
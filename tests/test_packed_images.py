@@ -0,0 +1,56 @@
+import pickle
+
+import numpy as np
+import pytest
+from PIL import Image
+from numpy.testing import assert_array_equal, assert_equal
+
+from tefla.da import iterator
+from tefla.da.packed_images import pack_images, PackedImages
+
+
+@pytest.fixture
+def image_files(tmpdir):
+  fnames = []
+  for i in range(10):
+    fname = str(tmpdir.join('%d.png' % i))
+    Image.fromarray(np.full((4, 4 + i % 2, 3), i * 10, dtype=np.uint8)).save(fname)
+    fnames.append(fname)
+  return fnames
+
+
+def test_pack_and_read(tmpdir, image_files):
+  packed = pack_images(
+      image_files, str(tmpdir.join('data.packed')), labels=np.arange(10), processes=2)
+  assert_equal(len(packed), 10)
+  assert_array_equal(packed.labels, np.arange(10))
+  for i, fname in enumerate(image_files):
+    assert_array_equal(packed[i], np.asarray(Image.open(fname)))
+    assert_array_equal(packed(fname), np.asarray(Image.open(fname)))
+
+
+def test_pack_no_images(tmpdir):
+  packed = pack_images([], str(tmpdir.join('data.packed')), processes=1)
+  assert_equal(len(packed), 0)
+  assert_equal(len(packed.labels), 0)
+
+
+def test_pickle_keeps_only_path(tmpdir, image_files):
+  packed = pack_images(image_files, str(tmpdir.join('data.packed')), processes=2)
+  packed(image_files[3])
+  unpickled = pickle.loads(pickle.dumps(packed))
+  assert len(pickle.dumps(packed)) < 200
+  assert_array_equal(unpickled(image_files[3]), packed(image_files[3]))
+
+
+def test_parallel_da_iter_with_packed_images(tmpdir, image_files):
+  image_files = image_files[::2]
+  packed = pack_images(image_files, str(tmpdir.join('data.packed')), processes=2)
+  dai = iterator.ParallelDAIterator(2, False, None, (4, 4), is_training=False)
+  packed_dai = iterator.ParallelDAIterator(2, False, packed, (4, 4), is_training=False)
+  expected = np.vstack([items[0] for items in dai(np.array(image_files))])
+  assert_array_equal(expected, np.vstack([items[0] for items in packed_dai(packed.names)]))
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
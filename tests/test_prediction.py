@@ -0,0 +1,207 @@
+import functools
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from numpy.testing import assert_allclose, assert_array_equal, assert_equal
+
+from tefla.core.prediction import CSVPredictionWriter, EnsemblePredictor, NpyPredictionWriter, \
+    OneCropPredictor, TenCropPredictor, stream_predictions
+from tefla.da import data, iterator
+from tefla.da.standardizer import AggregateStandardizer
+from tefla.utils import util
+
+NAMES = ['img%d' % i for i in range(10)]
+
+
+class FakePredictor(object):
+
+  def __init__(self, fail_after=None):
+    self.fail_after = fail_after
+    self.predicted = []
+
+  def predict(self, X):
+    if self.fail_after is not None and len(self.predicted) >= self.fail_after:
+      raise RuntimeError('crash')
+    self.predicted.extend(X)
+    return np.array([[int(x[3:]), 0.5] for x in X], dtype=np.float32)
+
+
+def _stream_with_crash(writer_cls, path):
+  with pytest.raises(RuntimeError):
+    stream_predictions(FakePredictor(fail_after=4), NAMES, writer_cls(path, NAMES), block_size=4)
+  predictor = FakePredictor()
+  stream_predictions(predictor, NAMES, writer_cls(path, NAMES), block_size=4)
+  return predictor
+
+
+def test_csv_resume(tmpdir):
+  path = str(tmpdir.join('predictions.csv'))
+  predictor = _stream_with_crash(CSVPredictionWriter, path)
+  assert_equal(predictor.predicted, NAMES[4:])
+  rows = np.loadtxt(path, delimiter=',', dtype=str)
+  assert_array_equal(rows[0], ['image', 'score1', 'score2'])
+  assert_array_equal(rows[1:, 0], NAMES)
+  assert_array_equal(rows[1:, 1].astype(float), np.arange(10))
+
+
+def test_csv_resume_drops_uncommitted_rows(tmpdir):
+  path = str(tmpdir.join('predictions.csv'))
+  writer = CSVPredictionWriter(path, NAMES)
+  writer.write(np.ones((3, 2)))
+  with open(path, 'ab') as f:
+    f.write(b'img3,1.0,1.0\nimg4,1.')
+  writer = CSVPredictionWriter(path, NAMES)
+  assert_equal(writer.rows_written, 3)
+  writer.write(np.ones((7, 2)))
+  rows = np.loadtxt(path, delimiter=',', dtype=str)
+  assert_array_equal(rows[1:, 0], NAMES)
+
+
+def test_csv_resume_checks_names(tmpdir):
+  path = str(tmpdir.join('predictions.csv'))
+  CSVPredictionWriter(path, NAMES).write(np.ones((3, 2)))
+  with pytest.raises(ValueError):
+    CSVPredictionWriter(path, NAMES[::-1])
+  writer = CSVPredictionWriter(path, NAMES)
+  with pytest.raises(ValueError):
+    writer.write(np.ones((3, 5)))
+
+
+def test_csv_refuses_file_without_counter(tmpdir):
+  path = tmpdir.join('predictions.csv')
+  path.write('image,score1\nimg0,1.0\n')
+  with pytest.raises(IOError):
+    CSVPredictionWriter(str(path), NAMES)
+
+
+def test_npy_resume(tmpdir):
+  path = str(tmpdir.join('predictions.npy'))
+  predictor = _stream_with_crash(NpyPredictionWriter, path)
+  assert_equal(predictor.predicted, NAMES[4:])
+  predictions = np.load(path)
+  assert_array_equal(predictions[:, 0], np.arange(10))
+  with pytest.raises(ValueError):
+    NpyPredictionWriter(path, NAMES[::-1])
+
+
+def no_op_preprocessor(img):
+  return img
+
+
+class MeanSession(object):
+  """Predicts the per channel means of the inputs."""
+
+  def __init__(self):
+    self.calls = 0
+
+  def run(self, fetch, feed_dict):
+    self.calls += 1
+    return list(feed_dict.values())[0].mean(axis=(1, 2))
+
+
+def _one_crop_predictor(prediction_iterator):
+  predictor = OneCropPredictor.__new__(OneCropPredictor)
+  predictor.prediction_iterator = prediction_iterator
+  predictor.sess = MeanSession()
+  predictor.inputs = 'inputs'
+  predictor.predictions = tf.placeholder(tf.float32, (None, 3))
+  return predictor
+
+
+def _standardizer():
+  return AggregateStandardizer(
+      np.array([0.5, 0.4, 0.3], dtype=np.float32),
+      np.array([2., 3., 4.], dtype=np.float32),
+      np.eye(3, dtype=np.float32),
+      np.array([0.1, 0.2, 0.3], dtype=np.float32))
+
+
+def test_fused_predict_empty():
+  it = iterator.DAIterator(4, False, no_op_preprocessor, (8, 8), is_training=False)
+  predictor = _one_crop_predictor(it)
+  predictions = predictor._real_predict_fused([], None, 4)
+  assert_equal(predictions.shape, (0, 3))
+  assert_equal(predictor.sess.calls, 0)
+
+
+def test_load_augment_tta_matches_transform_passes():
+  rng = np.random.RandomState(0)
+  X = rng.rand(5, 3, 8, 8).astype(np.float32)
+  transforms = [
+      data.build_augmentation_transform(),
+      data.build_augmentation_transform(zoom=(1.2, 1.2), rotation=30, translation=(1, -1)),
+      data.build_augmentation_transform(zoom=(0.9, 0.9), shear=10, flip=True),
+  ]
+  color_vecs = rng.normal(0.0, 0.5, (len(transforms), 3)).astype(np.float32)
+  standardizer = _standardizer()
+  it = iterator.DAIterator(
+      2, False, no_op_preprocessor, (8, 8), is_training=False, standardizer=standardizer)
+  augment_fn = functools.partial(
+      data.load_augment_tta,
+      preprocessor=no_op_preprocessor,
+      w=it.w,
+      h=it.h,
+      transforms=transforms,
+      color_vecs=color_vecs,
+      fill_mode=it.fill_mode,
+      fill_mode_cval=it.fill_mode_cval,
+      standardizer=standardizer)
+  fused = np.array([augment_fn(x) for x in X])
+  predictor = _one_crop_predictor(it)
+  fused_predictions = predictor._real_predict_fused(X, augment_fn, len(transforms))
+
+  # one pass per variant, as the unfused QuasiCropPredictor
+  total_predictions = 0
+  for i, (transform, color_vec) in enumerate(zip(transforms, color_vecs)):
+    standardizer.set_tta_args(color_vec=color_vec)
+    unfused = np.vstack([Xb for Xb, _ in it(X, xform=transform)])
+    assert_allclose(fused[:, i], unfused, rtol=1e-5, atol=1e-5)
+    total_predictions = total_predictions + predictor._real_predict(X, xform=transform)
+  assert_allclose(fused_predictions, total_predictions / len(transforms), rtol=1e-5, atol=1e-5)
+
+
+def test_load_augment_crops_matches_crop_passes():
+  X = np.random.RandomState(0).rand(5, 3, 8, 8).astype(np.float32)
+  bboxs = util.get_bbox_10crop(np.array((6, 6)), np.array((8, 8)))
+  standardizer = _standardizer()
+  it = iterator.DAIterator(
+      2, False, no_op_preprocessor, (6, 6), is_training=False, standardizer=standardizer)
+  augment_fn = functools.partial(
+      data.load_augment_crops,
+      preprocessor=no_op_preprocessor,
+      bboxs=bboxs,
+      standardizer=standardizer)
+  fused = np.array([augment_fn(x) for x in X])
+  predictor = _one_crop_predictor(it)
+  fused_predictions = predictor._real_predict_fused(X, augment_fn, len(bboxs))
+
+  # one pass per crop, as the unfused TenCropPredictor
+  total_predictions = 0
+  for i, bbox in enumerate(bboxs):
+    unfused = np.vstack([Xb for Xb, _ in it(X, crop_bbox=bbox)])
+    assert_allclose(fused[:, i], unfused, rtol=1e-5, atol=1e-5)
+    total_predictions = total_predictions + predictor._real_predict(X, crop_bbox=bbox)
+  assert_allclose(fused_predictions, total_predictions / len(bboxs), rtol=1e-5, atol=1e-5)
+
+
+def test_shared_ensemble():
+  X = np.random.RandomState(0).rand(5, 3, 8, 8).astype(np.float32)
+  it = iterator.DAIterator(2, False, no_op_preprocessor, (8, 8), is_training=False)
+  members = [_one_crop_predictor(it), _one_crop_predictor(it)]
+  for parallel in [False, True]:
+    ensemble = EnsemblePredictor(members, prediction_iterator=it, parallel=parallel)
+    assert_allclose(ensemble.predict(X), X.mean(axis=(2, 3)), rtol=1e-5)
+
+
+def test_shared_ensemble_rejects_tta_members():
+  it = iterator.DAIterator(2, False, no_op_preprocessor, (8, 8), is_training=False)
+  ten_crop = TenCropPredictor.__new__(TenCropPredictor)
+  ten_crop.predictor = _one_crop_predictor(it)
+  with pytest.raises(ValueError):
+    EnsemblePredictor([_one_crop_predictor(it), ten_crop], prediction_iterator=it)
+  EnsemblePredictor([_one_crop_predictor(it), ten_crop])
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
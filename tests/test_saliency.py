@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from tefla.core.saliency import Occlusion
+
+
+class FakeTensor(object):
+
+  def __init__(self, shape):
+    self.shape = shape
+
+
+class WeightedSumSession(object):
+  """Scores every image by a fixed weighted sum of its pixels."""
+
+  def __init__(self, weights, y, batch_y, x):
+    self.weights = weights
+    self.y = y
+    self.batch_y = batch_y
+    self.x = x
+    self.calls = 0
+
+  def scores(self, x_value):
+    return (np.asarray(x_value) * self.weights).sum(axis=(1, 2, 3))
+
+  def run(self, fetch, feed_dict):
+    self.calls += 1
+    scores = self.scores(feed_dict[self.x])
+    return scores if fetch is self.batch_y else scores[0]
+
+  def make_callable(self, fetch, feed_list):
+    assert fetch is self.y and feed_list[0] is self.x
+
+    def run(x_value, *feed_values):
+      self.calls += 1
+      return self.scores(x_value)[0]
+
+    return run
+
+
+def direct_occlusion(session, x_value, size, value):
+  """Adds the score difference of every window to the pixels it covers."""
+  original_y_value = session.scores([x_value])[0]
+  occlusion_scores = np.zeros_like(x_value)
+  for row in range(x_value.shape[0] - size):
+    for col in range(x_value.shape[1] - size):
+      x_occluded = np.array(x_value)
+      x_occluded[row:row + size, col:col + size, :] = value
+      occlusion_scores[row:row + size, col:col + size, :] += (
+          original_y_value - session.scores([x_occluded])[0])
+  return occlusion_scores
+
+
+@pytest.mark.parametrize('batched', [False, True])
+def test_occlusion_box_sums_match_direct_window_sums(batched):
+  rng = np.random.RandomState(0)
+  x_value = rng.rand(12, 10, 3)
+  y, batch_y, x = FakeTensor(()), FakeTensor((None,)), FakeTensor((None, 12, 10, 3))
+  session = WeightedSumSession(rng.rand(12, 10, 3), y, batch_y, x)
+  occlusion = Occlusion(None, session, y, x, batch_y=batch_y if batched else None)
+  mask = occlusion.GetMask(x_value, feed_dict={}, size=4, value=0.5, batch_size=16)
+  assert_allclose(mask, direct_occlusion(session, x_value, 4, 0.5), rtol=1e-10, atol=1e-10)
+  num_windows = (12 - 4) * (10 - 4)
+  assert session.calls == 1 + (-(-num_windows // 16) if batched else num_windows)
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -4,6 +4,7 @@ import pytest
 from numpy.testing import assert_array_almost_equal
 from tefla.da.standardizer import AggregateStandardizer, AggregateStandardizerTF
 from tefla.da.standardizer import SamplewiseStandardizer, SamplewiseStandardizerTF
+from tefla.da.standardizer import ZCAStandardizer
 
 
 @pytest.fixture(autouse=True)
@@ -60,5 +61,52 @@ def test_np_tf_samplewise():
   assert_array_almost_equal(im_st, im_, decimal=4)
 
 
+@pytest.mark.parametrize('is_training', [True, False])
+def test_np_batch_aggregate(is_training):
+  standardizer = AggregateStandardizer(
+      mean=np.array([108.64628601, 75.86886597, 54.34005737], dtype=np.float32),
+      std=np.array([70.53946096, 51.71475228, 43.03428563], dtype=np.float32),
+      u=np.array(
+          [[-0.56543481, 0.71983482, 0.40240142], [-0.5989477, -0.02304967, -0.80036049],
+           [-0.56694071, -0.6935729, 0.44423429]],
+          dtype=np.float32),
+      ev=np.array([1.65513492, 0.48450358, 0.1565086], dtype=np.float32),
+      sigma=0.5,
+      color_vec=np.array([0.2, -0.1, 0.3]))
+  imgs = np.random.uniform(0.0, 255.0, size=(4, 20, 16, 3)).astype(np.float32)
+  np.random.seed(7)
+  expected = np.array(
+      [standardizer(img.transpose(2, 0, 1).copy(), is_training).transpose(1, 2, 0) for img in imgs])
+  np.random.seed(7)
+  assert_array_almost_equal(expected, standardizer.standardize_batch(imgs.copy(), is_training),
+                            decimal=5)
+
+
+@pytest.mark.parametrize('channel_wise', [True, False])
+def test_np_batch_samplewise(channel_wise):
+  st = SamplewiseStandardizer(clip=6, channel_wise=channel_wise)
+  imgs = np.random.normal(50.0, 2.5, size=(4, 20, 16, 3)).astype(np.float32)
+  expected = np.array([st(img.transpose(2, 0, 1).copy(), False).transpose(1, 2, 0) for img in imgs])
+  assert_array_almost_equal(expected, st.standardize_batch(imgs.copy(), False), decimal=4)
+
+
+def test_np_zca_low_rank():
+  x = np.random.normal(size=(200, 4, 4, 3)).astype(np.float32)
+  flat = x.reshape(len(x), -1)
+  mean = flat.mean(axis=0)
+  eigvals, u = np.linalg.eigh(np.cov(flat, rowvar=False, bias=True))
+  eigvals, u = eigvals[::-1], u[:, ::-1]
+  full = ZCAStandardizer(mean, u, eigvals, epsilon=1e-5)
+  w = np.dot(u / np.sqrt(eigvals + 1e-5), u.T)
+  assert_array_almost_equal(np.dot(flat - mean, w).reshape(x.shape),
+                            full.standardize_batch(x.copy(), True), decimal=4)
+  low_rank = ZCAStandardizer(mean, u, eigvals, rank=10, epsilon=1e-5)
+  w10 = np.dot(u[:, :10] / np.sqrt(eigvals[:10] + 1e-5), u[:, :10].T)
+  white = low_rank.standardize_batch(x.copy(), True)
+  assert_array_almost_equal(np.dot(flat - mean, w10).reshape(x.shape), white, decimal=4)
+  assert_array_almost_equal(white[0].transpose(2, 0, 1), low_rank(x[0].transpose(2, 0, 1), True),
+                            decimal=4)
+
+
 if __name__ == '__main__':
   pytest.main([__file__])
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from tefla.dataset.base import Dataset
+from tefla.dataset.decoder import Decoder
+from tefla.dataset.dataflow import TFDataflow
+from tefla.dataset import tfrecord_index
+
+
+def _example(image, label):
+  buf = io.BytesIO()
+  Image.fromarray(image).save(buf, format='JPEG')
+  return tf.train.Example(
+      features=tf.train.Features(
+          feature={
+              'image/encoded/image':
+              tf.train.Feature(bytes_list=tf.train.BytesList(value=[buf.getvalue()])),
+              'image/class/label':
+              tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+          }))
+
+
+class TFDataflowTest(tf.test.TestCase):
+
+  def setUp(self):
+    self.data_dir = tempfile.mkdtemp()
+    for shard in range(2):
+      path = os.path.join(self.data_dir, 'train-%.5d-of-00002' % shard)
+      writer = tf.python_io.TFRecordWriter(path)
+      for label in range(shard * 6, shard * 6 + 6):
+        image = np.full((8, 8, 3), label * 10, dtype=np.uint8)
+        writer.write(_example(image, label).SerializeToString())
+      writer.close()
+    features_keys = {
+        'image/encoded/image': tf.FixedLenFeature((), tf.string, default_value=''),
+        'image/class/label':
+        tf.FixedLenFeature([], tf.int64, default_value=tf.zeros([], dtype=tf.int64)),
+    }
+    self.dataset = Dataset('test', Decoder(features_keys), self.data_dir, num_examples_per_epoch=12)
+
+  def testBatchInputsInOrder(self):
+    dataflow = TFDataflow(self.dataset, shuffle=False)
+    images, labels = dataflow.batch_inputs(4, False, [8, 8, 3], [8, 8], num_preprocess_threads=4)
+    self.assertEqual(images.get_shape().as_list(), [4, 8, 8, 3])
+    with self.test_session() as sess:
+      for i in range(3):
+        images_value, labels_value = sess.run([images, labels])
+        self.assertAllEqual(labels_value, np.arange(i * 4, i * 4 + 4))
+
+  def testBatchInputsGlobalShuffle(self):
+    for path in self.dataset.data_files():
+      tfrecord_index.build_index(path)
+    indexed_records = self.dataset.indexed_records()
+    dataflow = TFDataflow(self.dataset, shuffle=True, num_epochs=2, global_shuffle=True, seed=3)
+    _, labels = dataflow.batch_inputs(12, True, [8, 8, 3], [8, 8], num_preprocess_threads=4)
+    with self.test_session() as sess:
+      orders = [sess.run(labels) for _ in range(2)]
+      with self.assertRaises(tf.errors.OutOfRangeError):
+        sess.run(labels)
+    # the label of a record is its index, so every epoch reads its permutation in order
+    for epoch, order in enumerate(orders):
+      self.assertAllEqual(order, indexed_records.permutation(epoch, seed=3))
+    self.assertFalse(np.array_equal(orders[0], orders[1]))
+    indexed_records.close()
+
+  def testGlobalShuffleNeedsIndexes(self):
+    dataflow = TFDataflow(self.dataset, shuffle=True, global_shuffle=True)
+    with self.assertRaises(IOError):
+      dataflow.batch_inputs(4, True, [8, 8, 3], [8, 8])
+
+  def testGetBatchBalanced(self):
+    dataflow = TFDataflow(self.dataset, shuffle=True)
+    target_probs = [0.5, 0.5] + [0.] * 10
+    images, labels = dataflow.get_batch(
+        4, target_probs, [8, 8, 3], crop_size=[8, 8], num_preprocess_threads=4)
+    self.assertEqual(images.get_shape().as_list(), [4, 8, 8, 3])
+    with self.test_session() as sess:
+      coord = tf.train.Coordinator()
+      threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+      try:
+        for _ in range(3):
+          images_value, labels_value = sess.run([images, labels])
+          self.assertTrue(np.in1d(labels_value, [0, 1]).all())
+          self.assertAllClose(images_value[:, 0, 0, 0], labels_value * 10, atol=2)
+      finally:
+        coord.request_stop()
+        coord.join(threads)
+
+
+if __name__ == '__main__':
+  tf.test.main()
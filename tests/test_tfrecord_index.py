@@ -0,0 +1,84 @@
+import os
+import pickle
+import struct
+import threading
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal, assert_equal
+
+from tefla.dataset import tfrecord_index
+
+
+def write_records(path, records):
+  # TFRecord framing, with dummy crcs
+  with open(path, 'wb') as f:
+    for record in records:
+      f.write(struct.pack('<QI', len(record), 0))
+      f.write(record)
+      f.write(struct.pack('<I', 0))
+
+
+@pytest.fixture
+def shards(tmpdir):
+  records = [(b'record-%d-' % i) * (i + 1) for i in range(10)]
+  paths = [str(tmpdir.join('train-0000%d-of-00002' % i)) for i in range(2)]
+  write_records(paths[0], records[:6])
+  write_records(paths[1], records[6:])
+  return paths, records
+
+
+def test_index_random_access(shards):
+  paths, records = shards
+  tfrecord_index.write_index(paths[0], [len(r) for r in records[:6]], labels=[0, 1] * 3)
+  # the second index is built by scanning the shard
+  reader = tfrecord_index.IndexedTFRecords(paths)
+  assert_equal(len(reader), 10)
+  assert_array_equal(reader.labels, [0, 1, 0, 1, 0, 1, -1, -1, -1, -1])
+  for i in [7, 0, 9, 3]:
+    assert_equal(reader[i], records[i])
+  assert_equal(reader.read([2, 8]), [records[2], records[8]])
+  unpickled = pickle.loads(pickle.dumps(reader))
+  assert_equal(unpickled[5], records[5])
+  reader.close()
+
+
+def test_index_threaded_reads_open_each_shard_once(shards):
+  paths, records = shards
+  reader = tfrecord_index.IndexedTFRecords(paths)
+  num_fds = len(os.listdir('/proc/self/fd'))
+  start = threading.Event()
+
+  def read():
+    start.wait()
+    for i in range(10):
+      assert_equal(reader[i], records[i])
+
+  threads = [threading.Thread(target=read) for _ in range(8)]
+  for thread in threads:
+    thread.start()
+  start.set()
+  for thread in threads:
+    thread.join()
+  assert_equal(len(os.listdir('/proc/self/fd')), num_fds + 2)
+  reader.close()
+  assert_equal(len(os.listdir('/proc/self/fd')), num_fds)
+
+
+def test_index_sampling(shards):
+  paths, records = shards
+  tfrecord_index.write_index(paths[0], [len(r) for r in records[:6]], labels=[0, 0, 0, 0, 0, 1])
+  tfrecord_index.write_index(paths[1], [len(r) for r in records[6:]], labels=[0, 0, 0, 0])
+  reader = tfrecord_index.IndexedTFRecords(paths)
+  assert_array_equal(np.sort(reader.permutation(3)), np.arange(10))
+  assert_array_equal(reader.permutation(3), reader.permutation(3))
+  indices = reader.stratified_indices([0.5, 0.5], 10000, seed=0)
+  assert abs(np.mean(reader.labels[indices]) - 0.5) < 0.02
+  assert_equal(np.sum(indices == 5), np.sum(reader.labels[indices] == 1))
+  subset = reader.subset(4)
+  assert_equal(len(np.unique(subset)), 4)
+  assert_array_equal(subset, np.sort(subset))
+
+
+if __name__ == '__main__':
+  pytest.main([__file__])
@@ -25,9 +25,15 @@ from tefla.dataset.image_to_tfrecords import TFRecords
     show_default=True,
     help="Datset dir with jpeg/png images.")
 @click.option('--label_file', show_default=True, help="Path to the label file.")
-def process_dataset(records_name, num_shards, data_dir, output_data_dir, label_file):
+@click.option(
+    '--num_workers',
+    default=None,
+    type=int,
+    help="Number of worker processes, one per cpu by default.")
+def process_dataset(records_name, num_shards, data_dir, output_data_dir, label_file, num_workers):
   im2r = TFRecords()
-  im2r.process_dataset(records_name, data_dir, output_data_dir, num_shards, label_file)
+  im2r.process_dataset(
+      records_name, data_dir, output_data_dir, num_shards, label_file, num_workers=num_workers)
 
 
 if __name__ == '__main__':